@@ -1,48 +1,412 @@
-from flask import Flask, request, abort, jsonify
+import itertools
+import json
+import os
+from flask import (Flask, Response, request, abort, g, jsonify,
+                   stream_with_context)
 from flask_cors import CORS
 from models import *
-from auth import AuthError, requires_auth
+from auth import AuthError, requires_auth, token_cache
+from cache import make_etag, response_cache
+from compression import (COMPRESS_MIN_SIZE, COMPRESSIBLE_TYPES,
+                         available_encodings, choose_encoding, compress,
+                         variant_etag)
+from filters import filter_actors, filter_movies
+import metrics
+from metrics import SERVER_TIMING, begin_request, finish_request, span
+from pagination import paginate, parse_page
+from serializers import (actor_serializer, json_response, linked,
+                         movie_serializer)
+from stats import (actor_stats, actor_statements, execute, movie_stats,
+                   movie_statements, parse_age_bucket)
+from validation import (BULK_MAX_ITEMS, parse_int, validate_actors,
+                        validate_movies)
 from datetime import datetime
 
+# rows fetched per round trip by the export endpoints
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+version_listeners.append(response_cache.invalidate)
+
+# seconds the reads of a client stay on the primary after it wrote,
+# long enough for the replicas to catch up
+READ_YOUR_WRITES_SECONDS = int(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+READ_PRIMARY_COOKIE = 'read_primary'
+READ_PRIMARY_HEADER = 'X-Read-Primary'
+READ_METHODS = ('GET', 'HEAD')
+
+
+def cache_metrics():
+    tokens = token_cache.stats()
+    responses = response_cache.stats()
+    pool = get_pool_stats()
+    return [
+        ('token_cache_hits_total', 'counter', 'Verified token cache hits',
+         tokens['hits']),
+        ('token_cache_misses_total', 'counter',
+         'Verified token cache misses', tokens['misses']),
+        ('token_cache_size', 'gauge', 'Verified tokens cached',
+         tokens['size']),
+        ('response_cache_hits_total', 'counter', 'Response cache hits',
+         responses['hits']),
+        ('response_cache_misses_total', 'counter', 'Response cache misses',
+         responses['misses']),
+        ('db_pool_checkouts_total', 'counter', 'Connection checkouts',
+         pool['checkouts']),
+        ('db_pool_timeouts_total', 'counter',
+         'Connection checkouts that timed out', pool['timeouts']),
+        ('db_pool_wait_seconds_total', 'counter',
+         'Time spent waiting for a connection', pool['wait_total_seconds']),
+        ('db_pool_checked_out', 'gauge', 'Connections in use',
+         pool.get('checked_out', 0)),
+    ]
+
+
+metrics.collectors.append(cache_metrics)
+
+
+def request_etag(tables):
+    '''
+        Strong ETag of the current GET request derived from its path,
+        query parameters and the versions of the tables it reads. It is
+        computed before the rows are read, so a write in between only
+        causes one extra refresh.
+    '''
+    return make_etag(request.path, request.args.items(multi=True),
+                     get_versions(tables))
+
+
+def not_modified(etag):
+    '''
+        Return a 304 response if the client already has etag, in any
+        encoding, else None
+    '''
+    for tag in [etag] + [variant_etag(etag, encoding)
+                         for encoding in available_encodings()]:
+        if request.if_none_match.contains_weak(tag):
+            response = Response(status=304)
+            response.set_etag(tag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+    return None
+
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def cached_json(tables, build):
+    '''
+        Serve the current GET request from the ETag check, then from the
+        response cache, compressed body first, and only call build() to
+        produce the JSON response when neither has it
+    '''
+    etag = request_etag(tables)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    # compress_response caches the compressed bodies of these tables
+    g.cache_tables = tables
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is not None:
+        body = response_cache.get(variant_etag(etag, encoding))
+        if body is not None:
+            response = Response(body, mimetype='application/json')
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return with_etag(response, variant_etag(etag, encoding))
+
+    body = response_cache.get(etag)
+    if body is None:
+        response = build()
+        if response.status_code == 200:
+            response_cache.set(etag, response.get_data(), tables)
+    else:
+        response = Response(body, mimetype='application/json')
+    return with_etag(response, etag)
+
+
+def compress_response(response):
+    '''
+        Encode the body with the best encoding the client accepts when
+        it is large enough. The compressed body of a cached response is
+        cached under its variant ETag.
+    '''
+    if response.status_code != 200 or response.is_streamed or \
+            response.direct_passthrough or \
+            'Content-Encoding' in response.headers or \
+            response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None or \
+            response.calculate_content_length() < COMPRESS_MIN_SIZE:
+        return response
+
+    etag, weak = response.get_etag()
+    tables = g.get('cache_tables')
+    key = None if etag is None or weak or tables is None else \
+        variant_etag(etag, encoding)
+    with span('compress'):
+        body = compress(response.get_data(), encoding)
+    if key is not None:
+        response_cache.set(key, body, tables)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    if etag is not None:
+        response.set_etag(variant_etag(etag, encoding), weak)
+    return response
+
+
+def bulk_items():
+    '''Return the JSON array of the request body, abort 400 if invalid'''
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not 0 < len(items) <= BULK_MAX_ITEMS:
+        abort(400)
+    return items
+
+
+def bulk_errors_response(errors):
+    return jsonify(
+        {
+            'success': False,
+            'error': 422,
+            'message': 'Unprocessable entity',
+            'errors': errors,
+        }), 422
+
+
+def ndjson_response(serializer, query):
+    '''
+        Stream the rows of query as newline delimited JSON. Rows are read
+        from a server-side cursor and serialized a batch at a time so
+        memory stays flat whatever the table size.
+    '''
+    def generate():
+        rows = iter(query.yield_per(EXPORT_BATCH_SIZE))
+        while True:
+            batch = list(itertools.islice(rows, EXPORT_BATCH_SIZE))
+            if not batch:
+                break
+            yield ''.join(json.dumps(item) + '\n'
+                          for item in serializer.format(batch))
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    setup_db(app, test_config=test_config)
     CORS(app)
 
+    @app.before_request
+    def start_timings():
+        begin_request()
+
+    @app.before_request
+    def route_reads():
+        if ('replicas' in app.extensions and request.method in READ_METHODS
+                and READ_PRIMARY_COOKIE not in request.cookies
+                and READ_PRIMARY_HEADER not in request.headers):
+            use_replica()
+
     @app.after_request
     def after_request(response):
         response.headers.add(
             'Access-Control-Allow-Headers', 'Content-Type, Autorization')
         response.headers.add(
             'Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS')
+        response.headers.add('Access-Control-Expose-Headers', 'ETag')
+        compress_response(response)
+        if ('replicas' in app.extensions and response.status_code < 400
+                and request.method not in READ_METHODS + ('OPTIONS',)):
+            # read your writes: the next reads of this client skip the
+            # replicas until they have caught up
+            response.set_cookie(READ_PRIMARY_COOKIE, '1',
+                                max_age=READ_YOUR_WRITES_SECONDS)
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        server_timing = finish_request(
+            request.method, route, response.status_code)
+        if SERVER_TIMING and server_timing is not None:
+            response.headers['Server-Timing'] = server_timing
         return response
 
-    # GET all movies
+    # Prometheus metrics of this worker, for the scraper holding the
+    # metrics token only
+    @app.route('/metrics')
+    def metrics_export():
+        if not metrics.METRICS_TOKEN:
+            abort(404)
+        if not metrics.scrape_allowed(request.headers.get('Authorization')):
+            abort(401)
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    # GET a page of movies
     @app.route('/movies')
     @requires_auth('get:movies')
     def movies_retrieve(jwt):
-        q_movie = Movie.query.all()
-        movies = [movie.format() for movie in q_movie]
+        include = request.args.get('include')
+        try:
+            page = parse_page(request.args, Movie, Movie.sortable)
+            serializer = movie_serializer.project(
+                request.args.get('fields'), ('id', page.sort))
+            query = filter_movies(serializer.query(), request.args)
+        except ValueError:
+            abort(400)
+        if include not in (None, 'cast'):
+            abort(400)
 
-        return jsonify(
-            {
-                'success': True,
-                'movies': movies,
-            })
+        def build():
+            q_movie, next_cursor = paginate(query, Movie.id, page)
+            movies = serializer.format(q_movie)
+            if include == 'cast':
+                cast = linked(actor_serializer, actor_movie.c.Movie,
+                              [row.id for row in q_movie])
+                for movie, row in zip(movies, q_movie):
+                    movie['actors'] = cast[row.id]
 
-    # GET all actors
+            return json_response(
+                {
+                    'success': True,
+                    'movies': movies,
+                    'next_cursor': next_cursor,
+                })
+
+        return cached_json(
+            ('Movie', 'actor_movie', 'Actor') if include else ('Movie',),
+            build)
+
+    # GET a page of actors
     @app.route('/actors')
     @requires_auth('get:actors')
     def actors_retrieve(jwt):
-        q_actors = Actor.query.all()
-        actors = [actor.format() for actor in q_actors]
-        return jsonify(
-            {
-                'success': True,
-                'actors': actors,
-            })
+        include = request.args.get('include')
+        try:
+            page = parse_page(request.args, Actor, Actor.sortable)
+            serializer = actor_serializer.project(
+                request.args.get('fields'), ('id', page.sort))
+            query = filter_actors(serializer.query(), request.args)
+        except ValueError:
+            abort(400)
+        if include not in (None, 'movies'):
+            abort(400)
+
+        def build():
+            q_actors, next_cursor = paginate(query, Actor.id, page)
+            actors = serializer.format(q_actors)
+            if include == 'movies':
+                movies = linked(movie_serializer, actor_movie.c.Actor,
+                                [row.id for row in q_actors])
+                for actor, row in zip(actors, q_actors):
+                    actor['movies'] = movies[row.id]
+            return json_response(
+                {
+                    'success': True,
+                    'actors': actors,
+                    'next_cursor': next_cursor,
+                })
+
+        return cached_json(
+            ('Actor', 'actor_movie', 'Movie') if include else ('Actor',),
+            build)
+
+    # GET the cast of a movie
+    @app.route('/movies/<int:movie_id>/actors')
+    @requires_auth('get:movies & get:actors')
+    def movie_actors_retrieve(jwt, movie_id):
+        try:
+            serializer = actor_serializer.project(request.args.get('fields'))
+        except ValueError:
+            abort(400)
+
+        def build():
+            if not existing_ids(Movie, [movie_id]):
+                abort(404)
+
+            cast = linked(serializer, actor_movie.c.Movie, [movie_id])
+            return json_response(
+                {
+                    'success': True,
+                    'movie_id': movie_id,
+                    'actors': cast[movie_id],
+                })
+
+        return cached_json(('Movie', 'actor_movie', 'Actor'), build)
+
+    # GET the filmography of an actor
+    @app.route('/actors/<int:actor_id>/movies')
+    @requires_auth('get:movies & get:actors')
+    def actor_movies_retrieve(jwt, actor_id):
+        try:
+            serializer = movie_serializer.project(request.args.get('fields'))
+        except ValueError:
+            abort(400)
+
+        def build():
+            if not existing_ids(Actor, [actor_id]):
+                abort(404)
+
+            movies = linked(serializer, actor_movie.c.Actor, [actor_id])
+            return json_response(
+                {
+                    'success': True,
+                    'actor_id': actor_id,
+                    'movies': movies[actor_id],
+                })
+
+        return cached_json(('Actor', 'actor_movie', 'Movie'), build)
+
+    # GET actor counts by gender, age bucket and number of films
+    @app.route('/stats/actors')
+    @requires_auth('get:actors')
+    def actors_stats(jwt):
+        try:
+            bucket = parse_age_bucket(request.args)
+        except ValueError:
+            abort(400)
+
+        def build():
+            return json_response(dict(
+                actor_stats(execute(actor_statements(bucket)), bucket),
+                success=True))
+
+        return cached_json(('Actor', 'actor_movie'), build)
+
+    # GET movie counts by release year and cast size
+    @app.route('/stats/movies')
+    @requires_auth('get:movies')
+    def movies_stats(jwt):
+        def build():
+            return json_response(dict(
+                movie_stats(execute(movie_statements())), success=True))
+
+        return cached_json(('Movie', 'actor_movie'), build)
+
+    # Export all movies as NDJSON
+    @app.route('/movies/export')
+    @requires_auth('get:movies')
+    def movies_export(jwt):
+        try:
+            serializer = movie_serializer.project(request.args.get('fields'))
+            query = filter_movies(serializer.query(), request.args)
+        except ValueError:
+            abort(400)
+        return ndjson_response(serializer, query.order_by(Movie.id))
+
+    # Export all actors as NDJSON
+    @app.route('/actors/export')
+    @requires_auth('get:actors')
+    def actors_export(jwt):
+        try:
+            serializer = actor_serializer.project(request.args.get('fields'))
+            query = filter_actors(serializer.query(), request.args)
+        except ValueError:
+            abort(400)
+        return ndjson_response(serializer, query.order_by(Actor.id))
 
     # Create a new movie
     @app.route('/movies', methods=['POST'])
@@ -79,6 +443,21 @@ def create_app(test_config=None):
         except KeyError:
             abort(422)
 
+    # Create a batch of movies
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def movies_bulk_create(jwt):
+        rows, errors = validate_movies(bulk_items())
+        if errors:
+            return bulk_errors_response(errors)
+
+        movie_ids = bulk_insert(Movie, rows)
+        return jsonify(
+            {
+                'success': True,
+                'movie_ids': movie_ids,
+            })
+
     # Create a new actor
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
@@ -115,46 +494,76 @@ def create_app(test_config=None):
         except KeyError:
             abort(422)
 
-    # Create a movie_actor relation
+    # Create a batch of actors
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def actors_bulk_create(jwt):
+        rows, errors = validate_actors(bulk_items())
+        if errors:
+            return bulk_errors_response(errors)
+
+        actor_ids = bulk_insert(Actor, rows)
+        return jsonify(
+            {
+                'success': True,
+                'actor_ids': actor_ids,
+            })
+
+    # Add or remove movie_actor relations
     @app.route('/movies/actors', methods=['POST'])
     @requires_auth('post:movies_actors')
     def movie_actor_create(jwt):
+        body = request.get_json(silent=True)
+        single = isinstance(body, dict) and 'links' not in body
+        if single:
+            links, mode = [body], 'add'
+        elif isinstance(body, dict):
+            links, mode = body.get('links'), body.get('mode', 'add')
+        else:
+            links, mode = body, 'add'
 
-        # if body exists
-        try:
-            body = request.get_json()
-            actor_id = body.get('actor_id', None)
-            movie_id = body.get('movie_id', None)
-        except KeyError:
-            abort(422)
-
-        # check if missing some required data
-        if any(parameter is None for parameter in [actor_id, movie_id]):
+        if mode not in ('add', 'remove') or not isinstance(links, list) \
+                or not 0 < len(links) <= BULK_MAX_ITEMS:
             abort(400)
 
-        # check if movie exists
-        movie = Movie.query.get(movie_id)
-        if not movie:
-            abort(404)
-        # check if actor exist
-        actor = Actor.query.get(actor_id)
-        if not actor:
+        # check if missing some required data
+        pairs = set()
+        for link in links:
+            if not isinstance(link, dict):
+                abort(400)
+            movie_id = parse_int(link.get('movie_id'))
+            actor_id = parse_int(link.get('actor_id'))
+            if any(parameter is None for parameter in [actor_id, movie_id]):
+                abort(400)
+            pairs.add((movie_id, actor_id))
+
+        # check if movies and actors exist, one query per table
+        movie_ids = {movie_id for movie_id, _ in pairs}
+        actor_ids = {actor_id for _, actor_id in pairs}
+        if existing_ids(Movie, movie_ids) != movie_ids or \
+                existing_ids(Actor, actor_ids) != actor_ids:
             abort(404)
 
-        try:
-            # add actor to movie
-            movie.actor_movie = [actor]
-            movie.update()
+        if mode == 'add':
+            changed = add_links(pairs)
+        else:
+            changed = remove_links(pairs)
 
+        if single:
+            movie_id, actor_id = next(iter(pairs))
             return jsonify(
                 {
                     'success': True,
                     'actor_id': actor_id,
                     'movie_id': movie_id
                 })
-
-        except KeyError:
-            abort(422)
+        return jsonify(
+            {
+                'success': True,
+                'mode': mode,
+                'links': len(pairs),
+                'changed': changed,
+            })
 
     # Update movie by ID
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
@@ -168,27 +577,24 @@ def create_app(test_config=None):
         else:
             abort(422)
 
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-        if movie is None:
-            abort(404)
-
         try:
             # check parameter to update
+            values = {}
             if movie_title is not None:
-                movie.title = movie_title
+                values['title'] = movie_title
             if movie_release_date is not None:
-                movie_release_date = datetime.strptime(
-                    movie_release_date, "%Y-%m-%d")
-                movie.release_date = movie_release_date
+                values['release_date'] = datetime.strptime(
+                    movie_release_date, "%Y-%m-%d").date()
+        except (TypeError, ValueError):
+            abort(422)
 
-            movie.update()
-            return jsonify({
-                'success': True,
-                'movie_id': movie_id,
-            })
+        if not update_row(Movie, movie_id, values):
+            abort(404)
 
-        except KeyError:
-            abort(422)
+        return jsonify({
+            'success': True,
+            'movie_id': movie_id,
+        })
 
     # Update actor by ID
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
@@ -203,64 +609,46 @@ def create_app(test_config=None):
         else:
             abort(422)
 
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-        if actor is None:
-            abort(404)
-
-        try:
-            # check parameter to update
-            if actor_name is not None:
-                actor.name = actor_name
-            if actor_age is not None:
-                actor.age = actor_age
-            if actor_gender is not None:
-                actor.gender = actor_gender
+        # check parameter to update
+        values = {}
+        if actor_name is not None:
+            values['name'] = actor_name
+        if actor_age is not None:
+            values['age'] = actor_age
+        if actor_gender is not None:
+            values['gender'] = actor_gender
 
-            actor.update()
-
-            return jsonify({
-                'success': True,
-                'actor_id': actor_id,
-            })
+        if not update_row(Actor, actor_id, values):
+            abort(404)
 
-        except KeyError:
-            abort(422)
+        return jsonify({
+            'success': True,
+            'actor_id': actor_id,
+        })
 
     # Delete movie by ID
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movies')
     def movies_delete(jwt, movie_id):
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-        if movie is None:
+        if not delete_row(Movie, movie_id):
             abort(404)
 
-        try:
-            movie.delete()
-            return jsonify({
-                'success': True,
-                'movie_id': movie_id,
-            })
-
-        except KeyError:
-            abort(422)
+        return jsonify({
+            'success': True,
+            'movie_id': movie_id,
+        })
 
     # Delete actor by ID
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
     def actors_delete(jwt, actor_id):
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-        if actor is None:
+        if not delete_row(Actor, actor_id):
             abort(404)
 
-        try:
-            actor.delete()
-            return jsonify({
-                'success': True,
-                'actor_id': actor_id,
-            })
-
-        except KeyError:
-            abort(422)
+        return jsonify({
+            'success': True,
+            'actor_id': actor_id,
+        })
 
     # Error Handling
     @app.errorhandler(400)
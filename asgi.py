@@ -0,0 +1,836 @@
+import asyncio
+import json
+import logging
+import time
+import weakref
+from functools import wraps
+
+import httpx
+from databases import Database, DatabaseURL
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Query
+from sqlalchemy.util import KeyedTuple
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.http import parse_etags
+
+from auth import (JWKS_CACHE_TTL, JWKS_MIN_REFETCH_INTERVAL, JWKS_URL,
+                  AuthError, JWKSStore, check_permissions,
+                  compile_permission, decode_jwt, parse_auth_header,
+                  token_cache, token_kid)
+from cache import make_etag, response_cache
+from filters import filter_actors, filter_movies
+from models import (BULK_INSERT_CHUNK, Actor, Movie, TableVersion,
+                    actor_movie, database_path, link_count_updates,
+                    links_clause, links_delete, row_lock, unlinked_counts,
+                    version_listeners)
+from pagination import page_query, page_rows, parse_page
+from serializers import actor_serializer, dumps, movie_serializer
+from stats import (actor_stats, actor_statements, movie_stats,
+                   movie_statements, parse_age_bucket)
+from validation import (BULK_MAX_ITEMS, parse_dates, parse_int,
+                        validate_actors, validate_movies)
+
+'''
+    Async ASGI application
+    Same routes, permissions and JSON bodies as create_app in app.py,
+    served by an event loop so a single process holds many requests
+    waiting on the database or the JWKS endpoint. Queries are the
+    SQLAlchemy statements of the Flask app run with the databases
+    package (asyncpg on Postgres, aiosqlite on SQLite).
+
+    uvicorn asgi:app
+'''
+
+logger = logging.getLogger(__name__)
+
+if response_cache.invalidate not in version_listeners:
+    version_listeners.append(response_cache.invalidate)
+
+ERROR_MESSAGES = {
+    400: 'Bad request',
+    401: 'Unauthorized',
+    403: 'Forbidden',
+    404: 'Resource not found',
+    405: 'Method not allowed',
+    422: 'Unprocessable entity',
+    500: 'Internal server error',
+}
+
+
+'''
+    JWKS key store fetching on the event loop
+'''
+
+
+async def fetch_jwks_async(url=JWKS_URL, timeout=5):
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        response = await client.get(url)
+        response.raise_for_status()
+        return response.json()
+
+
+class AsyncJWKSStore(JWKSStore):
+    '''
+        JWKSStore whose fetcher is a coroutine function. There is no
+        background thread: the first request seeing a stale key set or
+        an unknown kid fetches it and the concurrent ones wait for that
+        single fetch.
+    '''
+
+    def __init__(self, fetcher=fetch_jwks_async, ttl=JWKS_CACHE_TTL,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL):
+        super().__init__(fetcher, ttl, min_refetch_interval,
+                         background=False)
+        self._fetch_locks = weakref.WeakKeyDictionary()
+
+    def _lock_for_loop(self):
+        # asyncio locks belong to the loop they are created in, keep one
+        # per loop using the store
+        loop = asyncio.get_event_loop()
+        lock = self._fetch_locks.get(loop)
+        if lock is None:
+            lock = self._fetch_locks[loop] = asyncio.Lock()
+        return lock
+
+    async def refresh(self):
+        async with self._lock_for_loop():
+            return await self._refresh_async()
+
+    async def _refresh_async(self):
+        self._attempted_at = time.monotonic()
+        try:
+            keys = self._parse_keys(await self.fetcher())
+        except Exception:
+            logger.warning('JWKS fetch failed, serving cached keys',
+                           exc_info=True)
+            return False
+
+        self._replace_keys(keys)
+        return True
+
+    def _needs_fetch(self, kid):
+        return self.is_stale() or kid not in self._keys
+
+    async def get_key(self, kid):
+        if self._needs_fetch(kid):
+            async with self._lock_for_loop():
+                # another request may have fetched while we waited
+                if self._needs_fetch(kid) and self._may_refetch():
+                    await self._refresh_async()
+        return self._keys.get(kid)
+
+
+jwks_store = AsyncJWKSStore()
+
+
+def requires_auth(permission=''):
+    '''
+        Same checks as auth.requires_auth, the decorated endpoint is
+        called with the request and the decoded payload
+    '''
+    permission = compile_permission(permission)
+
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(request):
+            token = parse_auth_header(request.headers.get('Authorization'))
+            payload = token_cache.get(token)
+            if payload is None:
+                try:
+                    rsa_key = await jwks_store.get_key(token_kid(token))
+                    payload = decode_jwt(token, rsa_key)
+                except KeyError:
+                    raise HTTPException(401)
+                token_cache.set(token, payload)
+            check_permissions(permission, payload)
+            return await f(request, payload)
+
+        return wrapper
+    return requires_auth_decorator
+
+
+'''
+    Responses
+'''
+
+
+def json_response(data, status_code=200):
+    # the bytes Flask jsonify produces, clients see no difference
+    return Response(dumps(data), status_code=status_code,
+                    media_type='application/json')
+
+
+def rows(records):
+    '''Records as the keyed tuples the serializers and pagination accept'''
+    return [KeyedTuple(record.values(), record.keys()) for record in records]
+
+
+def path_id(request, name):
+    return request.path_params[name]
+
+
+async def json_body(request):
+    '''The decoded JSON body, None when it is missing or malformed'''
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def is_postgres_url(url):
+    '''
+        Whether a databases URL is a Postgres one, databases reports the
+        postgres:// scheme of Heroku as the 'postgres' dialect
+    '''
+    return DatabaseURL(url).dialect in ('postgres', 'postgresql')
+
+
+def create_asgi_app(database_url=database_path):
+    database = Database(database_url)
+    is_postgres = is_postgres_url(database.url)
+
+    # Table versions and the response cache
+    async def get_versions(tables):
+        versions = dict.fromkeys(tables, 0)
+        for record in await database.fetch_all(
+                select([TableVersion.name, TableVersion.version]).where(
+                    TableVersion.name.in_(tables))):
+            versions[record['name']] = record['version']
+        return versions
+
+    async def bump_versions(*tables):
+        await database.execute(
+            TableVersion.__table__.update().where(
+                TableVersion.name.in_(tables)).values(
+                version=TableVersion.version + 1))
+
+    def notify_version_listeners(tables):
+        for listener in version_listeners:
+            listener(set(tables))
+
+    async def cached_json(request, tables, build):
+        '''
+            Serve the GET request from the ETag check, then from the
+            response cache, and only await build() when neither has it
+        '''
+        etag = make_etag(request.url.path,
+                         request.query_params.multi_items(),
+                         await get_versions(tables))
+        headers = {'ETag': '"{}"'.format(etag),
+                   'Cache-Control': 'private, no-cache'}
+        if parse_etags(request.headers.get('If-None-Match')).contains_weak(
+                etag):
+            return Response(status_code=304, headers=headers)
+
+        body = response_cache.get(etag)
+        if body is None:
+            response = await build()
+            if response.status_code == 200:
+                response_cache.set(etag, response.body, tables)
+        else:
+            response = Response(body, media_type='application/json')
+        response.headers.update(headers)
+        return response
+
+    # Writes: one transaction per request, the versions of the written
+    # tables are bumped in it and the listeners notified after the commit
+    async def insert_row(table, values):
+        if is_postgres:
+            return await database.execute(
+                table.insert().values(values).returning(table.c.id))
+        return await database.execute(table.insert().values(values))
+
+    async def insert_rows(model, values):
+        table = model.__table__
+        ids = []
+        async with database.transaction():
+            if is_postgres:
+                for start in range(0, len(values), BULK_INSERT_CHUNK):
+                    chunk = values[start:start + BULK_INSERT_CHUNK]
+                    ids.extend(record[0] for record in
+                               await database.fetch_all(
+                                   table.insert().values(chunk).returning(
+                                       table.c.id)))
+            else:
+                for row in values:
+                    ids.append(await insert_row(table, row))
+            await bump_versions(table.name)
+        notify_version_listeners([table.name])
+        return ids
+
+    async def row_exists(model, row_id):
+        return await database.fetch_val(
+            select([model.id]).where(model.id == row_id)) is not None
+
+    async def update_row(model, row_id, values):
+        table = model.__table__
+        async with database.transaction():
+            if not await row_exists(model, row_id):
+                return False
+            if values:
+                await database.execute(table.update().where(
+                    table.c.id == row_id).values(**values))
+                await bump_versions(table.name)
+        if values:
+            notify_version_listeners([table.name])
+        return True
+
+    async def delete_row(model, row_id):
+        table = model.__table__
+        async with database.transaction():
+            if is_postgres:
+                # the row is locked and its links deleted with RETURNING,
+                # a concurrent delete decrements the counts once
+                if await database.fetch_val(
+                        row_lock(model, row_id)) is None:
+                    return False
+                linked_ids = [record[0] for record in
+                              await database.fetch_all(
+                                  links_delete(model, row_id))]
+                if linked_ids:
+                    await database.execute(
+                        unlinked_counts(model, row_id, linked_ids))
+            elif not await row_exists(model, row_id):
+                return False
+            else:
+                await database.execute(unlinked_counts(model, row_id))
+                # the foreign keys pragma cannot be turned on inside the
+                # transaction, remove the links the cascade would remove
+                column = actor_movie.c[table.name]
+                await database.execute(
+                    actor_movie.delete().where(column == row_id))
+            await database.execute(
+                table.delete().where(table.c.id == row_id))
+            await bump_versions('Movie', 'Actor', 'actor_movie')
+        notify_version_listeners(['Movie', 'Actor', 'actor_movie'])
+        return True
+
+    async def existing_ids(model, ids):
+        return {record['id'] for record in await database.fetch_all(
+            select([model.id]).where(model.id.in_(ids)))}
+
+    async def existing_links(pairs):
+        return {(record['Movie'], record['Actor'])
+                for record in await database.fetch_all(
+                    select([actor_movie.c.Movie, actor_movie.c.Actor]).where(
+                        links_clause(pairs)))}
+
+    async def change_links(pairs, mode):
+        '''Add or remove the (movie, actor) links, return how many changed'''
+        pairs = list(dict.fromkeys(pairs))
+        changed = []
+        link_columns = (actor_movie.c.Movie, actor_movie.c.Actor)
+        async with database.transaction():
+            for start in range(0, len(pairs), BULK_INSERT_CHUNK):
+                chunk = pairs[start:start + BULK_INSERT_CHUNK]
+                if is_postgres:
+                    # RETURNING gives the rows this transaction changed,
+                    # a concurrent request changing the same pairs does
+                    # not count them twice
+                    if mode == 'add':
+                        statement = postgresql.insert(actor_movie).values([
+                            {'Movie': movie_id, 'Actor': actor_id}
+                            for movie_id, actor_id in chunk]
+                        ).on_conflict_do_nothing()
+                    else:
+                        statement = actor_movie.delete().where(
+                            links_clause(chunk))
+                    changed.extend(
+                        (record['Movie'], record['Actor'])
+                        for record in await database.fetch_all(
+                            statement.returning(*link_columns)))
+                    continue
+                existing = await existing_links(chunk)
+                if mode == 'add':
+                    chunk = [pair for pair in chunk if pair not in existing]
+                    if chunk:
+                        await database.execute(actor_movie.insert().values([
+                            {'Movie': movie_id, 'Actor': actor_id}
+                            for movie_id, actor_id in chunk]))
+                elif existing:
+                    chunk = list(existing)
+                    await database.execute(
+                        actor_movie.delete().where(links_clause(chunk)))
+                else:
+                    chunk = []
+                changed.extend(chunk)
+            for statement in link_count_updates(
+                    changed, 1 if mode == 'add' else -1):
+                await database.execute(statement)
+            if changed:
+                await bump_versions('Movie', 'Actor', 'actor_movie')
+        if changed:
+            notify_version_listeners(['Movie', 'Actor', 'actor_movie'])
+        return len(changed)
+
+    # Reads
+    async def fetch_page(model, query, page):
+        records = await database.fetch_all(
+            page_query(query, model.id, page).statement)
+        return page_rows(rows(records), page)
+
+    async def linked(serializer, link_column, ids):
+        '''{id: [items of serializer]} linked to ids through actor_movie'''
+        model = serializer.model
+        query = select([link_column] + list(serializer.columns)).select_from(
+            model.__table__.join(
+                actor_movie, actor_movie.c[model.__tablename__] == model.id)
+        ).where(link_column.in_(ids)).order_by(model.id)
+        result = {row_id: [] for row_id in ids}
+        records = [tuple(record.values())
+                   for record in await database.fetch_all(query)]
+        items = serializer.format([record[1:] for record in records])
+        for record, item in zip(records, items):
+            result[record[0]].append(item)
+        return result
+
+    async def execute(statements):
+        '''{name: rows as tuples} of the statements'''
+        return {name: [tuple(record.values()) for record in
+                       await database.fetch_all(statement)]
+                for name, statement in statements.items()}
+
+    async def ndjson_rows(serializer, query):
+        async for record in database.iterate(query.order_by(
+                serializer.model.id).statement):
+            yield json.dumps(
+                serializer.format([tuple(record.values())])[0]) + '\n'
+
+    # GET a page of movies
+    @requires_auth('get:movies')
+    async def movies_retrieve(request, jwt):
+        args = request.query_params
+        include = args.get('include')
+        try:
+            page = parse_page(args, Movie, Movie.sortable)
+            serializer = movie_serializer.project(
+                args.get('fields'), ('id', page.sort))
+            query = filter_movies(Query(serializer.columns), args)
+        except ValueError:
+            raise HTTPException(400)
+        if include not in (None, 'cast'):
+            raise HTTPException(400)
+
+        async def build():
+            q_movie, next_cursor = await fetch_page(Movie, query, page)
+            movies = serializer.format(q_movie)
+            if include == 'cast':
+                cast = await linked(actor_serializer, actor_movie.c.Movie,
+                                    [row.id for row in q_movie])
+                for movie, row in zip(movies, q_movie):
+                    movie['actors'] = cast[row.id]
+            return json_response(
+                {
+                    'success': True,
+                    'movies': movies,
+                    'next_cursor': next_cursor,
+                })
+
+        return await cached_json(
+            request,
+            ('Movie', 'actor_movie', 'Actor') if include else ('Movie',),
+            build)
+
+    # GET a page of actors
+    @requires_auth('get:actors')
+    async def actors_retrieve(request, jwt):
+        args = request.query_params
+        include = args.get('include')
+        try:
+            page = parse_page(args, Actor, Actor.sortable)
+            serializer = actor_serializer.project(
+                args.get('fields'), ('id', page.sort))
+            query = filter_actors(Query(serializer.columns), args)
+        except ValueError:
+            raise HTTPException(400)
+        if include not in (None, 'movies'):
+            raise HTTPException(400)
+
+        async def build():
+            q_actors, next_cursor = await fetch_page(Actor, query, page)
+            actors = serializer.format(q_actors)
+            if include == 'movies':
+                movies = await linked(movie_serializer, actor_movie.c.Actor,
+                                      [row.id for row in q_actors])
+                for actor, row in zip(actors, q_actors):
+                    actor['movies'] = movies[row.id]
+            return json_response(
+                {
+                    'success': True,
+                    'actors': actors,
+                    'next_cursor': next_cursor,
+                })
+
+        return await cached_json(
+            request,
+            ('Actor', 'actor_movie', 'Movie') if include else ('Actor',),
+            build)
+
+    # GET the cast of a movie
+    @requires_auth('get:movies & get:actors')
+    async def movie_actors_retrieve(request, jwt):
+        movie_id = path_id(request, 'movie_id')
+        try:
+            serializer = actor_serializer.project(
+                request.query_params.get('fields'))
+        except ValueError:
+            raise HTTPException(400)
+
+        async def build():
+            if not await row_exists(Movie, movie_id):
+                raise HTTPException(404)
+            cast = await linked(serializer, actor_movie.c.Movie, [movie_id])
+            return json_response(
+                {
+                    'success': True,
+                    'movie_id': movie_id,
+                    'actors': cast[movie_id],
+                })
+
+        return await cached_json(
+            request, ('Movie', 'actor_movie', 'Actor'), build)
+
+    # GET the filmography of an actor
+    @requires_auth('get:movies & get:actors')
+    async def actor_movies_retrieve(request, jwt):
+        actor_id = path_id(request, 'actor_id')
+        try:
+            serializer = movie_serializer.project(
+                request.query_params.get('fields'))
+        except ValueError:
+            raise HTTPException(400)
+
+        async def build():
+            if not await row_exists(Actor, actor_id):
+                raise HTTPException(404)
+            movies = await linked(serializer, actor_movie.c.Actor,
+                                  [actor_id])
+            return json_response(
+                {
+                    'success': True,
+                    'actor_id': actor_id,
+                    'movies': movies[actor_id],
+                })
+
+        return await cached_json(
+            request, ('Actor', 'actor_movie', 'Movie'), build)
+
+    # GET actor counts by gender, age bucket and number of films
+    @requires_auth('get:actors')
+    async def actors_stats(request, jwt):
+        try:
+            bucket = parse_age_bucket(request.query_params)
+        except ValueError:
+            raise HTTPException(400)
+
+        async def build():
+            return json_response(dict(actor_stats(
+                await execute(actor_statements(bucket)), bucket),
+                success=True))
+
+        return await cached_json(request, ('Actor', 'actor_movie'), build)
+
+    # GET movie counts by release year and cast size
+    @requires_auth('get:movies')
+    async def movies_stats(request, jwt):
+        async def build():
+            return json_response(dict(movie_stats(
+                await execute(movie_statements())), success=True))
+
+        return await cached_json(request, ('Movie', 'actor_movie'), build)
+
+    # Export all movies as NDJSON
+    @requires_auth('get:movies')
+    async def movies_export(request, jwt):
+        args = request.query_params
+        try:
+            serializer = movie_serializer.project(args.get('fields'))
+            query = filter_movies(Query(serializer.columns), args)
+        except ValueError:
+            raise HTTPException(400)
+        return StreamingResponse(ndjson_rows(serializer, query),
+                                 media_type='application/x-ndjson')
+
+    # Export all actors as NDJSON
+    @requires_auth('get:actors')
+    async def actors_export(request, jwt):
+        args = request.query_params
+        try:
+            serializer = actor_serializer.project(args.get('fields'))
+            query = filter_actors(Query(serializer.columns), args)
+        except ValueError:
+            raise HTTPException(400)
+        return StreamingResponse(ndjson_rows(serializer, query),
+                                 media_type='application/x-ndjson')
+
+    # Create a new movie
+    @requires_auth('post:movies')
+    async def movies_create(request, jwt):
+        body = await json_body(request)
+        if not isinstance(body, dict) or body.get('title') is None or \
+                body.get('release_date') is None:
+            raise HTTPException(400)
+        values, errors = validate_movies([body])
+        if errors:
+            raise HTTPException(422)
+
+        async with database.transaction():
+            movie_id = await insert_row(Movie.__table__, values[0])
+            await bump_versions('Movie')
+        notify_version_listeners(['Movie'])
+        return json_response(
+            {
+                'success': True,
+                'movie_id': movie_id,
+            })
+
+    # Create a new actor
+    @requires_auth('post:actors')
+    async def actors_create(request, jwt):
+        body = await json_body(request)
+        if not isinstance(body, dict) or any(
+                body.get(name) is None for name in ('name', 'gender', 'age')):
+            raise HTTPException(400)
+
+        async with database.transaction():
+            actor_id = await insert_row(Actor.__table__, {
+                'name': body['name'],
+                'age': body['age'],
+                'gender': body['gender'],
+            })
+            await bump_versions('Actor')
+        notify_version_listeners(['Actor'])
+        return json_response(
+            {
+                'success': True,
+                'actor_id': actor_id,
+            })
+
+    async def bulk_items(request):
+        items = await json_body(request)
+        if not isinstance(items, list) or \
+                not 0 < len(items) <= BULK_MAX_ITEMS:
+            raise HTTPException(400)
+        return items
+
+    def bulk_errors_response(errors):
+        return json_response(
+            {
+                'success': False,
+                'error': 422,
+                'message': ERROR_MESSAGES[422],
+                'errors': errors,
+            }, 422)
+
+    # Create a batch of movies
+    @requires_auth('post:movies')
+    async def movies_bulk_create(request, jwt):
+        values, errors = validate_movies(await bulk_items(request))
+        if errors:
+            return bulk_errors_response(errors)
+        return json_response(
+            {
+                'success': True,
+                'movie_ids': await insert_rows(Movie, values),
+            })
+
+    # Create a batch of actors
+    @requires_auth('post:actors')
+    async def actors_bulk_create(request, jwt):
+        values, errors = validate_actors(await bulk_items(request))
+        if errors:
+            return bulk_errors_response(errors)
+        return json_response(
+            {
+                'success': True,
+                'actor_ids': await insert_rows(Actor, values),
+            })
+
+    # Add or remove movie_actor relations
+    @requires_auth('post:movies_actors')
+    async def movie_actor_create(request, jwt):
+        body = await json_body(request)
+        single = isinstance(body, dict) and 'links' not in body
+        if single:
+            links, mode = [body], 'add'
+        elif isinstance(body, dict):
+            links, mode = body.get('links'), body.get('mode', 'add')
+        else:
+            links, mode = body, 'add'
+
+        if mode not in ('add', 'remove') or not isinstance(links, list) \
+                or not 0 < len(links) <= BULK_MAX_ITEMS:
+            raise HTTPException(400)
+
+        pairs = set()
+        for link in links:
+            if not isinstance(link, dict):
+                raise HTTPException(400)
+            movie_id = parse_int(link.get('movie_id'))
+            actor_id = parse_int(link.get('actor_id'))
+            if movie_id is None or actor_id is None:
+                raise HTTPException(400)
+            pairs.add((movie_id, actor_id))
+
+        movie_ids = {movie_id for movie_id, _ in pairs}
+        actor_ids = {actor_id for _, actor_id in pairs}
+        if await existing_ids(Movie, movie_ids) != movie_ids or \
+                await existing_ids(Actor, actor_ids) != actor_ids:
+            raise HTTPException(404)
+
+        changed = await change_links(pairs, mode)
+        if single:
+            movie_id, actor_id = next(iter(pairs))
+            return json_response(
+                {
+                    'success': True,
+                    'actor_id': actor_id,
+                    'movie_id': movie_id
+                })
+        return json_response(
+            {
+                'success': True,
+                'mode': mode,
+                'links': len(pairs),
+                'changed': changed,
+            })
+
+    # Update movie by ID
+    @requires_auth('patch:movies')
+    async def movie_patch(request, jwt):
+        movie_id = path_id(request, 'movie_id')
+        body = await json_body(request)
+        if not body or not isinstance(body, dict):
+            raise HTTPException(422)
+
+        values = {}
+        if body.get('title') is not None:
+            values['title'] = body['title']
+        if body.get('release_date') is not None:
+            values['release_date'] = parse_dates([body['release_date']])[0]
+            if values['release_date'] is None:
+                raise HTTPException(422)
+
+        if not await update_row(Movie, movie_id, values):
+            raise HTTPException(404)
+        return json_response({
+            'success': True,
+            'movie_id': movie_id,
+        })
+
+    # Update actor by ID
+    @requires_auth('patch:actors')
+    async def actor_patch(request, jwt):
+        actor_id = path_id(request, 'actor_id')
+        body = await json_body(request)
+        if not body or not isinstance(body, dict):
+            raise HTTPException(422)
+
+        values = {name: body[name] for name in ('name', 'age', 'gender')
+                  if body.get(name) is not None}
+        if not await update_row(Actor, actor_id, values):
+            raise HTTPException(404)
+        return json_response({
+            'success': True,
+            'actor_id': actor_id,
+        })
+
+    # Delete movie by ID
+    @requires_auth('delete:movies')
+    async def movies_delete(request, jwt):
+        movie_id = path_id(request, 'movie_id')
+        if not await delete_row(Movie, movie_id):
+            raise HTTPException(404)
+        return json_response({
+            'success': True,
+            'movie_id': movie_id,
+        })
+
+    # Delete actor by ID
+    @requires_auth('delete:actors')
+    async def actors_delete(request, jwt):
+        actor_id = path_id(request, 'actor_id')
+        if not await delete_row(Actor, actor_id):
+            raise HTTPException(404)
+        return json_response({
+            'success': True,
+            'actor_id': actor_id,
+        })
+
+    # Error Handling
+    async def http_error(request, error):
+        status_code = error.status_code
+        if status_code not in ERROR_MESSAGES:
+            status_code = 500
+        return json_response(
+            {
+                "success": False,
+                "error": status_code,
+                "message": ERROR_MESSAGES[status_code]
+            }, status_code)
+
+    async def server_error(request, error):
+        return json_response(
+            {
+                "success": False,
+                "error": 500,
+                "message": ERROR_MESSAGES[500]
+            }, 500)
+
+    # AuthError error handler
+    async def authentification_failed(request, error):
+        return json_response({
+            "success": False,
+            "error": error.status_code,
+            "message": error.error
+        }, 401)
+
+    routes = [
+        Route('/movies', movies_retrieve, methods=['GET']),
+        Route('/movies', movies_create, methods=['POST']),
+        Route('/movies/bulk', movies_bulk_create, methods=['POST']),
+        Route('/movies/export', movies_export, methods=['GET']),
+        Route('/movies/actors', movie_actor_create, methods=['POST']),
+        Route('/movies/{movie_id:int}/actors', movie_actors_retrieve,
+              methods=['GET']),
+        Route('/movies/{movie_id:int}', movie_patch, methods=['PATCH']),
+        Route('/movies/{movie_id:int}', movies_delete, methods=['DELETE']),
+        Route('/actors', actors_retrieve, methods=['GET']),
+        Route('/actors', actors_create, methods=['POST']),
+        Route('/actors/bulk', actors_bulk_create, methods=['POST']),
+        Route('/actors/export', actors_export, methods=['GET']),
+        Route('/actors/{actor_id:int}/movies', actor_movies_retrieve,
+              methods=['GET']),
+        Route('/actors/{actor_id:int}', actor_patch, methods=['PATCH']),
+        Route('/actors/{actor_id:int}', actors_delete, methods=['DELETE']),
+        Route('/stats/actors', actors_stats, methods=['GET']),
+        Route('/stats/movies', movies_stats, methods=['GET']),
+    ]
+
+    app = Starlette(
+        routes=routes,
+        middleware=[Middleware(CORSMiddleware, allow_origins=['*'],
+                               allow_methods=['GET', 'POST', 'PATCH',
+                                              'DELETE', 'OPTIONS'],
+                               allow_headers=['Content-Type',
+                                              'Authorization'],
+                               expose_headers=['ETag'])],
+        exception_handlers={
+            HTTPException: http_error,
+            AuthError: authentification_failed,
+            500: server_error,
+        },
+        on_startup=[database.connect],
+        on_shutdown=[database.disconnect],
+    )
+    app.state.database = database
+    return app
+
+
+app = create_asgi_app()
@@ -1,14 +1,31 @@
+import hashlib
 import json
-from flask import request, _request_ctx_stack
+import logging
+import threading
+import time
+from collections import OrderedDict
+from flask import request, abort, _request_ctx_stack
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
+from metrics import span
 import os
 
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'casting-agency'
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+# seconds a fetched key set is considered fresh
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+# minimum seconds between two fetches triggered by unknown kids or failures
+JWKS_MIN_REFETCH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFETCH_INTERVAL', 30))
+# maximum number of verified tokens kept per worker
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
+logger = logging.getLogger(__name__)
 
 
 # AuthError Exception
@@ -28,10 +45,9 @@ class AuthError(Exception):
 '''
 
 
-def get_token_auth_header():
-    """Obtains the Access Token from the Authorization Header
+def parse_auth_header(auth):
+    """Returns the token of an Authorization header value
     """
-    auth = request.headers.get('Authorization', None)
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -61,6 +77,139 @@ def get_token_auth_header():
     return token
 
 
+def get_token_auth_header():
+    """Obtains the Access Token from the Authorization Header
+    """
+    with span('auth_header'):
+        return parse_auth_header(request.headers.get('Authorization', None))
+
+
+'''
+    Permission compilation
+    Every scope gets one bit, a permission requirement is compiled once
+    into a list of bitmasks (OR of AND-ed scopes) so checking a request
+    is a couple of integer operations
+'''
+
+KNOWN_PERMISSIONS = (
+    'get:movies',
+    'get:actors',
+    'post:movies',
+    'post:actors',
+    'post:movies_actors',
+    'patch:movies',
+    'patch:actors',
+    'delete:movies',
+    'delete:actors',
+)
+
+_permission_bits = {
+    permission: 1 << bit for bit, permission in enumerate(KNOWN_PERMISSIONS)}
+_permission_bits_lock = threading.Lock()
+
+
+def permission_bit(permission):
+    bit = _permission_bits.get(permission)
+    if bit is None:
+        with _permission_bits_lock:
+            bit = _permission_bits.setdefault(
+                permission, 1 << len(_permission_bits))
+    return bit
+
+
+def permission_mask(permissions):
+    '''
+        Bitmask of the granted permissions, scopes no requirement was
+        compiled for cannot satisfy any check and are skipped
+    '''
+    mask = 0
+    for permission in permissions:
+        mask |= _permission_bits.get(permission, 0)
+    return mask
+
+
+class Permission:
+    '''
+        Compiled permission requirement.
+        'a & b' requires both scopes, 'a | b' requires either of them and
+        & binds tighter than |. An empty requirement only needs a valid
+        token.
+    '''
+    __slots__ = ('spec', 'clauses')
+
+    def __init__(self, spec):
+        self.spec = spec
+        clauses = []
+        for alternative in spec.split('|'):
+            scopes = [scope.strip() for scope in alternative.split('&')]
+            if any(not scope for scope in scopes):
+                if spec.strip():
+                    raise ValueError(f'Invalid permission: {spec!r}')
+                scopes = []
+            clause = 0
+            for scope in scopes:
+                clause |= permission_bit(scope)
+            clauses.append(clause)
+        self.clauses = tuple(clauses)
+
+    def allows(self, mask):
+        for clause in self.clauses:
+            if mask & clause == clause:
+                return True
+        return False
+
+    def __repr__(self):
+        return f'Permission({self.spec!r})'
+
+
+_compiled_permissions = {}
+
+
+def compile_permission(permission):
+    if isinstance(permission, Permission):
+        return permission
+    compiled = _compiled_permissions.get(permission)
+    if compiled is None:
+        compiled = _compiled_permissions.setdefault(
+            permission, Permission(permission))
+    return compiled
+
+
+def all_of(*permissions):
+    return compile_permission(' & '.join(permissions))
+
+
+def any_of(*permissions):
+    return compile_permission(' | '.join(permissions))
+
+
+class VerifiedPayload(dict):
+    '''
+        Decoded JWT payload carrying the bitmask of its permissions claim,
+        computed once when the token is verified
+    '''
+
+    def __init__(self, payload):
+        super().__init__(payload)
+        self._mask_generation = -1
+        self._permission_mask = None
+
+    @property
+    def permission_mask(self):
+        # requirements compiled after the mask was built may add scopes
+        generation = len(_permission_bits)
+        if self._mask_generation != generation:
+            permissions = self.get('permissions')
+            mask = (None if permissions is None
+                    else permission_mask(permissions))
+            # cached payloads are shared between threads, a matching
+            # generation must never be seen before its mask
+            self._permission_mask = mask
+            self._mask_generation = generation
+            return mask
+        return self._permission_mask
+
+
 '''
     check_permissions(permission, payload) method
     Raise an AuthError if permissions are not included in the payload
@@ -74,7 +223,12 @@ def check_permissions(permission, payload):
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    permission = compile_permission(permission)
+    if isinstance(payload, VerifiedPayload):
+        mask = payload.permission_mask
+    else:
+        mask = permission_mask(payload['permissions'])
+    if not permission.allows(mask):
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -83,31 +237,160 @@ def check_permissions(permission, payload):
 
 
 '''
-    Verify the token using Auth0 /.well-known/jwks.json
+    JWKS key store
+    Keep the Auth0 /.well-known/jwks.json keys in memory indexed by kid
+    so the key set is not fetched on every request
+'''
+
+
+def fetch_jwks(url=JWKS_URL, timeout=5):
+    jsonurl = urlopen(url, timeout=timeout)
+    return json.loads(jsonurl.read())
+
+
+class JWKSStore:
+    '''
+        In-process cache of the signing keys indexed by kid.
+        The key set is refreshed by a background thread when the ttl
+        elapses, an unknown kid triggers one re-fetch to pick up rotated
+        keys and the last known keys keep being served while the
+        fetcher fails. The fetcher is any callable returning the JWKS
+        document, tests can pass a local stand-in.
+    '''
+
+    def __init__(self, fetcher=fetch_jwks, ttl=JWKS_CACHE_TTL,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+                 background=True):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.background = background
+        self._keys = {}
+        self._fetched_at = None
+        self._attempted_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
+        self._refresher_pid = None
+
+    def refresh(self):
+        '''Fetch the key set, return True when the keys were replaced'''
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self):
+        self._attempted_at = time.monotonic()
+        try:
+            keys = self._parse_keys(self.fetcher())
+        except Exception:
+            logger.warning('JWKS fetch failed, serving cached keys',
+                           exc_info=True)
+            return False
+
+        self._replace_keys(keys)
+        return True
+
+    @staticmethod
+    def _parse_keys(jwks):
+        return {
+            key['kid']: {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            } for key in jwks['keys']}
+
+    def _replace_keys(self, keys):
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+
+    def is_stale(self):
+        return (self._fetched_at is None or
+                time.monotonic() - self._fetched_at >= self.ttl)
+
+    def _may_refetch(self):
+        return (self._attempted_at is None or
+                time.monotonic() - self._attempted_at >=
+                self.min_refetch_interval)
+
+    def get_key(self, kid):
+        '''
+            Return the key for kid, or None when it is not in the key set
+            even after a re-fetch
+        '''
+        if self.background:
+            self._start_refresher()
+
+        if self.is_stale() and (self._fetched_at is None or
+                                not self.background):
+            with self._lock:
+                # another thread may have refreshed while we waited
+                if self.is_stale() and self._may_refetch():
+                    self._refresh()
+
+        key = self._keys.get(kid)
+        if key is None:
+            with self._lock:
+                key = self._keys.get(kid)
+                if key is None and self._may_refetch():
+                    self._refresh()
+                    key = self._keys.get(kid)
+        return key
+
+    def _start_refresher(self):
+        # threads do not survive a fork, start one per worker process
+        pid = os.getpid()
+        if self._refresher_pid == pid and self._refresher.is_alive():
+            return
+        with self._lock:
+            if self._refresher_pid == pid and self._refresher.is_alive():
+                return
+            self._stop.clear()
+            self._refresher = threading.Thread(
+                target=self._refresh_loop, name='jwks-refresh', daemon=True)
+            self._refresher_pid = pid
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            if self._fetched_at is None:
+                wait = self.min_refetch_interval
+            elif self._attempted_at > self._fetched_at:
+                # last attempt failed, retry without waiting a full ttl
+                wait = self.min_refetch_interval
+            else:
+                wait = self.ttl - (time.monotonic() - self._fetched_at)
+            if self._stop.wait(max(wait, 0)):
+                break
+            if self.is_stale():
+                self.refresh()
+
+    def close(self):
+        self._stop.set()
+
+
+jwks_store = JWKSStore()
+
+
+'''
+    Verify the token using the cached Auth0 /.well-known/jwks.json keys
     return the decoded payload
 '''
 
 
-def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+def token_kid(token):
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
+    return unverified_header['kid']
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+
+def decode_jwt(token, rsa_key):
+    '''Verify token with rsa_key, None when no key matched its kid'''
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -118,7 +401,7 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
-            return payload
+            return VerifiedPayload(payload)
 
         except jwt.ExpiredSignatureError:
             raise AuthError({
@@ -143,22 +426,107 @@ def verify_decode_jwt(token):
     }, 400)
 
 
+def verify_decode_jwt(token):
+    with span('jwks'):
+        rsa_key = jwks_store.get_key(token_kid(token))
+    with span('jwt_decode'):
+        return decode_jwt(token, rsa_key)
+
+
+'''
+    Verified token cache
+    Keep the decoded payload of already verified tokens so a reused
+    bearer token skips the RS256 signature verification
+'''
+
+
+class TokenCache:
+    '''
+        Bounded LRU cache of decoded payloads keyed by the sha256 digest
+        of the token. An entry is dropped once the token exp claim is
+        reached, tokens without exp are never cached. hits and misses
+        count the lookups of this worker.
+    '''
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                payload, expires_at = entry
+                if expires_at > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, token, payload):
+        expires_at = payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(expires_at, (int, float)):
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'pid': os.getpid(),
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+token_cache = TokenCache()
+
+
 '''
     Validate claims and check the requested permission
     return the decorator which passes the decoded payload to the
     decorated method
+    the permission is compiled once when the decorator is applied and
+    accepts AND/OR combinations, e.g. 'get:movies | get:actors'
 '''
 
 
 def requires_auth(permission=''):
+    permission = compile_permission(permission)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except KeyError:
-                abort(401)
+            payload = token_cache.get(token)
+            if payload is None:
+                try:
+                    payload = verify_decode_jwt(token)
+                except KeyError:
+                    abort(401)
+                token_cache.set(token, payload)
             check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
@@ -0,0 +1,106 @@
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from Crypto.PublicKey import RSA
+from jose import jwt
+
+'''
+    Local identity provider stand-in
+    A locally generated RSA key signs the benchmark tokens and a small
+    HTTP server publishes its public key as the JWKS document. Point the
+    API at it with JWKS_URL, its tokens carry the issuer and audience
+    auth.py expects.
+'''
+
+ALL_PERMISSIONS = [
+    'get:movies', 'get:actors', 'post:movies', 'post:actors',
+    'post:movies_actors', 'patch:movies', 'patch:actors', 'delete:movies',
+    'delete:actors',
+]
+
+
+def b64_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+class LocalSigner:
+    def __init__(self, domain, audience='casting-agency', kid='bench-key',
+                 key=None):
+        self.domain = domain
+        self.audience = audience
+        self.kid = kid
+        self.key = key or RSA.generate(2048)
+        self.private_pem = self.key.exportKey('PEM').decode('ascii')
+
+    @classmethod
+    def from_file(cls, path, domain, **kwargs):
+        '''Signer of the PEM key in path, generated and saved if missing'''
+        try:
+            with open(path) as pem:
+                key = RSA.importKey(pem.read())
+        except FileNotFoundError:
+            key = RSA.generate(2048)
+            with open(path, 'wb') as pem:
+                pem.write(key.exportKey('PEM'))
+        return cls(domain, key=key, **kwargs)
+
+    def jwks(self):
+        return {'keys': [{
+            'kty': 'RSA',
+            'kid': self.kid,
+            'use': 'sig',
+            'n': b64_int(self.key.n),
+            'e': b64_int(self.key.e),
+        }]}
+
+    def token(self, permissions=ALL_PERMISSIONS, expires_in=3600,
+              subject='bench'):
+        now = int(time.time())
+        claims = {
+            'iss': 'https://{}/'.format(self.domain),
+            'sub': subject,
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions),
+        }
+        return jwt.encode(claims, self.private_pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+
+class JWKSServer:
+    '''Serve the signer key set on http://127.0.0.1:<port>/ in a thread'''
+
+    def __init__(self, signer, port=0):
+        body = json.dumps(signer.jwks()).encode('utf-8')
+        self.fetches = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.fetches += 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.url = 'http://127.0.0.1:{}/.well-known/jwks.json'.format(
+            self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='jwks-server', daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,154 @@
+import os
+import sys
+from flask import Flask
+
+# auth.py reads it on import
+os.environ.setdefault('AUTH0_DOMAIN', 'bench.local')
+
+import auth  # noqa: E402
+from bench.auth import LocalSigner  # noqa: E402
+from bench.microbench import (Benchmark, allocations,  # noqa: E402
+                              format_results)
+
+'''
+    Auth hot path microbenchmarks
+    Each stage requires_auth runs on a request (header parsing, JWKS
+    key lookup, signature and claims verification, permission check)
+    and the whole decorator with a cold and a warm token cache, for a
+    valid, an expired, an unknown kid and an insufficient token.
+    python -m bench.auth_micro prints them, python -m pytest bench
+    runs them through pytest-benchmark when it is installed.
+'''
+
+STAGES = ('header', 'jwks', 'decode', 'permission', 'decorator_cold',
+          'decorator_warm')
+TOKENS = ('valid', 'expired', 'wrong_kid', 'missing_permission')
+REQUIRED_PERMISSION = 'get:movies'
+
+# AuthError code expected from (stage, token), anything else returns
+EXPECTED_ERRORS = {
+    ('decode', 'expired'): 'token_expired',
+    ('decode', 'wrong_kid'): 'invalid_header',
+    ('permission', 'missing_permission'): 'unauthorized',
+}
+for _stage in ('decorator_cold', 'decorator_warm'):
+    EXPECTED_ERRORS.update({
+        (_stage, 'expired'): 'token_expired',
+        (_stage, 'wrong_kid'): 'invalid_header',
+        (_stage, 'missing_permission'): 'unauthorized',
+    })
+
+
+def expect_error(function, code):
+    def call():
+        try:
+            function()
+        except auth.AuthError as error:
+            if error.error['code'] != code:
+                raise
+        else:
+            raise AssertionError('expected AuthError {}'.format(code))
+    return call
+
+
+class AuthFixture:
+    '''
+        Tokens signed with a local key, a preloaded key store that does
+        not re-fetch for unknown kids and a Flask request context per
+        case. install() swaps them into auth, uninstall() restores it.
+    '''
+
+    def __init__(self):
+        signer = LocalSigner(auth.AUTH0_DOMAIN, audience=auth.API_AUDIENCE)
+        rotated = LocalSigner(auth.AUTH0_DOMAIN, audience=auth.API_AUDIENCE,
+                              kid='rotated-key', key=signer.key)
+        self.tokens = {
+            'valid': signer.token([REQUIRED_PERMISSION]),
+            'expired': signer.token([REQUIRED_PERMISSION], expires_in=-60),
+            'wrong_kid': rotated.token([REQUIRED_PERMISSION]),
+            'missing_permission': signer.token(['get:actors']),
+        }
+        self.store = auth.JWKSStore(fetcher=signer.jwks, background=False,
+                                    min_refetch_interval=3600)
+        self.cold_cache = auth.TokenCache(maxsize=0)
+        self.warm_cache = auth.TokenCache()
+        self.app = Flask(__name__)
+        self.permission = auth.compile_permission(REQUIRED_PERMISSION)
+        self.view = auth.requires_auth(REQUIRED_PERMISSION)(
+            lambda payload: payload)
+        self._context = None
+        self._saved = None
+
+    def install(self):
+        self._saved = (auth.jwks_store, auth.token_cache)
+        auth.jwks_store = self.store
+        self.store.refresh()
+
+    def uninstall(self):
+        self.end_case()
+        auth.jwks_store, auth.token_cache = self._saved
+
+    def case(self, stage, token_name):
+        '''The function benchmarking stage with the token_name token'''
+        self.end_case()
+        token = self.tokens[token_name]
+        header = 'Bearer ' + token
+        if stage == 'header':
+            def function():
+                return auth.parse_auth_header(header)
+        elif stage == 'jwks':
+            def function():
+                return self.store.get_key(auth.token_kid(token))
+        elif stage == 'decode':
+            key = self.store.get_key(auth.token_kid(token))
+
+            def function():
+                return auth.decode_jwt(token, key)
+        elif stage == 'permission':
+            payload = auth.VerifiedPayload(
+                auth.jwt.get_unverified_claims(token))
+
+            def function():
+                return auth.check_permissions(self.permission, payload)
+        else:
+            auth.token_cache = (self.cold_cache if stage == 'decorator_cold'
+                                else self.warm_cache)
+            self.warm_cache.clear()
+            self._context = self.app.test_request_context(
+                headers={'Authorization': header})
+            self._context.push()
+            function = self.view
+
+        code = EXPECTED_ERRORS.get((stage, token_name))
+        if code is not None:
+            function = expect_error(function, code)
+        # the warm case starts with the token cached
+        function()
+        return function
+
+    def end_case(self):
+        if self._context is not None:
+            self._context.pop()
+            self._context = None
+
+
+def main():
+    fixture = AuthFixture()
+    fixture.install()
+    benchmarks = []
+    try:
+        for stage in STAGES:
+            for token_name in TOKENS:
+                function = fixture.case(stage, token_name)
+                benchmark = Benchmark('{}[{}]'.format(stage, token_name))
+                benchmark(function)
+                benchmark.extra_info.update(allocations(function))
+                benchmarks.append(benchmark)
+    finally:
+        fixture.uninstall()
+    print(format_results(benchmarks))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
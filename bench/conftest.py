@@ -0,0 +1,27 @@
+import pytest
+from bench.microbench import Benchmark, format_results
+
+try:
+    import pytest_benchmark  # noqa: F401
+except ImportError:
+    pytest_benchmark = None
+
+'''
+    Without pytest-benchmark the benchmark fixture falls back to
+    bench.microbench.Benchmark and the results are printed at the end
+    of the session
+'''
+
+_results = []
+
+if pytest_benchmark is None:
+    @pytest.fixture
+    def benchmark(request):
+        benchmark = Benchmark(request.node.name)
+        yield benchmark
+        _results.append(benchmark)
+
+    def pytest_terminal_summary(terminalreporter):
+        if _results:
+            terminalreporter.write_sep('-', 'benchmarks')
+            terminalreporter.write_line(format_results(_results))
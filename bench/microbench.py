@@ -0,0 +1,109 @@
+import statistics
+import time
+import tracemalloc
+
+'''
+    Microbenchmarks
+    A minimal stand-in for the pytest-benchmark fixture (calibrated
+    rounds, per call min/median/mean) used when the plugin is not
+    installed, and a tracemalloc pass measuring the memory one call
+    allocates and keeps.
+'''
+
+MIN_ROUND_TIME = 0.001
+MAX_TIME = 0.5
+MIN_ROUNDS = 5
+
+
+def calibrate(function):
+    '''Calls per round so one round lasts at least MIN_ROUND_TIME'''
+    iterations = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            function()
+        if time.perf_counter() - started >= MIN_ROUND_TIME:
+            return iterations
+        iterations *= 10
+
+
+def timings(function, max_time=MAX_TIME, min_rounds=MIN_ROUNDS):
+    '''Seconds per call of each round, rounds stop after max_time'''
+    iterations = calibrate(function)
+    per_call = []
+    deadline = time.perf_counter() + max_time
+    while len(per_call) < min_rounds or time.perf_counter() < deadline:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            function()
+        per_call.append((time.perf_counter() - started) / iterations)
+    return per_call
+
+
+def allocations(function, calls=50):
+    '''
+        {'peak_bytes': median peak of the memory allocated during one
+        call, 'retained_bytes' and 'retained_blocks': memory still
+        allocated per call after calls calls (cache growth, leaks)}
+    '''
+    was_tracing = tracemalloc.is_tracing()
+    function()
+    peaks = []
+    try:
+        for _ in range(calls):
+            # restarting resets the peak
+            tracemalloc.stop()
+            tracemalloc.start()
+            function()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        before = tracemalloc.take_snapshot()
+        for _ in range(calls):
+            function()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+        if was_tracing:
+            tracemalloc.start()
+    differences = after.compare_to(before, 'filename')
+    return {
+        'peak_bytes': int(statistics.median(peaks)),
+        'retained_bytes': sum(
+            stat.size_diff for stat in differences) / calls,
+        'retained_blocks': sum(
+            stat.count_diff for stat in differences) / calls,
+    }
+
+
+class Benchmark:
+    '''Callable like the pytest-benchmark fixture, stats in seconds'''
+
+    def __init__(self, name):
+        self.name = name
+        self.stats = None
+        self.extra_info = {}
+
+    def __call__(self, function, *args, **kwargs):
+        def call():
+            return function(*args, **kwargs)
+        per_call = timings(call)
+        self.stats = {
+            'min': min(per_call),
+            'median': statistics.median(per_call),
+            'mean': statistics.mean(per_call),
+            'rounds': len(per_call),
+        }
+        return call()
+
+
+def format_results(benchmarks):
+    lines = ['{:<48}{:>12}{:>12}{:>12}{:>12}'.format(
+        'benchmark', 'min us', 'median us', 'peak B', 'kept B')]
+    for benchmark in benchmarks:
+        if benchmark.stats is None:
+            continue
+        lines.append('{:<48}{:>12.2f}{:>12.2f}{:>12}{:>12.1f}'.format(
+            benchmark.name[:47], benchmark.stats['min'] * 1e6,
+            benchmark.stats['median'] * 1e6,
+            benchmark.extra_info.get('peak_bytes', ''),
+            benchmark.extra_info.get('retained_bytes', 0.0)))
+    return '\n'.join(lines)
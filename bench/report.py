@@ -0,0 +1,101 @@
+import json
+import math
+import os
+
+'''
+    Reports and baselines
+    Throughput and nearest-rank latency percentiles per operation, saved
+    as JSON baselines under bench/baselines and compared on later runs.
+'''
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, rank):
+    '''Nearest-rank percentile of already sorted values'''
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(rank / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def _stats(latencies, elapsed):
+    values = sorted(latencies)
+    stats = {'count': len(values),
+             'throughput': len(values) / elapsed if elapsed else 0.0}
+    for rank in PERCENTILES:
+        stats['p{}'.format(rank)] = percentile(values, rank) * 1000
+    return stats
+
+
+def summarize(results):
+    '''{'total': stats, 'operations': {name: stats}, 'errors': n}'''
+    every = [value for values in results.latencies.values()
+             for value in values]
+    return {
+        'total': _stats(every, results.elapsed),
+        'operations': {name: _stats(values, results.elapsed)
+                       for name, values in sorted(results.latencies.items())},
+        'errors': results.errors(),
+        'statuses': {name: {str(status): count for status, count in
+                            sorted(statuses.items())}
+                     for name, statuses in sorted(results.statuses.items())},
+    }
+
+
+def format_summary(summary):
+    lines = ['{:<16}{:>8}{:>10}{:>10}{:>10}{:>10}'.format(
+        'operation', 'count', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')]
+    rows = list(summary['operations'].items()) + [('total',
+                                                   summary['total'])]
+    for name, stats in rows:
+        lines.append('{:<16}{:>8}{:>10.1f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+            name, stats['count'], stats['throughput'], stats['p50'],
+            stats['p95'], stats['p99']))
+    lines.append('errors: {}'.format(summary['errors']))
+    return '\n'.join(lines)
+
+
+def baseline_path(name):
+    return os.path.join(BASELINE_DIR, name + '.json')
+
+
+def save_baseline(name, summary, settings):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    with open(baseline_path(name), 'w') as output:
+        json.dump({'settings': settings, 'summary': summary}, output,
+                  indent=2, sort_keys=True)
+        output.write('\n')
+
+
+def load_baseline(name):
+    with open(baseline_path(name)) as baseline:
+        return json.load(baseline)
+
+
+def compare(summary, baseline, tolerance=0.2):
+    '''
+        Regressions of summary against a baseline summary: p95 latencies
+        more than tolerance (a fraction) slower, throughput more than
+        tolerance lower, or new errors. Return a list of messages.
+    '''
+    regressions = []
+    current = dict(summary['operations'], total=summary['total'])
+    previous = dict(baseline['operations'], total=baseline['total'])
+    for name, stats in sorted(current.items()):
+        before = previous.get(name)
+        if before is None or not before['count']:
+            continue
+        if stats['p95'] > before['p95'] * (1 + tolerance):
+            regressions.append('{} p95 {:.2f}ms, baseline {:.2f}ms'.format(
+                name, stats['p95'], before['p95']))
+        if name == 'total' and stats['throughput'] < before['throughput'] * (
+                1 - tolerance):
+            regressions.append('throughput {:.1f} req/s, baseline {:.1f}'
+                               .format(stats['throughput'],
+                                       before['throughput']))
+    if summary['errors'] > baseline['errors']:
+        regressions.append('{} errors, baseline {}'.format(
+            summary['errors'], baseline['errors']))
+    return regressions
@@ -0,0 +1,178 @@
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from bench.auth import ALL_PERMISSIONS, JWKSServer, LocalSigner
+from bench.report import (compare, format_summary, load_baseline,
+                          save_baseline, summarize)
+
+'''
+    Load test
+    python -m bench.run seeds a database, serves a local JWKS document
+    the API trusts through JWKS_URL and replays a workload mix in
+    process, against gunicorn started by the harness or against an
+    already running server, then prints throughput and latency
+    percentiles and optionally saves or checks a baseline.
+'''
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.run')
+    parser.add_argument('--database-url', default=os.environ.get(
+        'DATABASE_URL', 'sqlite:///' + os.path.join(
+            tempfile.gettempdir(), 'casting-agency-bench.db')))
+    parser.add_argument('--reset', action='store_true',
+                        help='drop and recreate the tables first')
+    parser.add_argument('--actors', type=int, default=10000,
+                        help='actors to seed, 0 to reuse the data')
+    parser.add_argument('--movies', type=int, default=1000)
+    parser.add_argument('--links', type=int, default=50000)
+    parser.add_argument('--mix', default='mixed', help='read, mixed, write')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--duration', type=float,
+                        help='run for seconds instead of --requests')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--tokens', type=int, default=1,
+                        help='distinct bearer tokens, 1 keeps the token '
+                             'cache hot')
+    parser.add_argument('--gunicorn', action='store_true',
+                        help='start gunicorn app:app and load it over HTTP')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='gunicorn workers')
+    parser.add_argument('--target',
+                        help='base URL of a running server, started with '
+                             'JWKS_URL=http://127.0.0.1:<--jwks-port>'
+                             '/.well-known/jwks.json')
+    parser.add_argument('--jwks-port', type=int, default=0)
+    parser.add_argument('--key-file',
+                        help='PEM signing key kept across runs')
+    parser.add_argument('--random-seed', type=int, default=0)
+    parser.add_argument('--save-baseline', metavar='NAME')
+    parser.add_argument('--compare', metavar='NAME')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited with {}'.format(
+                process.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('gunicorn did not start listening')
+
+
+def start_gunicorn(workers):
+    port = free_port()
+    process = subprocess.Popen(
+        # gunicorn 20.0 has no __main__ module
+        [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+         '--workers', str(workers),
+         '--bind', '127.0.0.1:{}'.format(port), '--log-level', 'warning',
+         'app:app'], env=dict(os.environ))
+    try:
+        wait_for_port(port, process)
+    except Exception:
+        process.terminate()
+        raise
+    return process, 'http://127.0.0.1:{}'.format(port)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    domain = os.environ.setdefault('AUTH0_DOMAIN', 'bench.local')
+    if args.key_file:
+        signer = LocalSigner.from_file(args.key_file, domain)
+    else:
+        signer = LocalSigner(domain)
+
+    with JWKSServer(signer, args.jwks_port) as jwks:
+        # read by auth.py and models.py when app is imported
+        os.environ['JWKS_URL'] = jwks.url
+        os.environ['DATABASE_URL'] = args.database_url
+        print('JWKS_URL={}'.format(jwks.url))
+
+        from app import app
+        from models import db, db_drop_and_create_all
+        from bench.seed import id_ranges, seed
+        from bench.workload import (MIXES, HTTPClient, InProcessClient,
+                                    run)
+
+        with app.app_context():
+            if args.reset:
+                db_drop_and_create_all()
+            else:
+                db.create_all()
+            if args.actors:
+                seed(args.actors, args.movies, args.links, args.random_seed)
+            ranges = id_ranges()
+            db.session.remove()
+        if None in ranges['actors'] + ranges['movies']:
+            sys.exit('no data to load, seed with --actors and --movies')
+
+        server = None
+        if args.gunicorn:
+            server, base_url = start_gunicorn(args.workers)
+        else:
+            base_url = args.target
+        if base_url:
+            def client_factory():
+                return HTTPClient(base_url)
+            mode = 'gunicorn' if args.gunicorn else 'http'
+        else:
+            def client_factory():
+                return InProcessClient(app)
+            mode = 'in-process'
+
+        tokens = [signer.token(ALL_PERMISSIONS, subject='bench|{}'.format(
+            number)) for number in range(max(1, args.tokens))]
+        mix = MIXES[args.mix]
+        try:
+            if args.warmup:
+                run(client_factory, mix, tokens, ranges, args.warmup,
+                    args.concurrency, random_seed=args.random_seed + 1)
+            results = run(client_factory, mix, tokens, ranges, args.requests,
+                          args.concurrency, args.duration, args.random_seed)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    summary = summarize(results)
+    print('{} mix, {} workers, {}'.format(args.mix, args.concurrency, mode))
+    print(format_summary(summary))
+
+    status = 0
+    if args.compare:
+        regressions = compare(summary, load_baseline(args.compare)['summary'],
+                              args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        status = 1 if regressions else 0
+    if args.save_baseline:
+        save_baseline(args.save_baseline, summary, {
+            'mode': mode, 'mix': args.mix, 'concurrency': args.concurrency,
+            'requests': args.requests, 'duration': args.duration,
+            'tokens': args.tokens, 'actors': args.actors,
+            'movies': args.movies, 'links': args.links,
+            'database': args.database_url.split(':', 1)[0]})
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+import itertools
+import random
+import time
+from datetime import date, timedelta
+from importer import copy_rows
+from models import (db, actor_movie, bump_versions, dialect_name,
+                    refresh_link_counts, Actor, Movie)
+
+'''
+    Benchmark data
+    Deterministic actors, movies and cast links inserted a chunk at a
+    time, with COPY FROM STDIN on Postgres (psycopg2 executemany sends
+    one INSERT per row) and one executemany elsewhere, so a million rows
+    load in seconds on both. Run inside an application context.
+'''
+
+SEED_CHUNK = 10000
+GENDERS = ('female', 'male', 'non-binary')
+FIRST_NAMES = ('Ada', 'Bruno', 'Carla', 'Diego', 'Elena', 'Farid', 'Greta',
+               'Hugo', 'Irene', 'Jonas', 'Kira', 'Luis', 'Maya', 'Nico')
+LAST_NAMES = ('Alba', 'Berg', 'Costa', 'Duarte', 'Eklund', 'Fontaine',
+              'Garcia', 'Holm', 'Ivanova', 'Jensen', 'Klein', 'Lopez')
+TITLE_WORDS = ('Night', 'River', 'Empire', 'Silent', 'Last', 'Summer',
+               'Storm', 'Garden', 'Shadow', 'Return', 'Golden', 'City')
+
+
+def _insert(table, rows, chunk):
+    '''Insert an iterable of rows, only one chunk of it is held at a time'''
+    postgres = dialect_name() == 'postgresql'
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, chunk))
+        if not batch:
+            break
+        if postgres:
+            columns = tuple(batch[0])
+            copy_rows(table.name, columns, [
+                tuple(row[column] for column in columns) for row in batch])
+        else:
+            db.session.execute(table.insert(), batch)
+
+
+def _id_range(model):
+    low, high = db.session.query(
+        db.func.min(model.id), db.func.max(model.id)).one()
+    return low, high
+
+
+def seed(actors, movies, links, random_seed=0, chunk=SEED_CHUNK,
+         progress=print):
+    '''
+        Add actors, movies and links rows (links are spread evenly over
+        the new movies, distinct actors per movie) and return
+        {'actors': (low id, high id), 'movies': (low id, high id)}
+    '''
+    rng = random.Random(random_seed)
+    started = time.perf_counter()
+    first_day = date(1950, 1, 1)
+    try:
+        _insert(Actor.__table__, ({
+            'name': '{} {} {}'.format(rng.choice(FIRST_NAMES),
+                                      rng.choice(LAST_NAMES), number),
+            'age': rng.randint(5, 90),
+            'gender': rng.choice(GENDERS),
+        } for number in range(actors)), chunk)
+        _insert(Movie.__table__, ({
+            'title': '{} {} {}'.format(rng.choice(TITLE_WORDS),
+                                       rng.choice(TITLE_WORDS), number),
+            'release_date': first_day + timedelta(days=rng.randrange(27000)),
+        } for number in range(movies)), chunk)
+        db.session.flush()
+        actor_low, actor_high = _id_range(Actor)
+        movie_high = _id_range(Movie)[1]
+        movie_low = movie_high - movies + 1
+        progress('seeded {} actors and {} movies in {:.1f}s'.format(
+            actors, movies, time.perf_counter() - started))
+
+        if links and movies and actors:
+            per_movie, extra = divmod(min(links, actors * movies), movies)
+            rows = []
+            for offset, movie_id in enumerate(range(movie_low,
+                                                    movie_high + 1)):
+                size = per_movie + (1 if offset < extra else 0)
+                for actor_id in rng.sample(range(actor_low, actor_high + 1),
+                                           size):
+                    rows.append({'Movie': movie_id, 'Actor': actor_id})
+                if len(rows) >= chunk:
+                    _insert(actor_movie, rows, chunk)
+                    rows = []
+            _insert(actor_movie, rows, chunk)
+            progress('seeded {} links in {:.1f}s'.format(
+                links, time.perf_counter() - started))
+
+        bump_versions('Actor', 'Movie', 'actor_movie')
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    # the links bypass add_links, backfill cast_count and film_count
+    refresh_link_counts()
+    return {'actors': _id_range(Actor), 'movies': _id_range(Movie)}
+
+
+def id_ranges():
+    '''The id ranges of an already seeded database'''
+    return {'actors': _id_range(Actor), 'movies': _id_range(Movie)}
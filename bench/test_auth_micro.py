@@ -0,0 +1,28 @@
+import os
+import pytest
+from bench.auth_micro import STAGES, TOKENS, AuthFixture
+from bench.microbench import allocations
+
+# timing runs take seconds, keep them out of the unit test runs
+pytestmark = pytest.mark.skipif(
+    os.environ.get('BENCH') != '1',
+    reason='microbenchmarks run with BENCH=1')
+
+
+@pytest.fixture(scope='module')
+def auth_fixture():
+    fixture = AuthFixture()
+    fixture.install()
+    yield fixture
+    fixture.uninstall()
+
+
+@pytest.mark.parametrize('token_name', TOKENS)
+@pytest.mark.parametrize('stage', STAGES)
+def test_auth(benchmark, auth_fixture, stage, token_name):
+    function = auth_fixture.case(stage, token_name)
+    try:
+        benchmark(function)
+        benchmark.extra_info.update(allocations(function))
+    finally:
+        auth_fixture.end_case()
@@ -0,0 +1,211 @@
+import http.client
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+'''
+    Workload
+    Weighted mixes of API operations replayed by concurrent workers,
+    either in process through the Flask test client or over HTTP
+    against a running server (gunicorn, uvicorn). Every operation
+    records its latency under its name.
+'''
+
+SORTS = ('id', 'title', 'release_date', '-cast_count')
+ACTOR_SORTS = ('id', 'name', 'age', '-film_count')
+
+
+def list_movies(worker):
+    sort = worker.rng.choice(SORTS)
+    return worker.request('GET', '/movies?limit=50&sort=' + sort)
+
+
+def list_actors(worker):
+    sort = worker.rng.choice(ACTOR_SORTS)
+    return worker.request('GET', '/actors?limit=50&sort=' + sort)
+
+
+def filter_actors(worker):
+    age = worker.rng.randint(5, 80)
+    return worker.request('GET', '/actors?limit=50&age_min={}&age_max={}'
+                          .format(age, age + 10))
+
+
+def movie_cast(worker):
+    return worker.request('GET', '/movies/{}/actors'.format(
+        worker.random_id('movies')))
+
+
+def actor_movies(worker):
+    return worker.request('GET', '/actors/{}/movies'.format(
+        worker.random_id('actors')))
+
+
+def create_movie(worker):
+    status, body = worker.request('POST', '/movies', {
+        'title': 'Bench {}'.format(worker.rng.getrandbits(32)),
+        'release_date': '2020-01-{:02d}'.format(worker.rng.randint(1, 28)),
+    })
+    if status == 200:
+        worker.created.append(json.loads(body)['movie_id'])
+    return status, body
+
+
+def patch_actor(worker):
+    return worker.request('PATCH', '/actors/{}'.format(
+        worker.random_id('actors')), {'age': worker.rng.randint(5, 90)})
+
+
+def delete_movie(worker):
+    # delete what this worker created so the data volume stays stable
+    if not worker.created:
+        return create_movie(worker)
+    return worker.request('DELETE', '/movies/{}'.format(
+        worker.created.pop()))
+
+
+OPERATIONS = {function.__name__: function for function in (
+    list_movies, list_actors, filter_actors, movie_cast, actor_movies,
+    create_movie, patch_actor, delete_movie)}
+
+# {mix name: {operation name: weight}}
+MIXES = {
+    'read': {'list_movies': 30, 'list_actors': 25, 'filter_actors': 15,
+             'movie_cast': 20, 'actor_movies': 10},
+    'mixed': {'list_movies': 25, 'list_actors': 15, 'filter_actors': 10,
+              'movie_cast': 15, 'actor_movies': 5, 'create_movie': 10,
+              'patch_actor': 12, 'delete_movie': 8},
+    'write': {'list_movies': 10, 'movie_cast': 10, 'create_movie': 30,
+              'patch_actor': 30, 'delete_movie': 20},
+}
+
+
+class InProcessClient:
+    '''Requests through the Flask test client of app'''
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers, body=None):
+        response = self.client.open(path, method=method, headers=headers,
+                                    data=body)
+        return response.status_code, response.get_data()
+
+    def close(self):
+        pass
+
+
+class HTTPClient:
+    '''Requests over one keep-alive connection to base_url'''
+
+    def __init__(self, base_url, timeout=30):
+        parts = urlsplit(base_url)
+        connection = (http.client.HTTPSConnection if parts.scheme == 'https'
+                      else http.client.HTTPConnection)
+        self.connection = connection(parts.hostname, parts.port,
+                                     timeout=timeout)
+        self.prefix = parts.path.rstrip('/')
+
+    def request(self, method, path, headers, body=None):
+        self.connection.request(method, self.prefix + path, body=body,
+                                headers=headers)
+        response = self.connection.getresponse()
+        return response.status, response.read()
+
+    def close(self):
+        self.connection.close()
+
+
+class Worker:
+    def __init__(self, client, tokens, id_ranges, rng):
+        self.client = client
+        self.tokens = tokens
+        self.id_ranges = id_ranges
+        self.rng = rng
+        self.created = []
+
+    def random_id(self, table):
+        low, high = self.id_ranges[table]
+        return self.rng.randint(low, high)
+
+    def request(self, method, path, data=None):
+        headers = {'Authorization': 'Bearer ' + self.rng.choice(self.tokens),
+                   'Accept-Encoding': 'gzip'}
+        body = None
+        if data is not None:
+            body = json.dumps(data)
+            headers['Content-Type'] = 'application/json'
+        return self.client.request(method, path, headers, body)
+
+
+class Results:
+    def __init__(self):
+        # {operation: [latency seconds]}, {operation: {status: count}}
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds, status):
+        with self._lock:
+            self.latencies[operation].append(seconds)
+            self.statuses[operation][status] += 1
+
+    def errors(self):
+        # 404 is expected: random ids may point at deleted rows
+        return sum(count for statuses in self.statuses.values()
+                   for status, count in statuses.items()
+                   if status >= 400 and status != 404)
+
+
+def run(client_factory, mix, tokens, id_ranges, requests=1000,
+        concurrency=8, duration=None, random_seed=0):
+    '''
+        Replay requests operations (or as many as fit in duration
+        seconds) of the mix weights on concurrency workers, each with
+        its own client_factory() client, and return the Results
+    '''
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    results = Results()
+    remaining = [requests]
+    lock = threading.Lock()
+    deadline = None
+
+    def take():
+        if deadline is not None:
+            return time.perf_counter() < deadline
+        with lock:
+            if remaining[0] <= 0:
+                return False
+            remaining[0] -= 1
+            return True
+
+    def work(number):
+        rng = random.Random(random_seed * 1000 + number)
+        client = client_factory()
+        worker = Worker(client, tokens, id_ranges, rng)
+        try:
+            while take():
+                name = rng.choices(names, weights)[0]
+                started = time.perf_counter()
+                status, _ = OPERATIONS[name](worker)
+                results.record(name, time.perf_counter() - started, status)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=work, args=(number,),
+                                name='bench-worker-{}'.format(number))
+               for number in range(concurrency)]
+    started = time.perf_counter()
+    if duration is not None:
+        deadline = started + duration
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.elapsed = time.perf_counter() - started
+    return results
@@ -0,0 +1,148 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+# memory bound of the in-process backend
+RESPONSE_CACHE_MAX_BYTES = int(
+    os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# redis URL of the store shared by the workers, in-process when unset
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL')
+# seconds an entry lives in the shared store
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+
+'''
+    Response cache
+    Pre-encoded response bodies keyed by the request ETag. The ETag
+    carries the versions of the tables the response was built from, so
+    a write makes the old entries unreachable in every worker; the
+    backends also drop the entries of the written tables to free memory.
+'''
+
+
+def make_etag(path, args, versions):
+    '''
+        Strong ETag of a GET request from its path, query parameters
+        ((name, value) pairs) and the versions of the tables it reads
+    '''
+    key = '\n'.join(
+        [path, urlencode(sorted(args))] +
+        ['{}={}'.format(table, version) for table, version in
+         versions.items()])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class MemoryBackend:
+    '''In-process LRU bounded by the total size of keys and bodies'''
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, body, tables):
+        cost = len(key) + len(body)
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (body, frozenset(tables), cost)
+            self.size += cost
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tables):
+        with self._lock:
+            stale = [key for key, (_, entry_tables, _) in
+                     self._entries.items() if not entry_tables.isdisjoint(
+                         tables)]
+            for key in stale:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+
+class SharedBackend:
+    '''
+        Store shared by the gunicorn workers. client is any object with
+        the redis get/set(ex=) interface. Entries of written tables are
+        left to expire after ttl, their keys are never requested again.
+    '''
+
+    def __init__(self, client, ttl=RESPONSE_CACHE_TTL, prefix='response:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, body, tables):
+        self.client.set(self.prefix + key, body, ex=self.ttl)
+
+    def invalidate(self, tables):
+        pass
+
+    def clear(self):
+        pass
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        body = self.backend.get(key)
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+
+    def set(self, key, body, tables):
+        self.backend.set(key, body, tables)
+
+    def invalidate(self, tables):
+        self.backend.invalidate(tables)
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'backend': type(self.backend).__name__,
+        }
+
+
+def default_backend():
+    if RESPONSE_CACHE_URL:
+        import redis
+        return SharedBackend(redis.Redis.from_url(RESPONSE_CACHE_URL))
+    return MemoryBackend()
+
+
+response_cache = ResponseCache(default_backend())
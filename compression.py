@@ -0,0 +1,50 @@
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# bodies smaller than this many bytes are sent uncompressed
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_LEVEL = int(os.environ.get('BROTLI_LEVEL', 5))
+# streamed responses, the NDJSON exports, are never compressed
+COMPRESSIBLE_TYPES = ('application/json', 'text/html', 'text/plain')
+
+'''
+    Response compression
+    Content-Encoding negotiation between brotli, when installed, and
+    gzip. A compressed representation gets its own ETag, the identity
+    ETag with the encoding appended, so caches never mix them up.
+'''
+
+
+def available_encodings():
+    if brotli is not None:
+        return ('br', 'gzip')
+    return ('gzip',)
+
+
+def choose_encoding(accept_encodings):
+    '''
+        Best available encoding of a werkzeug Accept-Encoding header,
+        brotli first on equal quality, None for the identity encoding
+    '''
+    best, best_quality = None, 0
+    for encoding in available_encodings():
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_LEVEL)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def variant_etag(etag, encoding):
+    return '{}-{}'.format(etag, encoding)
@@ -0,0 +1,62 @@
+from datetime import date
+from models import Actor, Movie
+
+'''
+    Search and filter query parameters
+    Every filter is pushed down into the SQL WHERE clause. Text filters
+    are case insensitive: name/title match a prefix and
+    name_contains/title_contains a substring, both backed by trigram
+    indexes on Postgres. Invalid values raise ValueError.
+'''
+
+
+def like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace(
+        '_', '\\_')
+
+
+def _text_filters(query, args, column, name):
+    prefix = args.get(name)
+    if prefix is not None:
+        query = query.filter(
+            column.ilike(like_escape(prefix) + '%', escape='\\'))
+    substring = args.get(name + '_contains')
+    if substring is not None:
+        query = query.filter(
+            column.ilike('%' + like_escape(substring) + '%', escape='\\'))
+    return query
+
+
+def _range_filters(query, args, column, minimum, maximum, parse):
+    if args.get(minimum) is not None:
+        query = query.filter(column >= parse(args[minimum]))
+    if args.get(maximum) is not None:
+        query = query.filter(column <= parse(args[maximum]))
+    return query
+
+
+def filter_movies(query, args):
+    '''
+        title, title_contains, released_after and released_before
+        (inclusive, YYYY-MM-DD) and cast_count_min and cast_count_max
+        (inclusive)
+    '''
+    query = _text_filters(query, args, Movie.title, 'title')
+    query = _range_filters(query, args, Movie.cast_count, 'cast_count_min',
+                           'cast_count_max', int)
+    return _range_filters(query, args, Movie.release_date,
+                          'released_after', 'released_before',
+                          date.fromisoformat)
+
+
+def filter_actors(query, args):
+    '''
+        name, name_contains, gender (exact), age_min and age_max and
+        film_count_min and film_count_max (inclusive)
+    '''
+    query = _text_filters(query, args, Actor.name, 'name')
+    if args.get('gender') is not None:
+        query = query.filter(Actor.gender == args['gender'])
+    query = _range_filters(query, args, Actor.film_count, 'film_count_min',
+                           'film_count_max', int)
+    return _range_filters(query, args, Actor.age, 'age_min', 'age_max', int)
@@ -0,0 +1,183 @@
+import csv
+import io
+import itertools
+import json
+import os
+import time
+from sqlalchemy import text
+from models import (db, actor_movie, bump_versions, dialect_name,
+                    existing_ids, insert_links, link_count_updates, Actor,
+                    Movie)
+from validation import validate_actors, validate_links, validate_movies
+
+# rows read, validated and written per round trip by manage.py import
+IMPORT_CHUNK = int(os.environ.get('IMPORT_CHUNK', 10000))
+# invalid rows listed in the error of an aborted import
+MAX_REPORTED_ERRORS = 20
+
+'''
+    Bulk import
+    Stream a CSV (with a header row) or NDJSON file into Movie, Actor or
+    actor_movie a chunk at a time: each chunk is validated column by
+    column with the bulk endpoint validators, then written with COPY
+    FROM STDIN on Postgres or one executemany elsewhere, so memory stays
+    flat whatever the file size. The whole file is one transaction, the
+    table versions are bumped once and imported links update
+    cast_count and film_count.
+'''
+
+
+class ImportFileError(ValueError):
+    '''Invalid rows found by an import, nothing was written'''
+
+    def __init__(self, errors):
+        super().__init__('{} invalid rows'.format(len(errors)))
+        self.errors = errors
+
+
+# table option: (model or table, validator, columns of the validated rows)
+TABLES = {
+    'movies': (Movie, validate_movies, ('title', 'release_date')),
+    'actors': (Actor, validate_actors, ('name', 'age', 'gender')),
+    'links': (actor_movie, validate_links, ('Movie', 'Actor')),
+}
+
+
+def file_format(path):
+    return 'ndjson' if path.endswith(('.ndjson', '.jsonl', '.json')) \
+        else 'csv'
+
+
+def read_records(stream, fmt):
+    '''
+        Yield (line number, dict) of every record, None for an NDJSON
+        line that is not valid JSON
+    '''
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, None
+
+
+def copy_rows(table, columns, rows):
+    '''COPY the rows (tuples of columns) into table on Postgres'''
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    statement = 'COPY "{}" ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        table, ', '.join('"{}"'.format(column) for column in columns))
+    # the psycopg2 connection of the session transaction
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(statement, buffer)
+    finally:
+        cursor.close()
+
+
+def _write_rows(table, columns, rows, postgres):
+    if postgres:
+        copy_rows(table.name, columns,
+                  [tuple(row[column] for column in columns) for row in rows])
+    else:
+        db.session.execute(table.insert(), rows)
+
+
+def _write_links(pairs, postgres):
+    '''Insert the links missing from actor_movie, return those inserted'''
+    if not postgres:
+        return insert_links(pairs)
+    # COPY cannot skip existing rows, stage the chunk in a temporary table
+    db.session.execute(text(
+        'CREATE TEMPORARY TABLE IF NOT EXISTS import_links '
+        '("Movie" integer, "Actor" integer) ON COMMIT DROP'))
+    db.session.execute(text('TRUNCATE import_links'))
+    copy_rows('import_links', ('Movie', 'Actor'), pairs)
+    return [tuple(row) for row in db.session.execute(text(
+        'INSERT INTO actor_movie ("Movie", "Actor") '
+        'SELECT DISTINCT "Movie", "Actor" FROM import_links '
+        'ON CONFLICT DO NOTHING RETURNING "Movie", "Actor"'))]
+
+
+def _missing_links(pairs):
+    '''Indexes of the pairs whose movie or actor does not exist'''
+    movies = existing_ids(Movie, {movie_id for movie_id, _ in pairs})
+    actors = existing_ids(Actor, {actor_id for _, actor_id in pairs})
+    return [index for index, (movie_id, actor_id) in enumerate(pairs)
+            if movie_id not in movies or actor_id not in actors]
+
+
+def import_file(stream, table_name, fmt='csv', chunk_size=IMPORT_CHUNK,
+                skip_invalid=False, progress=print):
+    '''
+        Import the records of stream into the table_name table of
+        TABLES. Invalid records raise ImportFileError and roll everything
+        back, or are skipped with skip_invalid. Return the number of
+        rows written and of records skipped.
+    '''
+    target, validate, columns = TABLES[table_name]
+    table = getattr(target, '__table__', target)
+    postgres = dialect_name() == 'postgresql'
+    records = read_records(stream, fmt)
+    written = skipped = 0
+    errors = []
+    started = time.perf_counter()
+    try:
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                break
+            lines = [number for number, _ in chunk]
+            rows, chunk_errors = validate([record for _, record in chunk])
+            for error in chunk_errors:
+                error['line'] = lines[error.pop('index')]
+            if table_name == 'links' and rows:
+                # foreign keys would abort the transaction, check first
+                invalid = {error['line'] for error in chunk_errors}
+                row_lines = [line for line in lines if line not in invalid]
+                missing = set(_missing_links(rows))
+                chunk_errors.extend(
+                    {'line': row_lines[index],
+                     'message': 'Unknown movie or actor'}
+                    for index in sorted(missing))
+                rows = [pair for index, pair in enumerate(rows)
+                        if index not in missing]
+            skipped += len(chunk_errors)
+            if chunk_errors and not skip_invalid:
+                errors.extend(chunk_errors)
+                if len(errors) >= MAX_REPORTED_ERRORS:
+                    break
+                continue
+            if errors or not rows:
+                # only looking for more errors to report
+                continue
+
+            if table_name == 'links':
+                inserted = _write_links(rows, postgres)
+                for statement in link_count_updates(inserted, 1):
+                    db.session.execute(statement)
+                written += len(inserted)
+            else:
+                _write_rows(table, columns, rows, postgres)
+                written += len(rows)
+            elapsed = time.perf_counter() - started
+            progress('{}: {} rows, {:.0f} rows/s'.format(
+                table_name, written, written / elapsed if elapsed else 0))
+
+        if errors:
+            raise ImportFileError(errors[:MAX_REPORTED_ERRORS])
+        if written:
+            bump_versions(*(('Movie', 'Actor', 'actor_movie')
+                            if table_name == 'links' else (table.name,)))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return written, skipped
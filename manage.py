@@ -1,8 +1,11 @@
-from flask_script import Manager
+import sys
+from flask_script import Command, Manager, Option
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from importer import (IMPORT_CHUNK, TABLES, ImportFileError, file_format,
+                      import_file)
+from models import db, link_count_checks, refresh_link_counts
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +13,64 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+class ImportCommand(Command):
+    '''
+        Import a CSV or NDJSON file of movies, actors or links
+        (movie_id, actor_id), all or nothing unless --skip-invalid
+    '''
+
+    option_list = (
+        Option('table', choices=sorted(TABLES)),
+        Option('path'),
+        Option('--format', dest='fmt', choices=('csv', 'ndjson'),
+               help='default from the file extension'),
+        Option('--chunk-size', dest='chunk_size', type=int,
+               default=IMPORT_CHUNK),
+        Option('--skip-invalid', dest='skip_invalid', action='store_true',
+               help='import the valid rows and count the others'),
+    )
+
+    def run(self, table, path, fmt, chunk_size, skip_invalid):
+        with open(path, newline='', encoding='utf-8') as stream:
+            try:
+                written, skipped = import_file(
+                    stream, table, fmt or file_format(path), chunk_size,
+                    skip_invalid,
+                    progress=lambda line: print(line, file=sys.stderr))
+            except ImportFileError as error:
+                for item in error.errors:
+                    print('line {}: {}'.format(
+                        item['line'], item.get('message') or item['fields']))
+                print('nothing imported, {}'.format(error))
+                return 1
+        print('imported {} {}, skipped {}'.format(written, table, skipped))
+        return 0
+
+
+manager.add_command('import', ImportCommand())
+
+# mismatched rows listed by check_counts
+CHECK_COUNTS_LIMIT = 20
+
+
+@manager.command
+def check_counts(fix=False):
+    '''
+        Compare Movie.cast_count and Actor.film_count with actor_movie,
+        --fix recomputes the counts. Exit status 1 on mismatches.
+    '''
+    mismatches = link_count_checks()
+    total = sum(len(rows) for rows in mismatches.values())
+    for table, rows in mismatches.items():
+        print('{}: {} mismatched counts'.format(table, len(rows)))
+        for row_id, stored, actual in rows[:CHECK_COUNTS_LIMIT]:
+            print('  id {}: stored {}, actual {}'.format(
+                row_id, stored, actual))
+    if total and fix:
+        print('fixed {} rows'.format(refresh_link_counts()))
+        return 0
+    return 1 if total else 0
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,238 @@
+import hmac
+import os
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# add the Server-Timing header to the responses
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'true').lower() in (
+    '1', 'true', 'yes', 'on')
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# bearer token of the /metrics scraper, the endpoint is disabled when unset
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+'''
+    Metrics
+    Process-wide Prometheus histograms and counters, plus the timings of
+    the current request (a context variable, so it follows threads and
+    asyncio tasks) used for the Server-Timing header. Recording a value
+    is a bisect and a dict update under a lock.
+'''
+
+
+def scrape_allowed(authorization, token=None):
+    '''
+        Whether the Authorization header value carries the metrics token,
+        compared in constant time. Always False without a token.
+    '''
+    token = METRICS_TOKEN if token is None else token
+    if not token or not authorization:
+        return False
+    return hmac.compare_digest(authorization.encode('utf-8'),
+                               'Bearer {}'.format(token).encode('utf-8'))
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(
+                label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def collect(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} counter'.format(self.name)
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in sorted(values):
+            yield '{}{} {}'.format(
+                self.name, _labels(self.labels, label_values), value)
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # per bucket counts (the last one is +Inf), sum
+                series = self._series[label_values] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *label_values):
+        series = self._series.get(label_values)
+        return 0 if series is None else sum(series[0])
+
+    def collect(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} histogram'.format(self.name)
+        with self._lock:
+            series = [(label_values, list(counts), total) for
+                      label_values, (counts, total) in self._series.items()]
+        names = self.labels + ('le',)
+        for label_values, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(
+                    self.name, _labels(names, label_values + (bound,)),
+                    cumulative)
+            labels = _labels(self.labels, label_values)
+            yield '{}_sum{} {}'.format(self.name, labels, total)
+            yield '{}_count{} {}'.format(self.name, labels, cumulative)
+
+
+REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', 'Time spent handling requests',
+    ('method', 'route'))
+REQUESTS = Counter(
+    'http_requests_total', 'Requests handled', ('method', 'route', 'status'))
+PHASE_DURATION = Histogram(
+    'request_phase_duration_seconds',
+    'Time spent in each phase of the requests', ('phase',))
+QUERY_DURATION = Histogram(
+    'db_query_duration_seconds', 'Duration of the SQL statements')
+REQUEST_QUERIES = Histogram(
+    'db_queries_per_request', 'SQL statements executed per request',
+    buckets=QUERY_COUNT_BUCKETS)
+
+registry = [REQUEST_DURATION, REQUESTS, PHASE_DURATION, QUERY_DURATION,
+            REQUEST_QUERIES]
+# callables returning (name, type, documentation, value) samples of
+# values owned by other modules (caches, connection pool)
+collectors = []
+
+
+class RequestTimings:
+    __slots__ = ('started', 'phases', 'queries', 'query_time')
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.phases = {}
+        self.queries = 0
+        self.query_time = 0.0
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def server_timing(self, total):
+        entries = ['{};dur={:.3f}'.format(phase, seconds * 1000)
+                   for phase, seconds in self.phases.items()]
+        if self.queries:
+            entries.append('db;dur={:.3f};desc="{} queries"'.format(
+                self.query_time * 1000, self.queries))
+        entries.append('total;dur={:.3f}'.format(total * 1000))
+        return ', '.join(entries)
+
+
+_current = ContextVar('request_timings', default=None)
+
+
+def begin_request():
+    _current.set(RequestTimings())
+
+
+def finish_request(method, route, status):
+    '''
+        Record the current request, return its Server-Timing header
+        value or None when no request was started
+    '''
+    timings = _current.get()
+    if timings is None:
+        return None
+    _current.set(None)
+    total = perf_counter() - timings.started
+    REQUEST_DURATION.observe(total, method, route)
+    REQUESTS.inc(method, route, status)
+    REQUEST_QUERIES.observe(timings.queries)
+    return timings.server_timing(total)
+
+
+class span:
+    '''Context manager timing one phase of the current request'''
+    __slots__ = ('phase', 'started')
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = perf_counter() - self.started
+        PHASE_DURATION.observe(elapsed, self.phase)
+        timings = _current.get()
+        if timings is not None:
+            timings.add(self.phase, elapsed)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    conn.info.setdefault('query_started', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context,
+                     executemany):
+    elapsed = perf_counter() - conn.info['query_started'].pop()
+    QUERY_DURATION.observe(elapsed)
+    timings = _current.get()
+    if timings is not None:
+        timings.queries += 1
+        timings.query_time += elapsed
+
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_timer(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+
+def render():
+    '''The metrics in the Prometheus text exposition format'''
+    lines = []
+    for metric in registry:
+        lines.extend(metric.collect())
+    for collector in collectors:
+        for name, kind, documentation, value in collector():
+            lines.append('# HELP {} {}'.format(name, documentation))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
@@ -79,6 +79,12 @@ def run_migrations_online():
     )
 
     with connectable.connect() as connection:
+        if connection.dialect.name == 'sqlite':
+            # models.py turns foreign keys on for every SQLite connection,
+            # the DROP TABLE of a batch table rebuild would then run the
+            # ON DELETE CASCADE of actor_movie. The pragma is ignored inside
+            # a transaction, set it before the migrations begin one.
+            connection.execute('PRAGMA foreign_keys=OFF')
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
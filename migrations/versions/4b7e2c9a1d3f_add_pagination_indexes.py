@@ -0,0 +1,31 @@
+"""add pagination indexes
+
+Revision ID: 4b7e2c9a1d3f
+Revises: 9261467712c1
+Create Date: 2026-10-18 09:12:31.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b7e2c9a1d3f'
+down_revision = '9261467712c1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_Movie_title_id', 'Movie', ['title', 'id'])
+    op.create_index('ix_Movie_release_date_id', 'Movie',
+                    ['release_date', 'id'])
+    op.create_index('ix_Actor_name_id', 'Actor', ['name', 'id'])
+    op.create_index('ix_Actor_age_id', 'Actor', ['age', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_Actor_age_id', table_name='Actor')
+    op.drop_index('ix_Actor_name_id', table_name='Actor')
+    op.drop_index('ix_Movie_release_date_id', table_name='Movie')
+    op.drop_index('ix_Movie_title_id', table_name='Movie')
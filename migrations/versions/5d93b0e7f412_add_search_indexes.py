@@ -0,0 +1,36 @@
+"""add search indexes
+
+Revision ID: 5d93b0e7f412
+Revises: c81f0e5d2a47
+Create Date: 2026-10-18 11:58:42.930186
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d93b0e7f412'
+down_revision = 'c81f0e5d2a47'
+branch_labels = None
+depends_on = None
+
+# release_date, title, name and age range/prefix scans already use the
+# (column, id) indexes of revision 4b7e2c9a1d3f
+
+
+def upgrade():
+    op.create_index('ix_Actor_gender', 'Actor', ['gender'])
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        op.execute('CREATE INDEX "ix_Movie_title_trgm" ON "Movie" '
+                   'USING gin (title gin_trgm_ops)')
+        op.execute('CREATE INDEX "ix_Actor_name_trgm" ON "Actor" '
+                   'USING gin (name gin_trgm_ops)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_Actor_name_trgm', table_name='Actor')
+        op.drop_index('ix_Movie_title_trgm', table_name='Movie')
+    op.drop_index('ix_Actor_gender', table_name='Actor')
@@ -0,0 +1,44 @@
+"""add cast_count and film_count
+
+Revision ID: 7f3c1b9e5a20
+Revises: e2a6d4c8b517
+Create Date: 2026-10-18 18:02:44.517390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7f3c1b9e5a20'
+down_revision = 'e2a6d4c8b517'
+branch_labels = None
+depends_on = None
+
+# (table, count column, actor_movie column holding its id)
+COUNTS = (('Movie', 'cast_count', 'Movie'), ('Actor', 'film_count', 'Actor'))
+
+
+def upgrade():
+    for table, column, link in COUNTS:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column(column, sa.Integer(),
+                                          nullable=False,
+                                          server_default='0'))
+        # backfill with one correlated count per row, the (Movie, Actor)
+        # and (Actor, Movie) indexes of actor_movie serve the lookups
+        op.execute(
+            'UPDATE "{table}" SET {column} = (SELECT count(*) FROM '
+            'actor_movie WHERE actor_movie."{link}" = "{table}".id)'.format(
+                table=table, column=column, link=link))
+        op.create_index('ix_{}_{}_id'.format(table, column), table,
+                        [column, 'id'])
+    op.execute("UPDATE table_version SET version = version + 1 "
+               "WHERE name IN ('Movie', 'Actor')")
+
+
+def downgrade():
+    for table, column, link in reversed(COUNTS):
+        op.drop_index('ix_{}_{}_id'.format(table, column), table_name=table)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column(column)
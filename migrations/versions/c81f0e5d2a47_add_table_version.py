@@ -0,0 +1,34 @@
+"""add table version counters
+
+Revision ID: c81f0e5d2a47
+Revises: 4b7e2c9a1d3f
+Create Date: 2026-10-18 10:41:07.218554
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81f0e5d2a47'
+down_revision = '4b7e2c9a1d3f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_version = op.create_table(
+        'table_version',
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_version, [
+        {'name': 'Movie', 'version': 0},
+        {'name': 'Actor', 'version': 0},
+        {'name': 'actor_movie', 'version': 0},
+    ])
+
+
+def downgrade():
+    op.drop_table('table_version')
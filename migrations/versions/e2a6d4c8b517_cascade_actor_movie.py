@@ -0,0 +1,52 @@
+"""cascade actor_movie deletes and index links by movie
+
+Revision ID: e2a6d4c8b517
+Revises: 5d93b0e7f412
+Create Date: 2026-10-18 12:47:15.661093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a6d4c8b517'
+down_revision = '5d93b0e7f412'
+branch_labels = None
+depends_on = None
+
+
+def actor_movie_table(ondelete):
+    return sa.Table(
+        'actor_movie', sa.MetaData(),
+        sa.Column('Actor', sa.Integer(), sa.ForeignKey(
+            'Actor.id', ondelete=ondelete), nullable=False),
+        sa.Column('Movie', sa.Integer(), sa.ForeignKey(
+            'Movie.id', ondelete=ondelete), nullable=False),
+        sa.PrimaryKeyConstraint('Actor', 'Movie'))
+
+
+def replace_foreign_keys(ondelete):
+    if op.get_bind().dialect.name == 'postgresql':
+        for column, table in (('Actor', 'Actor'), ('Movie', 'Movie')):
+            name = 'actor_movie_{}_fkey'.format(column)
+            op.drop_constraint(name, 'actor_movie', type_='foreignkey')
+            op.create_foreign_key(name, 'actor_movie', table, [column],
+                                  ['id'], ondelete=ondelete)
+    else:
+        # SQLite cannot alter constraints, rebuild the table instead
+        with op.batch_alter_table(
+                'actor_movie', recreate='always',
+                copy_from=actor_movie_table(ondelete)):
+            pass
+
+
+def upgrade():
+    replace_foreign_keys('CASCADE')
+    op.create_index('ix_actor_movie_Movie_Actor', 'actor_movie',
+                    ['Movie', 'Actor'])
+
+
+def downgrade():
+    op.drop_index('ix_actor_movie_Movie_Actor', table_name='actor_movie')
+    replace_foreign_keys(None)
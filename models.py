@@ -1,10 +1,130 @@
+import itertools
 import os
-from sqlalchemy import Column, String, Integer
-from flask_sqlalchemy import SQLAlchemy
+from collections import Counter
+import sqlite3
+import threading
+import time
+from sqlalchemy import (DDL, Column, String, Integer, bindparam, event, exc,
+                        func, inspect, orm, select, text, tuple_)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 
 database_path = os.environ['DATABASE_URL']
+# connection pool settings: config/env name, type and default
+POOL_SETTINGS = (
+    ('pool_size', 'DB_POOL_SIZE', int, 5),
+    ('max_overflow', 'DB_MAX_OVERFLOW', int, 10),
+    ('pool_timeout', 'DB_POOL_TIMEOUT', int, 30),
+    ('pool_recycle', 'DB_POOL_RECYCLE', int, 1800),
+    ('pool_pre_ping', 'DB_POOL_PRE_PING', bool, True),
+)
+# milliseconds before Postgres cancels a statement, 0 disables it
+STATEMENT_TIMEOUT_SETTING = ('DB_STATEMENT_TIMEOUT', int, 0)
+# rows per multi-row INSERT statement of the bulk inserts
+BULK_INSERT_CHUNK = int(os.environ.get('BULK_INSERT_CHUNK', 1000))
+# comma separated URLs of read replicas of DATABASE_URL
+REPLICA_URLS_SETTING = 'DATABASE_REPLICA_URLS'
+# seconds a replica health check result is trusted, failed replicas
+# are left out of the rotation for as long
+REPLICA_HEALTH_INTERVAL = int(os.environ.get('REPLICA_HEALTH_INTERVAL', 10))
 
-db = SQLAlchemy()
+'''
+    Read replicas
+    Read-only requests call use_replica() and their session then sends
+    its queries to one healthy replica, picked in turn. Flushes and
+    INSERT/UPDATE/DELETE statements go to the primary and keep the rest
+    of the session there. Without a healthy replica the primary is used.
+'''
+
+
+class ReplicaSet:
+    '''The replica binds of an application and their health'''
+
+    def __init__(self, binds, check_interval=REPLICA_HEALTH_INTERVAL,
+                 clock=time.monotonic):
+        self.binds = list(binds)
+        self.check_interval = check_interval
+        self.clock = clock
+        self.fallbacks = 0
+        self._health = {}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def is_healthy(self, bind, engine):
+        now = self.clock()
+        with self._lock:
+            health = self._health.get(bind)
+        if health is not None and now - health[1] < self.check_interval:
+            return health[0]
+        healthy = self._ping(engine)
+        with self._lock:
+            self._health[bind] = (healthy, now)
+        return healthy
+
+    def _ping(self, engine):
+        try:
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except exc.SQLAlchemyError:
+            return False
+        return True
+
+    def choose(self, get_engine):
+        '''Return the engine of the next healthy replica or None'''
+        start = next(self._turn)
+        for step in range(len(self.binds)):
+            bind = self.binds[(start + step) % len(self.binds)]
+            engine = get_engine(bind)
+            if self.is_healthy(bind, engine):
+                return engine
+        self.fallbacks += 1
+        return None
+
+    def status(self):
+        with self._lock:
+            return {bind: self._health.get(bind, (None, None))[0]
+                    for bind in self.binds}
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if self.info.get('read_replica'):
+            if self._flushing or isinstance(clause, UpdateBase):
+                # the session has written, it reads its writes from now on
+                self.info['read_replica'] = False
+            else:
+                engine = self.info.get('replica_engine')
+                if engine is None:
+                    engine = self._choose_replica()
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper, clause)
+
+    def _choose_replica(self):
+        app = db.get_app()
+        replicas = app.extensions.get('replicas')
+        engine = None
+        if replicas is not None:
+            engine = replicas.choose(
+                lambda bind: db.get_engine(app, bind=bind))
+        if engine is None:
+            self.info['read_replica'] = False
+        else:
+            # one replica per session for a consistent view
+            self.info['replica_engine'] = engine
+        return engine
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
@@ -12,19 +132,284 @@ setup_db(app)
 '''
 
 
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite only enforces foreign keys, and their cascades, when asked to
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
 def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
 
 
-def setup_db(app, database_path=database_path):
+def dialect_name():
+    return db.session.get_bind().dialect.name
+
+
+def bulk_insert(model, rows):
+    '''
+        Insert the rows (list of column dicts) of model in one
+        transaction and return their ids in order. On Postgres each chunk
+        is a single multi-row INSERT ... RETURNING id.
+    '''
+    table = model.__table__
+    ids = []
+    try:
+        if dialect_name() == 'postgresql':
+            for start in range(0, len(rows), BULK_INSERT_CHUNK):
+                chunk = rows[start:start + BULK_INSERT_CHUNK]
+                result = db.session.execute(
+                    table.insert().values(chunk).returning(table.c.id))
+                ids.extend(row[0] for row in result)
+        else:
+            for row in rows:
+                result = db.session.execute(table.insert().values(row))
+                ids.append(result.inserted_primary_key[0])
+        bump_versions(table.name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return ids
+
+
+def update_row(model, row_id, values):
+    '''
+        Update the row of model with one UPDATE ... WHERE id statement,
+        return False when there is no such row
+    '''
+    table = model.__table__
+    try:
+        if values:
+            result = db.session.execute(table.update().where(
+                table.c.id == row_id).values(**values))
+            found = result.rowcount > 0
+            if found:
+                bump_versions(table.name)
+        else:
+            found = db.session.query(table.c.id).filter(
+                table.c.id == row_id).scalar() is not None
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return found
+
+
+def delete_row(model, row_id):
+    '''
+        Delete the row of model with one DELETE ... WHERE id statement,
+        its links are removed by the database cascade after the counts
+        of the linked rows are decremented. Return False, and roll back,
+        when there is no such row.
+    '''
+    table = model.__table__
+    try:
+        found = unlink_row(model, row_id)
+        if found:
+            result = db.session.execute(
+                table.delete().where(table.c.id == row_id))
+            found = result.rowcount > 0
+        if not found:
+            db.session.rollback()
+            return False
+        bump_versions('Movie', 'Actor', 'actor_movie')
+        # an instance already loaded in the session is now stale
+        instance = db.session.identity_map.get(identity_key(model, row_id))
+        if instance is not None:
+            db.session.expunge(instance)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return True
+
+
+class PoolStats:
+    '''Checkout counters of the connection pool of this worker'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+    '''QueuePool recording how long each checkout waited'''
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_stats.record(time.perf_counter() - start)
+        return connection
+
+
+def _setting(name, kind, default, config):
+    value = config.get(name, os.environ.get(name))
+    if value is None:
+        return default
+    if kind is bool and isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return kind(value)
+
+
+def engine_options(database_path, config=None):
+    '''
+        SQLAlchemy engine options from config (test_config) falling back
+        to the environment then to the defaults
+    '''
+    config = config or {}
+    settings = {option: _setting(name, kind, default, config)
+                for option, name, kind, default in POOL_SETTINGS}
+    options = {
+        'pool_pre_ping': settings['pool_pre_ping'],
+        'pool_recycle': settings['pool_recycle'],
+    }
+    if not database_path.startswith('sqlite'):
+        # SQLite uses a single connection or no pool at all
+        options.update(
+            poolclass=InstrumentedQueuePool,
+            pool_size=settings['pool_size'],
+            max_overflow=settings['max_overflow'],
+            pool_timeout=settings['pool_timeout'],
+        )
+    statement_timeout = _setting(*STATEMENT_TIMEOUT_SETTING, config)
+    if statement_timeout and database_path.startswith('postgres'):
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(statement_timeout)}
+    return options
+
+
+def get_pool_stats():
+    '''Pool occupancy and checkout wait statistics of this worker'''
+    pool = db.engine.pool
+    stats = {
+        'pid': os.getpid(),
+        'checkouts': pool_stats.checkouts,
+        'timeouts': pool_stats.timeouts,
+        'wait_total_seconds': pool_stats.wait_total,
+        'wait_max_seconds': pool_stats.wait_max,
+    }
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    return stats
+
+
+def replica_urls(config=None):
+    value = (config or {}).get(
+        REPLICA_URLS_SETTING, os.environ.get(REPLICA_URLS_SETTING, ''))
+    if isinstance(value, str):
+        value = value.split(',')
+    return [url.strip() for url in value if url.strip()]
+
+
+def setup_db(app, database_path=database_path, test_config=None):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        database_path, test_config)
+    binds = {'replica{}'.format(number): url
+             for number, url in enumerate(replica_urls(test_config))}
+    if binds:
+        app.config["SQLALCHEMY_BINDS"] = binds
+        app.extensions['replicas'] = ReplicaSet(binds)
     db.app = app
     db.init_app(app)
     # db_drop_and_create_all()
 
 
+'''
+    Table versions
+    One counter per table bumped in the same transaction as every write
+    to that table, readers use it to tell whether cached data is current
+    without touching the rows
+'''
+VERSIONED_TABLES = ('Movie', 'Actor', 'actor_movie')
+
+
+class TableVersion(db.Model):
+    __tablename__ = 'table_version'
+    name = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+@event.listens_for(TableVersion.__table__, 'after_create')
+def seed_table_versions(target, connection, **kw):
+    connection.execute(target.insert(), [
+        {'name': name, 'version': 0} for name in VERSIONED_TABLES])
+
+
+# callables notified with the set of written tables after each commit
+version_listeners = []
+
+
+def bump_versions(*tables):
+    '''Increment the version of tables within the current transaction'''
+    db.session.execute(
+        TableVersion.__table__.update().where(
+            TableVersion.name.in_(tables)).values(
+            version=TableVersion.version + 1))
+    db.session.info.setdefault('bumped_tables', set()).update(tables)
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def notify_version_listeners(session):
+    tables = session.info.pop('bumped_tables', None)
+    if tables:
+        for listener in version_listeners:
+            listener(tables)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def discard_bumped_tables(session):
+    session.info.pop('bumped_tables', None)
+
+
+def use_replica():
+    '''Send the reads of the current session to a read replica'''
+    db.session.info['read_replica'] = True
+
+
+def get_versions(tables):
+    '''Return {table: version} for tables in one query'''
+    versions = dict.fromkeys(tables, 0)
+    versions.update(db.session.query(
+        TableVersion.name, TableVersion.version).filter(
+        TableVersion.name.in_(tables)))
+    return versions
+
+
 '''
     drops the database tables and starts fresh
     can be used to initialize a clean database
@@ -32,37 +417,56 @@ def setup_db(app, database_path=database_path):
 # Actor by movie
 actor_movie = db.Table('actor_movie',
                        db.Column('Actor', db.Integer, db.ForeignKey(
-                           'Actor.id'), primary_key=True),
+                           'Actor.id', ondelete='CASCADE'),
+                           primary_key=True),
                        db.Column('Movie', db.Integer, db.ForeignKey(
-                           'Movie.id'), primary_key=True),
+                           'Movie.id', ondelete='CASCADE'),
+                           primary_key=True),
+                       # the primary key only serves lookups by actor
+                       db.Index('ix_actor_movie_Movie_Actor',
+                                'Movie', 'Actor'),
                        )
 
 
 class Movie(db.Model):
     __tablename__ = 'Movie'
+    # (column, id) indexes backing the keyset pagination sort orders
+    __table_args__ = (
+        db.Index('ix_Movie_title_id', 'title', 'id'),
+        db.Index('ix_Movie_release_date_id', 'release_date', 'id'),
+        db.Index('ix_Movie_cast_count_id', 'cast_count', 'id'),
+    )
     id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
     title = Column(String(100), nullable=False)
     release_date = db.Column(db.Date, nullable=False)
+    # actor_movie links of the movie, maintained by the link helpers below
+    cast_count = Column(Integer, nullable=False, server_default='0')
+    sortable = ('title', 'release_date', 'cast_count')
+    # links are removed by the ON DELETE CASCADE foreign keys
     actor_movie = db.relationship(
         'Actor', secondary=actor_movie, backref=db.backref(
-            'actor_movie'), lazy='dynamic')
+            'actor_movie', order_by='Movie.id', passive_deletes=True),
+        lazy='dynamic', passive_deletes=True)
 
     def insert(self):
         db.session.add(self)
+        bump_versions(self.__tablename__)
         db.session.commit()
 
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        # the identity does not need a refresh of a detached instance
+        delete_row(type(self), inspect(self).identity[0])
 
     def update(self):
+        bump_versions(self.__tablename__)
         db.session.commit()
 
     def format(self):
         return {
             'id': self.id,
             'title': self.title,
-            'release_date': self.release_date.strftime('%Y-%m-%d')
+            'release_date': self.release_date.strftime('%Y-%m-%d'),
+            'cast_count': self.cast_count
         }
 
     def __repr__(self):
@@ -71,20 +475,31 @@ class Movie(db.Model):
 
 class Actor(db.Model):
     __tablename__ = 'Actor'
+    __table_args__ = (
+        db.Index('ix_Actor_name_id', 'name', 'id'),
+        db.Index('ix_Actor_age_id', 'age', 'id'),
+        db.Index('ix_Actor_gender', 'gender'),
+        db.Index('ix_Actor_film_count_id', 'film_count', 'id'),
+    )
     id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
     name = Column(String(120), nullable=False)
     age = Column(db.Integer, nullable=False)
     gender = db.Column(db.String(120), nullable=False)
+    # actor_movie links of the actor, maintained by the link helpers below
+    film_count = Column(Integer, nullable=False, server_default='0')
+    sortable = ('name', 'age', 'film_count')
 
     def insert(self):
         db.session.add(self)
+        bump_versions(self.__tablename__)
         db.session.commit()
 
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        # the identity does not need a refresh of a detached instance
+        delete_row(type(self), inspect(self).identity[0])
 
     def update(self):
+        bump_versions(self.__tablename__)
         db.session.commit()
 
     def format(self):
@@ -92,8 +507,247 @@ class Actor(db.Model):
             'id': self.id,
             'name': self.name,
             'age': self.age,
-            'gender': self.gender
+            'gender': self.gender,
+            'film_count': self.film_count
         }
 
     def __repr__(self):
         return self.name
+
+
+# trigram indexes backing the case insensitive name/title searches
+event.listen(Movie.__table__, 'after_create', DDL(
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm; '
+    'CREATE INDEX "ix_Movie_title_trgm" ON "Movie" '
+    'USING gin (title gin_trgm_ops)').execute_if(dialect='postgresql'))
+event.listen(Actor.__table__, 'after_create', DDL(
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm; '
+    'CREATE INDEX "ix_Actor_name_trgm" ON "Actor" '
+    'USING gin (name gin_trgm_ops)').execute_if(dialect='postgresql'))
+
+
+'''
+    Cast links
+    Add or remove (movie_id, actor_id) pairs of actor_movie with one
+    statement per chunk, return the number of links changed. The
+    cast_count and film_count of the rows at both ends change in the
+    same transaction, by the number of links actually changed.
+'''
+
+
+def links_clause(pairs):
+    '''
+        WHERE clause matching the actor_movie rows of (movie, actor)
+        pairs, a row value IN list rather than nested ORs which SQLite
+        rejects past 1000 terms
+    '''
+    return tuple_(actor_movie.c.Movie, actor_movie.c.Actor).in_(
+        [tuple_(movie_id, actor_id) for movie_id, actor_id in pairs])
+
+
+# one expanding parameter, the statement compiles once however many pairs
+EXISTING_LINKS = select([actor_movie.c.Movie, actor_movie.c.Actor]).where(
+    tuple_(actor_movie.c.Movie, actor_movie.c.Actor).in_(
+        bindparam('pairs', expanding=True)))
+
+
+def existing_links(pairs):
+    return {tuple(row) for row in
+            db.session.execute(EXISTING_LINKS, {'pairs': list(pairs)})}
+
+
+# (model, count column, index of its id in a (movie, actor) pair)
+LINK_COUNTS = ((Movie, 'cast_count', 0), (Actor, 'film_count', 1))
+
+
+def link_count_updates(pairs, sign):
+    '''
+        UPDATE statements adding sign (1 or -1) times the number of
+        changed pairs to the counts of their movies and actors, one
+        statement per distinct delta and chunk of ids
+    '''
+    for model, name, index in LINK_COUNTS:
+        by_delta = {}
+        for row_id, delta in Counter(pair[index] for pair in pairs).items():
+            by_delta.setdefault(delta, []).append(row_id)
+        table = model.__table__
+        column = table.c[name]
+        for delta, ids in sorted(by_delta.items()):
+            for start in range(0, len(ids), BULK_INSERT_CHUNK):
+                yield table.update().where(table.c.id.in_(
+                    ids[start:start + BULK_INSERT_CHUNK])).values(
+                    {name: column + sign * delta})
+
+
+def unlinked_counts(model, row_id, linked_ids=None):
+    '''
+        UPDATE decrementing the counts of the rows linked to row_id of
+        model, run before the row and its links are deleted. The linked
+        rows are read from actor_movie unless their linked_ids are given.
+    '''
+    other, name, _ = LINK_COUNTS[1] if model is Movie else LINK_COUNTS[0]
+    table = other.__table__
+    if linked_ids is None:
+        own = actor_movie.c[model.__tablename__]
+        linked = actor_movie.c[other.__tablename__]
+        linked_ids = select([linked]).where(own == row_id)
+    return table.update().where(table.c.id.in_(linked_ids)).values(
+        {name: table.c[name] - 1})
+
+
+def row_lock(model, row_id):
+    '''SELECT ... FOR UPDATE of the row, links to it wait for the delete'''
+    table = model.__table__
+    return select([table.c.id]).where(table.c.id == row_id).with_for_update()
+
+
+def links_delete(model, row_id):
+    '''DELETE of the links of row_id returning the ids at the other end'''
+    own = actor_movie.c[model.__tablename__]
+    other = 'Actor' if model is Movie else 'Movie'
+    return actor_movie.delete().where(own == row_id).returning(
+        actor_movie.c[other])
+
+
+def unlink_row(model, row_id):
+    '''
+        Decrement the counts of the rows linked to row_id of model, in
+        the transaction deleting it. On Postgres the row is locked and
+        its links deleted with RETURNING first, so concurrent deletes of
+        the row or of its links decrement each count once. Return False
+        when the row does not exist there.
+    '''
+    if dialect_name() != 'postgresql':
+        # SQLite serialises writers, the UPDATE reads the links under
+        # the write lock
+        db.session.execute(unlinked_counts(model, row_id))
+        return True
+    if db.session.execute(row_lock(model, row_id)).first() is None:
+        return False
+    linked_ids = [row[0] for row in
+                  db.session.execute(links_delete(model, row_id))]
+    if linked_ids:
+        db.session.execute(unlinked_counts(model, row_id, linked_ids))
+    return True
+
+
+def link_count_checks():
+    '''
+        {model name: [(id, stored count, actual count)]} of the rows
+        whose count column disagrees with actor_movie
+    '''
+    mismatches = {}
+    for model, name, index in LINK_COUNTS:
+        link = actor_movie.c[model.__tablename__]
+        actual = select([link.label('id'), func.count().label('links')]
+                        ).group_by(link).alias('actual')
+        actual_count = func.coalesce(actual.c.links, 0)
+        column = getattr(model, name)
+        mismatches[model.__tablename__] = db.session.query(
+            model.id, column, actual_count).select_from(model).outerjoin(
+            actual, actual.c.id == model.id).filter(
+            column != actual_count).order_by(model.id).all()
+    return mismatches
+
+
+def refresh_link_counts():
+    '''
+        Recompute every count from actor_movie, used to backfill and to
+        repair the counts. Return the number of rows changed.
+    '''
+    changed = 0
+    try:
+        for model, name, index in LINK_COUNTS:
+            link = actor_movie.c[model.__tablename__]
+            table = model.__table__
+            actual = select([func.count()]).where(
+                link == table.c.id).as_scalar()
+            changed += db.session.execute(table.update().where(
+                table.c[name] != actual).values({name: actual})).rowcount
+        if changed:
+            bump_versions('Movie', 'Actor')
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return changed
+
+
+def insert_links(pairs):
+    '''
+        Insert the (movie, actor) pairs missing from actor_movie in the
+        current transaction, return the pairs actually inserted
+    '''
+    pairs = list(dict.fromkeys(pairs))
+    postgres = dialect_name() == 'postgresql'
+    inserted = []
+    for start in range(0, len(pairs), BULK_INSERT_CHUNK):
+        chunk = pairs[start:start + BULK_INSERT_CHUNK]
+        if postgres:
+            # RETURNING tells which rows the conflict clause skipped
+            result = db.session.execute(postgresql.insert(
+                actor_movie).values([
+                    {'Movie': movie_id, 'Actor': actor_id}
+                    for movie_id, actor_id in chunk]
+                ).on_conflict_do_nothing().returning(
+                actor_movie.c.Movie, actor_movie.c.Actor))
+            inserted.extend(tuple(row) for row in result)
+            continue
+        existing = existing_links(chunk)
+        chunk = [pair for pair in chunk if pair not in existing]
+        if chunk:
+            # executemany, compiled once rather than a bind per value
+            db.session.execute(actor_movie.insert(), [
+                {'Movie': movie_id, 'Actor': actor_id}
+                for movie_id, actor_id in chunk])
+            inserted.extend(chunk)
+    return inserted
+
+
+def add_links(pairs):
+    try:
+        changed = insert_links(pairs)
+        for statement in link_count_updates(changed, 1):
+            db.session.execute(statement)
+        if changed:
+            bump_versions('Movie', 'Actor', 'actor_movie')
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(changed)
+
+
+def remove_links(pairs):
+    pairs = list(dict.fromkeys(pairs))
+    postgres = dialect_name() == 'postgresql'
+    changed = []
+    try:
+        for start in range(0, len(pairs), BULK_INSERT_CHUNK):
+            chunk = pairs[start:start + BULK_INSERT_CHUNK]
+            statement = actor_movie.delete().where(links_clause(chunk))
+            if postgres:
+                result = db.session.execute(statement.returning(
+                    actor_movie.c.Movie, actor_movie.c.Actor))
+                changed.extend(tuple(row) for row in result)
+                continue
+            existing = existing_links(chunk)
+            if existing:
+                db.session.execute(statement)
+                changed.extend(existing)
+        for statement in link_count_updates(changed, -1):
+            db.session.execute(statement)
+        if changed:
+            bump_versions('Movie', 'Actor', 'actor_movie')
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(changed)
+
+
+def existing_ids(model, ids):
+    '''Return the subset of ids present in the model table, one IN query'''
+    return {row[0] for row in db.session.execute(
+        select([model.id]).where(model.id.in_(bindparam(
+            'ids', expanding=True))), {'ids': list(ids)})}
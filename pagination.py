@@ -0,0 +1,159 @@
+import base64
+import json
+import os
+from datetime import date
+from sqlalchemy import Date, Integer, String, tuple_
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+# offset pagination is only meant for the first pages of a listing
+MAX_OFFSET = int(os.environ.get('MAX_OFFSET', 10000))
+
+'''
+    Keyset pagination
+    Pages are ordered by (sort column, id) and the next page starts
+    after the last (value, id) pair returned, so every page is an index
+    range scan whatever its position in the listing
+'''
+
+
+class Page:
+    def __init__(self, sort, column, descending, limit, after=None,
+                 offset=0):
+        self.sort = sort
+        self.column = column
+        self.descending = descending
+        self.limit = limit
+        self.after = after
+        self.offset = offset
+
+
+def _encode_value(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _decode_value(column, value):
+    '''The cursor value as the column type, raise ValueError if it is not'''
+    # the id columns are Variant types wrapping an Integer
+    column_type = getattr(column.type, 'impl', column.type)
+    if isinstance(column_type, Date):
+        return date.fromisoformat(value)
+    if isinstance(column_type, Integer) and _is_int(value) or \
+            isinstance(column_type, String) and isinstance(value, str):
+        return value
+    raise ValueError('cursor value does not match the sort column')
+
+
+def encode_cursor(sort, value, last_id):
+    data = json.dumps([sort, _encode_value(value), last_id])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token, sort, column):
+    '''Return the (value, id) pair of a cursor, raise ValueError if invalid'''
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        cursor_sort, value, last_id = data
+        value = _decode_value(column, value)
+    except TypeError as error:
+        raise ValueError('malformed cursor') from error
+    if cursor_sort != sort or not _is_int(last_id):
+        raise ValueError('cursor does not match the sort order')
+    return value, last_id
+
+
+def _int_arg(args, name, default):
+    value = args.get(name)
+    if value is None:
+        return default
+    return int(value)
+
+
+def parse_page(args, model, sortable):
+    '''
+        Build the Page requested by the limit, sort, after and page
+        query parameters. sort is 'id' or one of the sortable columns,
+        prefixed with '-' for descending order. page selects offset
+        pagination and cannot be combined with after.
+        Raise ValueError for invalid parameters.
+    '''
+    sort = args.get('sort', 'id')
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort != 'id' and sort not in sortable:
+        raise ValueError(f'cannot sort by {sort!r}')
+    column = getattr(model, sort)
+
+    limit = _int_arg(args, 'limit', DEFAULT_PAGE_SIZE)
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError('limit out of range')
+
+    after = args.get('after')
+    page_number = _int_arg(args, 'page', None)
+    if after is not None and page_number is not None:
+        raise ValueError('after and page are mutually exclusive')
+
+    offset = 0
+    if page_number is not None:
+        offset = (page_number - 1) * limit
+        if page_number < 1 or offset > MAX_OFFSET:
+            raise ValueError('page out of range, use the after cursor')
+    if after is not None:
+        after = decode_cursor(after, sort, column)
+
+    return Page(sort, column, descending, limit, after, offset)
+
+
+def page_query(query, id_column, page):
+    '''
+        Apply the page to query, one extra row is requested to tell
+        whether a next page exists
+    '''
+    if page.sort == 'id':
+        keys = (id_column,)
+        if page.after is not None:
+            last_id = page.after[1]
+            query = query.filter(
+                id_column < last_id if page.descending
+                else id_column > last_id)
+    else:
+        keys = (page.column, id_column)
+        if page.after is not None:
+            position = tuple_(*page.after)
+            query = query.filter(
+                tuple_(*keys) < position if page.descending
+                else tuple_(*keys) > position)
+
+    order = [key.desc() if page.descending else key.asc() for key in keys]
+    query = query.order_by(*order)
+    if page.offset:
+        query = query.offset(page.offset)
+    return query.limit(page.limit + 1)
+
+
+def page_rows(rows, page):
+    '''
+        Return the rows of the page and the cursor of the next page,
+        None on the last page
+    '''
+    next_cursor = None
+    if len(rows) > page.limit:
+        rows = rows[:page.limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(
+            page.sort, getattr(last, page.sort), last.id)
+    return rows, next_cursor
+
+
+def paginate(query, id_column, page):
+    '''
+        Apply the page to query, return the rows and the cursor of the
+        next page, None on the last page
+    '''
+    return page_rows(page_query(query, id_column, page).all(), page)
@@ -0,0 +1,135 @@
+import json
+from flask import Response
+from sqlalchemy import Date
+from metrics import span
+from models import db, actor_movie, Actor, Movie
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+    Response serialization
+    List endpoints select the columns they render as tuples instead of
+    loading entities, format the dates once per distinct value and
+    encode the whole body in one call. orjson is used when it is
+    installed, the bytes are those of Flask jsonify either way.
+'''
+
+
+def _stdlib_dumps(data):
+    # Flask 1.0 jsonify: sorted keys, compact separators, ASCII only and
+    # a trailing newline
+    return (json.dumps(data, sort_keys=True, separators=(',', ':')) +
+            '\n').encode('ascii')
+
+
+def dumps(data):
+    '''Encode data to the bytes jsonify would send'''
+    with span('serialize'):
+        return _dumps(data)
+
+
+def _dumps(data):
+    if orjson is not None:
+        try:
+            body = orjson.dumps(
+                data, option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            body = None
+        # the stdlib escapes non-ASCII characters and DEL, orjson does not
+        if body is not None and body.isascii() and b'\x7f' not in body:
+            return body
+    return _stdlib_dumps(data)
+
+
+def json_response(data, status=200):
+    return Response(dumps(data), status=status, mimetype='application/json')
+
+
+def format_dates(values):
+    '''{date: 'YYYY-MM-DD'} for a batch of dates, one strftime per value'''
+    return {value: value.strftime('%Y-%m-%d') for value in set(values)}
+
+
+class ModelSerializer:
+    '''
+        Fields of a model selected as tuples and rendered as the dicts
+        the model format() method builds. hidden fields are selected
+        after them, for pagination or links, but not rendered.
+    '''
+
+    def __init__(self, model, fields, hidden=()):
+        self.model = model
+        self.fields = tuple(fields)
+        self.columns = tuple(getattr(model, field)
+                             for field in self.fields + tuple(hidden))
+        self._dates = tuple(index for index, column in enumerate(
+            self.columns[:len(self.fields)]) if isinstance(
+            column.type, Date))
+
+    def project(self, fields=None, required=()):
+        '''
+            Serializer rendering only fields, the comma separated value
+            of a fields= parameter, and selecting the required fields
+            too. Raise ValueError for fields the model does not render.
+        '''
+        if fields is None:
+            return self
+        names = []
+        for name in fields.split(','):
+            name = name.strip()
+            if name not in self.fields:
+                raise ValueError(f'unknown field {name!r}')
+            if name not in names:
+                names.append(name)
+        hidden = [name for name in dict.fromkeys(required)
+                  if name not in names]
+        return ModelSerializer(self.model, names, hidden)
+
+    def query(self):
+        return db.session.query(*self.columns)
+
+    def format(self, rows):
+        # zip stops at the rendered fields, hidden columns come last
+        fields = self.fields
+        if not self._dates:
+            return [dict(zip(fields, row)) for row in rows]
+
+        dates = self._dates
+        formatted = format_dates(
+            row[index] for row in rows for index in dates)
+        items = []
+        for row in rows:
+            row = list(row)
+            for index in dates:
+                row[index] = formatted[row[index]]
+            items.append(dict(zip(fields, row)))
+        return items
+
+
+movie_serializer = ModelSerializer(
+    Movie, ('id', 'title', 'release_date', 'cast_count'))
+actor_serializer = ModelSerializer(
+    Actor, ('id', 'name', 'age', 'gender', 'film_count'))
+
+
+def linked(serializer, link_column, ids):
+    '''
+        {id: [items of serializer]} for the rows linked to ids through
+        actor_movie, link_column is the actor_movie column holding ids.
+        One query whatever the number of ids.
+    '''
+    result = {row_id: [] for row_id in ids}
+    if not result:
+        return result
+    model = serializer.model
+    rows = db.session.query(link_column, *serializer.columns).select_from(
+        model).join(actor_movie,
+                    actor_movie.c[model.__tablename__] == model.id).filter(
+        link_column.in_(ids)).order_by(model.id).all()
+    items = serializer.format([row[1:] for row in rows])
+    for row, item in zip(rows, items):
+        result[row[0]].append(item)
+    return result
@@ -0,0 +1,117 @@
+import os
+from sqlalchemy import extract, func, select
+from models import db, actor_movie, Actor, Movie
+from validation import parse_int
+
+# default and maximum width in years of the actor age buckets
+STATS_AGE_BUCKET = int(os.environ.get('STATS_AGE_BUCKET', 10))
+MAX_AGE_BUCKET = 100
+
+'''
+    Aggregate statistics
+    Every figure of GET /stats/actors and /stats/movies is a COUNT, MIN,
+    MAX or AVG grouped in SQL, so a handful of rows come back whatever
+    the table sizes. Cast sizes and films per actor group the
+    cast_count and film_count columns instead of joining actor_movie.
+    The statements are plain SQLAlchemy selects run by the Flask
+    session or the async database of asgi.py alike.
+'''
+
+
+def parse_age_bucket(args):
+    '''The age_bucket query parameter, raise ValueError when invalid'''
+    value = args.get('age_bucket')
+    if value is None:
+        return STATS_AGE_BUCKET
+    bucket = parse_int(value)
+    if not bucket or bucket > MAX_AGE_BUCKET:
+        raise ValueError('age_bucket out of range')
+    return bucket
+
+
+def _links():
+    return select([func.count()]).select_from(actor_movie)
+
+
+def actor_statements(bucket):
+    # integer division on both SQLite and Postgres, ages are positive
+    start = (Actor.age / bucket * bucket).label('start')
+    return {
+        'summary': select([func.count(Actor.id), func.min(Actor.age),
+                           func.max(Actor.age), func.avg(Actor.age)]),
+        'links': _links(),
+        'genders': select([Actor.gender, func.count()]).group_by(
+            Actor.gender).order_by(Actor.gender),
+        # grouped by the output label, the bucket width is a parameter
+        'ages': select([start, func.count()]).group_by('start').order_by(
+            'start'),
+        'films': select([Actor.film_count, func.count()]).group_by(
+            Actor.film_count).order_by(Actor.film_count),
+    }
+
+
+def movie_statements():
+    year = extract('year', Movie.release_date).label('year')
+    return {
+        'summary': select([func.count(Movie.id),
+                           func.min(Movie.release_date),
+                           func.max(Movie.release_date)]),
+        'links': _links(),
+        'years': select([year, func.count()]).group_by('year').order_by(
+            'year'),
+        'cast_sizes': select([Movie.cast_count, func.count()]).group_by(
+            Movie.cast_count).order_by(Movie.cast_count),
+    }
+
+
+def execute(statements):
+    '''{name: rows} of the statements run by the Flask session'''
+    return {name: db.session.execute(statement).fetchall()
+            for name, statement in statements.items()}
+
+
+def _average(total, count):
+    return round(total / count, 2) if count else None
+
+
+def _date(value):
+    if value is None or isinstance(value, str):
+        return value
+    return value.strftime('%Y-%m-%d')
+
+
+def actor_stats(results, bucket):
+    total, youngest, oldest, average = results['summary'][0]
+    return {
+        'total': total,
+        'age': {
+            'min': youngest,
+            'max': oldest,
+            'average': None if average is None else round(float(average), 2),
+        },
+        'genders': [{'gender': gender, 'count': count}
+                    for gender, count in results['genders']],
+        'ages': [{'min': start, 'max': start + bucket - 1, 'count': count}
+                 for start, count in results['ages']],
+        'films': {
+            'average': _average(results['links'][0][0], total),
+            'distribution': [{'films': films, 'actors': count}
+                             for films, count in results['films']],
+        },
+    }
+
+
+def movie_stats(results):
+    total, first, last = results['summary'][0]
+    return {
+        'total': total,
+        'release_date': {'min': _date(first), 'max': _date(last)},
+        # EXTRACT returns a double precision on Postgres
+        'years': [{'year': int(year), 'count': count}
+                  for year, count in results['years']],
+        'cast': {
+            'average': _average(results['links'][0][0], total),
+            'distribution': [{'cast_size': size, 'movies': count}
+                             for size, count in results['cast_sizes']],
+        },
+    }
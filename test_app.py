@@ -1,10 +1,78 @@
 import unittest
+import base64
 import json
+import time
+from Crypto.PublicKey import RSA
 from flask_sqlalchemy import SQLAlchemy
+from jose import jwt
+from sqlalchemy import create_engine, event, exc
 from app import create_app
-from models import setup_db, Actor, Movie
+from flask import jsonify
+from models import (setup_db, db, actor_movie, add_links, delete_row,
+                    get_versions, engine_options, link_count_checks,
+                    pool_stats,
+                    refresh_link_counts, InstrumentedQueuePool,
+                    ReplicaSet, TableVersion, Actor, Movie)
+from pagination import encode_cursor
+import compression
+import metrics
+import serializers
+from bench import report as bench_report, workload as bench_workload
+from bench.auth import ALL_PERMISSIONS
+from bench.seed import seed
+from serializers import dumps, movie_serializer
+import auth
+from importer import ImportFileError, import_file
+from cache import MemoryBackend, SharedBackend, response_cache
+from auth import (AUTH0_DOMAIN, API_AUDIENCE, AuthError, JWKSStore,
+                  TokenCache, VerifiedPayload, check_permissions,
+                  compile_permission, requires_auth)
+import gzip
+import io
 import os
-from datetime import datetime
+import sys
+import tempfile
+try:
+    import asyncio
+    import httpx
+    import asgi
+except ImportError:
+    asgi = None
+from datetime import date, datetime
+
+
+# Local signing key standing in for the Auth0 tenant
+LOCAL_KID = 'local-test-key'
+local_key = RSA.generate(2048)
+
+
+def b64_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def local_jwks():
+    return {'keys': [{
+        'kty': 'RSA',
+        'kid': LOCAL_KID,
+        'use': 'sig',
+        'n': b64_int(local_key.n),
+        'e': b64_int(local_key.e),
+    }]}
+
+
+def make_token(permissions, expires_in=3600, kid=LOCAL_KID):
+    now = int(time.time())
+    claims = {
+        'iss': 'https://' + AUTH0_DOMAIN + '/',
+        'sub': 'local|test',
+        'aud': API_AUDIENCE,
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': permissions,
+    }
+    return jwt.encode(claims, local_key.exportKey('PEM').decode('ascii'),
+                      algorithm='RS256', headers={'kid': kid})
 
 
 class AgencyTestCase(unittest.TestCase):
@@ -342,6 +410,1698 @@ class AgencyTestCase(unittest.TestCase):
         self.assertTrue(new_movie)
 
 
+class JWKSStoreTestCase(unittest.TestCase):
+    """This class represents the JWKS key store test case"""
+
+    def setUp(self):
+        self.fetches = 0
+        self.fail_fetch = False
+        self.jwks = {'keys': [self.make_key('key-1')]}
+        self.store = JWKSStore(fetcher=self.fetcher, ttl=60,
+                               min_refetch_interval=0, background=False)
+
+    def make_key(self, kid):
+        return {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n', 'e': 'e'}
+
+    def fetcher(self):
+        self.fetches += 1
+        if self.fail_fetch:
+            raise OSError('identity provider unavailable')
+        return self.jwks
+
+    def test_keys_are_cached(self):
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.fetches, 1)
+
+    def test_unknown_kid_refetches_once(self):
+        self.store.get_key('key-1')
+        self.jwks = {'keys': [self.make_key('key-1'), self.make_key('key-2')]}
+        self.assertEqual(self.store.get_key('key-2')['kid'], 'key-2')
+        self.assertEqual(self.fetches, 2)
+        self.assertIsNone(self.store.get_key('key-3'))
+        self.assertEqual(self.fetches, 3)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.store.min_refetch_interval = 60
+        self.store.get_key('key-1')
+        self.assertIsNone(self.store.get_key('key-2'))
+        self.assertIsNone(self.store.get_key('key-2'))
+        self.assertEqual(self.fetches, 1)
+
+    def test_stale_keys_served_when_fetch_fails(self):
+        self.store.get_key('key-1')
+        self.store.ttl = 0
+        self.fail_fetch = True
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.fetches, 2)
+
+    def test_expired_key_set_is_refreshed(self):
+        self.store.get_key('key-1')
+        self.store.ttl = 0
+        self.jwks = {'keys': [self.make_key('key-2')]}
+        self.assertIsNone(self.store.get_key('key-1'))
+        self.assertEqual(self.store.get_key('key-2')['kid'], 'key-2')
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        self.now = 1000
+        self.cache = TokenCache(maxsize=2, clock=lambda: self.now)
+
+    def test_hit_and_miss_counters(self):
+        self.assertIsNone(self.cache.get('token-a'))
+        self.cache.set('token-a', {'exp': 2000})
+        self.assertEqual(self.cache.get('token-a'), {'exp': 2000})
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_entry_evicted_at_exp(self):
+        self.cache.set('token-a', {'exp': 2000})
+        self.now = 2000
+        self.assertIsNone(self.cache.get('token-a'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_least_recently_used_evicted_at_size_limit(self):
+        self.cache.set('token-a', {'exp': 2000})
+        self.cache.set('token-b', {'exp': 2000})
+        self.cache.get('token-a')
+        self.cache.set('token-c', {'exp': 2000})
+        self.assertIsNotNone(self.cache.get('token-a'))
+        self.assertIsNone(self.cache.get('token-b'))
+
+    def test_token_without_exp_not_cached(self):
+        self.cache.set('token-a', {'permissions': []})
+        self.assertIsNone(self.cache.get('token-a'))
+
+
+class PermissionTestCase(unittest.TestCase):
+    """This class represents the compiled permission test case"""
+
+    def payload(self, *permissions):
+        return VerifiedPayload({'permissions': list(permissions)})
+
+    def test_single_permission(self):
+        permission = compile_permission('get:movies')
+        self.assertTrue(
+            check_permissions(permission, self.payload('get:movies')))
+        with self.assertRaises(AuthError) as error:
+            check_permissions(permission, self.payload('get:actors'))
+        self.assertEqual(error.exception.status_code, 403)
+
+    def test_and_combination(self):
+        permission = compile_permission('post:movies & post:actors')
+        self.assertTrue(check_permissions(
+            permission, self.payload('post:actors', 'post:movies')))
+        with self.assertRaises(AuthError):
+            check_permissions(permission, self.payload('post:movies'))
+
+    def test_or_combination(self):
+        permission = compile_permission(
+            'delete:movies | patch:movies & patch:actors')
+        self.assertTrue(
+            check_permissions(permission, self.payload('delete:movies')))
+        self.assertTrue(check_permissions(
+            permission, self.payload('patch:actors', 'patch:movies')))
+        with self.assertRaises(AuthError):
+            check_permissions(permission, self.payload('patch:movies'))
+
+    def test_scope_compiled_after_payload(self):
+        payload = self.payload('get:movies', 'read:reports')
+        check_permissions('get:movies', payload)
+        self.assertTrue(check_permissions('read:reports', payload))
+
+    def test_plain_dict_payload(self):
+        self.assertTrue(
+            check_permissions('get:movies', {'permissions': ['get:movies']}))
+
+    def test_missing_permissions_claim(self):
+        with self.assertRaises(AuthError) as error:
+            check_permissions('get:movies', VerifiedPayload({}))
+        self.assertEqual(error.exception.status_code, 400)
+
+    def test_invalid_permission(self):
+        with self.assertRaises(ValueError):
+            compile_permission('get:movies |')
+
+
+class LocalAppTestCase(unittest.TestCase):
+    """Base test case authenticating with tokens signed with a local key"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.fetches = 0
+        self.jwks_store = auth.jwks_store
+        auth.jwks_store = JWKSStore(fetcher=self.fetcher, background=False)
+        auth.token_cache.clear()
+        response_cache.clear()
+
+    def tearDown(self):
+        auth.jwks_store = self.jwks_store
+        auth.token_cache.clear()
+
+    def fetcher(self):
+        self.fetches += 1
+        return local_jwks()
+
+    def get(self, path, token):
+        return self.client().get(path, headers={
+            "Authorization": "Bearer {}".format(token)})
+
+    def count_queries(self, request, *args, **kwargs):
+        res, statements = self.count_statements(request, *args, **kwargs)
+        return res, len(statements)
+
+    def count_statements(self, request, *args, **kwargs):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        # connections opened before the listener do not see it
+        db.session.remove()
+        event.listen(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            res = request(*args, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        return res, statements
+
+
+class LocalAuthTestCase(LocalAppTestCase):
+    """This class represents the requires_auth test case
+    using tokens signed with a local key"""
+
+    def test_reused_token_verified_once(self):
+        token = make_token(['get:movies'])
+        for _ in range(3):
+            res = self.get('/movies', token)
+            self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(auth.token_cache.stats()['misses'], 1)
+        self.assertEqual(auth.token_cache.stats()['hits'], 2)
+
+    def test_cached_token_still_checks_permissions(self):
+        token = make_token(['get:movies'])
+        self.assertEqual(self.get('/movies', token).status_code, 200)
+        res = self.get('/actors', token)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(
+            data['message'],
+            {'code': 'unauthorized', 'description': 'Permission not found.'})
+
+    def test_requires_auth_with_combined_permission(self):
+        @requires_auth('get:movies | get:actors')
+        def view(payload):
+            return payload['sub']
+
+        token = make_token(['get:actors'])
+        with self.app.test_request_context(headers={
+                "Authorization": "Bearer {}".format(token)}):
+            self.assertEqual(view(), 'local|test')
+
+    def test_expired_token_rejected(self):
+        res = self.get('/movies', make_token(['get:movies'], expires_in=-60))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['message']['code'], 'token_expired')
+        self.assertEqual(auth.token_cache.stats()['size'], 0)
+
+
+class PaginationTestCase(LocalAppTestCase):
+    """This class represents the keyset pagination test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.token = make_token(['get:movies', 'get:actors'])
+        for age in (41, 23, 23, 67, 35):
+            Actor(name='pagination actor', age=age, gender='female').insert()
+
+    def tearDown(self):
+        for actor in Actor.query.filter(
+                Actor.name == 'pagination actor').all():
+            actor.delete()
+        super().tearDown()
+
+    def walk(self, query):
+        pages, items, cursor = 0, [], None
+        while True:
+            path = '/actors?' + query
+            if cursor:
+                path += '&after=' + cursor
+            data = json.loads(self.get(path, self.token).data)
+            pages += 1
+            items.extend(data['actors'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                return pages, items
+
+    def test_cursor_walks_every_row_once(self):
+        pages, actors = self.walk('limit=2')
+        ids = [actor['id'] for actor in actors]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(ids), Actor.query.count())
+        self.assertGreaterEqual(pages, 3)
+
+    def test_cursor_with_sort_column(self):
+        pages, actors = self.walk('limit=2&sort=-age')
+        keys = [(actor['age'], actor['id']) for actor in actors]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+        self.assertEqual(len(keys), len(set(keys)))
+
+    def test_offset_pagination(self):
+        first = json.loads(self.get('/actors?limit=2', self.token).data)
+        second = json.loads(
+            self.get('/actors?limit=2&page=2', self.token).data)
+        cursor = json.loads(self.get(
+            '/actors?limit=2&after=' + first['next_cursor'],
+            self.token).data)
+        self.assertEqual(second['actors'], cursor['actors'])
+
+    def test_400_for_invalid_page_parameters(self):
+        for query in ('limit=0', 'limit=abc', 'sort=gender', 'after=xyz',
+                      'page=0', 'page=1&after=xyz'):
+            res = self.get('/actors?' + query, self.token)
+            self.assertEqual(res.status_code, 400, query)
+
+    def test_400_for_cursor_of_other_sort(self):
+        data = json.loads(self.get('/actors?limit=1', self.token).data)
+        res = self.get('/actors?sort=age&after=' + data['next_cursor'],
+                       self.token)
+        self.assertEqual(res.status_code, 400)
+
+    def test_400_for_cursor_value_of_other_type(self):
+        for sort, value, last_id in (('title', [1, 2], 5),
+                                     ('title', {'a': 1}, 5),
+                                     ('release_date', 5, 5),
+                                     ('cast_count', '3', 5),
+                                     ('id', True, True)):
+            res = self.get('/movies?sort={}&after={}'.format(
+                sort, encode_cursor(sort, value, last_id)), self.token)
+            self.assertEqual(res.status_code, 400, (sort, value))
+
+
+class ExportTestCase(LocalAppTestCase):
+    """This class represents the NDJSON export test case"""
+
+    def test_export_movies(self):
+        res = self.get('/movies/export', make_token(['get:movies']))
+        lines = res.data.decode('utf-8').splitlines()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), Movie.query.count())
+        movies = [json.loads(line) for line in lines]
+        self.assertEqual(movies[0], Movie.query.order_by(
+            Movie.id).first().format())
+
+    def test_export_actors(self):
+        res = self.get('/actors/export', make_token(['get:actors']))
+        lines = res.data.decode('utf-8').splitlines()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(lines), Actor.query.count())
+
+    def test_export_requires_permission(self):
+        res = self.get('/actors/export', make_token(['get:movies']))
+        self.assertEqual(res.status_code, 401)
+
+
+class CastTestCase(LocalAppTestCase):
+    """This class represents the cast and filmography test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.token = make_token(['get:movies', 'get:actors'])
+        release_date = datetime.strptime('2001-01-01', '%Y-%m-%d')
+        self.movies = [Movie(title='cast movie', release_date=release_date)
+                       for _ in range(3)]
+        self.actors = [Actor(name='cast actor', age=30, gender='male')
+                       for _ in range(3)]
+        for item in self.movies + self.actors:
+            item.insert()
+        add_links([(movie.id, actor.id) for movie in self.movies
+                   for actor in self.actors[:2]])
+        # requests end the shared session and detach the instances
+        self.movie_ids = [movie.id for movie in self.movies]
+        self.actor_ids = [actor.id for actor in self.actors]
+
+    def tearDown(self):
+        for item in self.movies + self.actors:
+            item.delete()
+        super().tearDown()
+
+    def test_get_movie_actors(self):
+        res = self.get('/movies/{}/actors'.format(self.movie_ids[0]),
+                       self.token)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['actors']],
+                         self.actor_ids[:2])
+
+    def test_get_actor_movies(self):
+        res = self.get('/actors/{}/movies'.format(self.actor_ids[0]),
+                       self.token)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']],
+                         self.movie_ids)
+
+    def test_404_cast_of_missing_movie(self):
+        res = self.get('/movies/999999/actors', self.token)
+        self.assertEqual(res.status_code, 404)
+
+    def test_include_cast_constant_queries(self):
+        after = self.movies[0].id - 1
+        path = '/movies?limit={}&after={}'
+        res, few = self.count_queries(
+            self.get, path.format(1, self.cursor(after)) + '&include=cast',
+            self.token)
+        res, many = self.count_queries(
+            self.get, path.format(3, self.cursor(after)) + '&include=cast',
+            self.token)
+        data = json.loads(res.data)
+        self.assertEqual(few, many)
+        self.assertEqual(len(data['movies']), 3)
+        for movie in data['movies']:
+            self.assertEqual(len(movie['actors']), 2)
+
+    def test_include_movies_on_actors(self):
+        path = '/actors?limit=3&include=movies&after=' + self.cursor(
+            self.actors[0].id - 1)
+        data = json.loads(self.get(path, self.token).data)
+        self.assertEqual(len(data['actors'][0]['movies']), 3)
+        self.assertEqual(data['actors'][2]['movies'], [])
+
+    def test_400_for_unknown_include(self):
+        res = self.get('/movies?include=crew', self.token)
+        self.assertEqual(res.status_code, 400)
+
+    def cursor(self, last_id):
+        return encode_cursor('id', last_id, last_id)
+
+
+class BulkCreateTestCase(LocalAppTestCase):
+    """This class represents the bulk create test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.token = make_token(['post:movies', 'post:actors'])
+
+    def post(self, path, body):
+        return self.client().post(path, json=body, headers={
+            "Authorization": "Bearer {}".format(self.token)})
+
+    def test_bulk_create_movies(self):
+        res = self.post('/movies/bulk', [
+            {'title': 'bulk movie 1', 'release_date': '2001-02-03'},
+            {'title': 'bulk movie 2', 'release_date': '2004-05-06'},
+        ])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        movies = [Movie.query.get(movie_id) for movie_id in data['movie_ids']]
+        self.assertEqual([movie.title for movie in movies],
+                         ['bulk movie 1', 'bulk movie 2'])
+        self.assertEqual(movies[1].format()['release_date'], '2004-05-06')
+        for movie in movies:
+            movie.delete()
+
+    def test_bulk_create_actors(self):
+        res = self.post('/actors/bulk', [
+            {'name': 'bulk actor 1', 'age': 30, 'gender': 'female'},
+            {'name': 'bulk actor 2', 'age': '41', 'gender': 'male'},
+        ])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        actors = [Actor.query.get(actor_id) for actor_id in data['actor_ids']]
+        self.assertEqual([actor.age for actor in actors], [30, 41])
+        for actor in actors:
+            actor.delete()
+
+    def test_422_reports_errors_per_item(self):
+        count = Movie.query.count()
+        res = self.post('/movies/bulk', [
+            {'title': 'bulk movie ok', 'release_date': '2001-02-03'},
+            {'title': 'bulk movie bad', 'release_date': '2001-02-30'},
+            {'release_date': '2001-02-03'},
+            'not a movie',
+        ])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual([error['index'] for error in data['errors']],
+                         [1, 2, 3])
+        self.assertIn('release_date', data['errors'][0]['fields'])
+        self.assertIn('title', data['errors'][1]['fields'])
+        self.assertEqual(Movie.query.count(), count)
+
+    def test_422_for_non_ascii_digits(self):
+        res = self.post('/actors/bulk', [
+            {'name': 'bulk actor', 'age': '\u00b2', 'gender': 'male'}])
+        self.assertEqual(res.status_code, 422)
+        self.assertIn('age', json.loads(res.data)['errors'][0]['fields'])
+
+    def test_400_for_bulk_body_not_a_list(self):
+        res = self.post('/actors/bulk', {'name': 'bulk actor'})
+        self.assertEqual(res.status_code, 400)
+        res = self.post('/actors/bulk', [])
+        self.assertEqual(res.status_code, 400)
+
+
+class CastAssignmentTestCase(LocalAppTestCase):
+    """This class represents the POST /movies/actors test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.token = make_token(['post:movies_actors'])
+        release_date = datetime.strptime('2001-01-01', '%Y-%m-%d')
+        self.movie = Movie(title='assignment movie',
+                           release_date=release_date)
+        self.movie.insert()
+        self.actors = [Actor(name='assignment actor', age=30, gender='male')
+                       for _ in range(3)]
+        for actor in self.actors:
+            actor.insert()
+        self.movie_id = self.movie.id
+        self.actor_ids = [actor.id for actor in self.actors]
+
+    def tearDown(self):
+        Movie.query.get(self.movie_id).delete()
+        for actor_id in self.actor_ids:
+            Actor.query.get(actor_id).delete()
+        super().tearDown()
+
+    def post(self, body):
+        return self.client().post('/movies/actors', json=body, headers={
+            "Authorization": "Bearer {}".format(self.token)})
+
+    def links(self, actor_ids):
+        return [{'movie_id': self.movie_id, 'actor_id': actor_id}
+                for actor_id in actor_ids]
+
+    def cast(self):
+        return sorted(row[0] for row in db.session.query(
+            actor_movie.c.Actor).filter(actor_movie.c.Movie == self.movie_id))
+
+    def test_single_link_is_additive(self):
+        for link in self.links(self.actor_ids[:2]):
+            res = self.post(link)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['movie_id'], self.movie_id)
+        self.assertEqual(self.cast(), self.actor_ids[:2])
+
+    def test_batch_add_ignores_existing_links(self):
+        self.post(self.links(self.actor_ids[:1])[0])
+        res, queries = self.count_queries(
+            self.post, {'links': self.links(self.actor_ids)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['links'], 3)
+        self.assertEqual(data['changed'], 2)
+        self.assertEqual(self.cast(), self.actor_ids)
+        # existence checks, existing links, insert, the cast_count and
+        # film_count updates and the version bump
+        self.assertLessEqual(queries, 7)
+
+    def test_batch_remove(self):
+        self.post(self.links(self.actor_ids))
+        res = self.post({'links': self.links(self.actor_ids[1:]),
+                         'mode': 'remove'})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['changed'], 2)
+        self.assertEqual(self.cast(), self.actor_ids[:1])
+
+    def test_404_if_any_actor_does_not_exist(self):
+        links = self.links(self.actor_ids)
+        links.append({'movie_id': self.movie_id, 'actor_id': 999999})
+        res = self.post(links)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(self.cast(), [])
+
+    def test_400_for_invalid_links(self):
+        self.assertEqual(self.post({'movie_id': self.movie_id}).status_code,
+                         400)
+        self.assertEqual(self.post({'links': self.links(self.actor_ids),
+                                    'mode': 'replace'}).status_code, 400)
+        self.assertEqual(self.post({'links': []}).status_code, 400)
+        self.assertEqual(self.post({'movie_id': '\u00b2',
+                                    'actor_id': self.actor_ids[0]}
+                                   ).status_code, 400)
+
+
+class ConditionalGetTestCase(LocalAppTestCase):
+    """This class represents the ETag / conditional GET test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.token = make_token(['get:movies', 'get:actors', 'patch:actors'])
+
+    def get_if_none_match(self, path, etag):
+        return self.client().get(path, headers={
+            "Authorization": "Bearer {}".format(self.token),
+            "If-None-Match": '"{}"'.format(etag)})
+
+    def test_304_without_reading_rows(self):
+        etag = self.get('/actors', self.token).get_etag()[0]
+        res, queries = self.count_queries(
+            self.get_if_none_match, '/actors', etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.get_etag()[0], etag)
+        self.assertEqual(queries, 1)
+
+    def test_etag_changes_after_write(self):
+        etag = self.get('/actors', self.token).get_etag()[0]
+        actor = Actor(name='etag actor', age=30, gender='male')
+        actor.insert()
+        res = self.get_if_none_match('/actors', etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.get_etag()[0], etag)
+        actor.delete()
+
+    def test_etag_depends_on_query_parameters(self):
+        first = self.get('/movies?limit=1', self.token).get_etag()[0]
+        second = self.get('/movies?limit=2', self.token).get_etag()[0]
+        self.assertNotEqual(first, second)
+
+    def test_unrelated_write_keeps_etag(self):
+        etag = self.get('/actors', self.token).get_etag()[0]
+        movie = Movie(title='etag movie',
+                      release_date=datetime.strptime('2001-01-01',
+                                                     '%Y-%m-%d'))
+        movie.insert()
+        res = self.get_if_none_match('/actors', etag)
+        self.assertEqual(res.status_code, 304)
+        movie.delete()
+
+
+class FakeSharedStore:
+    """Local stand-in for the redis client of the shared backend"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+
+class ResponseCacheTestCase(LocalAppTestCase):
+    """This class represents the response cache test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.token = make_token(['get:movies', 'get:actors',
+                                 'post:movies_actors'])
+
+    def test_memory_backend_lru_bounded_by_size(self):
+        backend = MemoryBackend(max_bytes=20)
+        backend.set('a', b'12345678', ('Movie',))
+        backend.set('b', b'12345678', ('Movie',))
+        backend.get('a')
+        backend.set('c', b'12345678', ('Actor',))
+        self.assertEqual(backend.get('a'), b'12345678')
+        self.assertIsNone(backend.get('b'))
+        self.assertLessEqual(backend.size, 20)
+
+    def test_memory_backend_invalidates_tables(self):
+        backend = MemoryBackend()
+        backend.set('movies', b'[]', ('Movie',))
+        backend.set('cast', b'[]', ('Movie', 'actor_movie', 'Actor'))
+        backend.set('actors', b'[]', ('Actor',))
+        backend.invalidate({'actor_movie'})
+        self.assertIsNotNone(backend.get('movies'))
+        self.assertIsNone(backend.get('cast'))
+        self.assertIsNotNone(backend.get('actors'))
+
+    def test_second_request_served_from_cache(self):
+        first = self.get('/movies?limit=5', self.token)
+        res, queries = self.count_queries(
+            self.get, '/movies?limit=5', self.token)
+        self.assertEqual(res.data, first.data)
+        self.assertEqual(res.get_etag(), first.get_etag())
+        self.assertEqual(queries, 1)
+        self.assertEqual(response_cache.hits, 1)
+
+    def test_write_invalidates_cached_list(self):
+        self.get('/actors?sort=-age&limit=1', self.token)
+        actor = Actor(name='cache actor', age=150, gender='male')
+        actor.insert()
+        data = json.loads(
+            self.get('/actors?sort=-age&limit=1', self.token).data)
+        self.assertEqual(data['actors'][0]['name'], 'cache actor')
+        actor.delete()
+
+    def test_link_write_invalidates_cast(self):
+        movie_id = Movie.query.order_by(Movie.id).first().id
+        actor_id = Actor.query.order_by(Actor.id).first().id
+        path = '/movies/{}/actors'.format(movie_id)
+        before = json.loads(self.get(path, self.token).data)['actors']
+        self.client().post('/movies/actors', json={
+            'links': [{'movie_id': movie_id, 'actor_id': actor_id}],
+            'mode': 'remove' if before else 'add'}, headers={
+            "Authorization": "Bearer {}".format(self.token)})
+        after = json.loads(self.get(path, self.token).data)['actors']
+        self.assertNotEqual(before, after)
+
+    def test_shared_backend(self):
+        store = FakeSharedStore()
+        response_cache.backend = SharedBackend(store, prefix='test:')
+        try:
+            first = self.get('/actors?limit=3', self.token)
+            self.assertEqual(len(store.data), 1)
+            res, queries = self.count_queries(
+                self.get, '/actors?limit=3', self.token)
+            self.assertEqual(res.data, first.data)
+            self.assertEqual(queries, 1)
+        finally:
+            response_cache.backend = MemoryBackend()
+
+
+class SearchTestCase(LocalAppTestCase):
+    """This class represents the search and filter test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.token = make_token(['get:movies', 'get:actors'])
+        self.actors = [
+            Actor(name='Search_Ada Lovelace', age=36, gender='female'),
+            Actor(name='Search_Alan Turing', age=41, gender='male'),
+            Actor(name='search_grace Hopper', age=85, gender='female'),
+        ]
+        self.movies = [
+            Movie(title='Search 100% Movie',
+                  release_date=datetime.strptime('1990-06-01', '%Y-%m-%d')),
+            Movie(title='Search Other',
+                  release_date=datetime.strptime('2010-06-01', '%Y-%m-%d')),
+        ]
+        for item in self.actors + self.movies:
+            item.insert()
+
+    def tearDown(self):
+        for item in self.actors + self.movies:
+            item.delete()
+        super().tearDown()
+
+    def names(self, query):
+        res = self.get('/actors?limit=1000&' + query, self.token)
+        self.assertEqual(res.status_code, 200)
+        return [actor['name'] for actor in json.loads(res.data)['actors']]
+
+    def titles(self, query):
+        res = self.get('/movies?limit=1000&' + query, self.token)
+        self.assertEqual(res.status_code, 200)
+        return [movie['title'] for movie in json.loads(res.data)['movies']]
+
+    def test_name_prefix_is_case_insensitive(self):
+        self.assertEqual(len(self.names('name=SEARCH_')), 3)
+        self.assertEqual(self.names('name=search_a&sort=name'),
+                         ['Search_Ada Lovelace', 'Search_Alan Turing'])
+
+    def test_name_contains(self):
+        self.assertEqual(self.names('name_contains=HOPPER'),
+                         ['search_grace Hopper'])
+
+    def test_gender_and_age_range(self):
+        self.assertEqual(
+            self.names('name=search_&gender=female&age_min=30&age_max=40'),
+            ['Search_Ada Lovelace'])
+
+    def test_like_wildcards_are_literal(self):
+        self.assertEqual(self.titles('title_contains=100%25'),
+                         ['Search 100% Movie'])
+        self.assertEqual(self.names('name=search%25'), [])
+
+    def test_release_date_range(self):
+        self.assertEqual(
+            self.titles('title=search&released_after=2000-01-01'),
+            ['Search Other'])
+        self.assertEqual(
+            self.titles('title=search&released_before=1990-06-01'),
+            ['Search 100% Movie'])
+
+    def test_filtered_export(self):
+        res = self.get('/actors/export?gender=female&name=search',
+                       self.token)
+        self.assertEqual(len(res.data.splitlines()), 2)
+
+    def test_400_for_invalid_filters(self):
+        for path in ('/actors?age_min=old', '/movies?released_after=2001',
+                     '/movies/export?released_before=x'):
+            self.assertEqual(self.get(path, self.token).status_code, 400)
+
+
+class CascadeDeleteTestCase(LocalAppTestCase):
+    """This class represents the actor_movie cascade test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.token = make_token(['delete:movies', 'delete:actors'])
+        self.movie = Movie(title='cascade movie',
+                           release_date=datetime.strptime('2001-01-01',
+                                                          '%Y-%m-%d'))
+        self.movie.insert()
+        self.actor = Actor(name='cascade actor', age=30, gender='male')
+        self.actor.insert()
+        self.movie_id, self.actor_id = self.movie.id, self.actor.id
+        add_links([(self.movie_id, self.actor_id)])
+
+    def tearDown(self):
+        for item in (Movie.query.get(self.movie_id),
+                     Actor.query.get(self.actor_id)):
+            if item is not None:
+                item.delete()
+        super().tearDown()
+
+    def delete(self, path):
+        return self.client().delete(path, headers={
+            "Authorization": "Bearer {}".format(self.token)})
+
+    def links(self):
+        return db.session.query(actor_movie).filter(
+            (actor_movie.c.Movie == self.movie_id) |
+            (actor_movie.c.Actor == self.actor_id)).count()
+
+    def assert_deleted_by_cascade(self, path):
+        res, statements = self.count_statements(self.delete, path)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.links(), 0)
+        # actor_movie is only read to decrement the counts of the other end
+        self.assertFalse([statement for statement in statements
+                          if statement.startswith('DELETE FROM actor_movie')
+                          or statement.startswith('SELECT') and
+                          'FROM actor_movie' in statement])
+
+    def test_delete_movie_cascades_links(self):
+        self.assert_deleted_by_cascade('/movies/{}'.format(self.movie_id))
+        self.assertEqual(db.session.query(Actor.film_count).filter(
+            Actor.id == self.actor_id).scalar(), 0)
+
+    def test_delete_actor_cascades_links(self):
+        self.assert_deleted_by_cascade('/actors/{}'.format(self.actor_id))
+        self.assertEqual(db.session.query(Movie.cast_count).filter(
+            Movie.id == self.movie_id).scalar(), 0)
+
+
+class SingleStatementWriteTestCase(LocalAppTestCase):
+    """This class represents the PATCH and DELETE round trip test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.token = make_token(['patch:actors', 'delete:actors'])
+        actor = Actor(name='statement actor', age=30, gender='male')
+        actor.insert()
+        self.actor_id = actor.id
+
+    def tearDown(self):
+        actor = Actor.query.get(self.actor_id)
+        if actor is not None:
+            actor.delete()
+        super().tearDown()
+
+    def request(self, method, path, body=None):
+        return self.client().open(path, method=method, json=body, headers={
+            "Authorization": "Bearer {}".format(self.token)})
+
+    def row_statements(self, statements):
+        return [statement for statement in statements
+                if 'table_version' not in statement]
+
+    def test_patch_is_one_statement(self):
+        res, statements = self.count_statements(
+            self.request, 'PATCH', '/actors/{}'.format(self.actor_id),
+            {'age': 31, 'name': 'statement actor renamed'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(self.row_statements(statements)), 1)
+        actor = Actor.query.get(self.actor_id)
+        self.assertEqual((actor.name, actor.age),
+                         ('statement actor renamed', 31))
+
+    def test_delete_is_one_delete_statement(self):
+        res, statements = self.count_statements(
+            self.request, 'DELETE', '/actors/{}'.format(self.actor_id))
+        self.assertEqual(res.status_code, 200)
+        # the DELETE and the film counts update of the linked movies
+        statements = self.row_statements(statements)
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(len([statement for statement in statements
+                              if statement.startswith('DELETE')]), 1)
+        self.assertIsNone(Actor.query.get(self.actor_id))
+
+    def test_404_from_row_count(self):
+        res = self.request('PATCH', '/actors/999999', {'age': 31})
+        self.assertEqual(res.status_code, 404)
+        res = self.request('DELETE', '/actors/999999')
+        self.assertEqual(res.status_code, 404)
+
+    def test_patch_bumps_version(self):
+        before = get_versions(('Actor',))['Actor']
+        self.request('PATCH', '/actors/{}'.format(self.actor_id), {'age': 32})
+        self.assertEqual(get_versions(('Actor',))['Actor'], before + 1)
+
+
+class PoolConfigTestCase(unittest.TestCase):
+    """This class represents the connection pool configuration test case"""
+
+    def setUp(self):
+        self.environ = dict(os.environ)
+        pool_stats.reset()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def test_defaults(self):
+        options = engine_options('postgresql://localhost/casting')
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['pool_size'], 5)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertNotIn('connect_args', options)
+
+    def test_test_config_overrides_environment(self):
+        os.environ['DB_POOL_SIZE'] = '20'
+        os.environ['DB_POOL_PRE_PING'] = 'false'
+        options = engine_options('postgresql://localhost/casting', {
+            'DB_POOL_SIZE': 3, 'DB_STATEMENT_TIMEOUT': 5000})
+        self.assertEqual(options['pool_size'], 3)
+        self.assertFalse(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=5000'})
+
+    def test_sqlite_keeps_its_pool(self):
+        options = engine_options('sqlite:///casting.db',
+                                 {'DB_POOL_RECYCLE': 60})
+        self.assertNotIn('pool_size', options)
+        self.assertEqual(options['pool_recycle'], 60)
+
+    def test_checkout_statistics(self):
+        engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.01)
+        connection = engine.connect()
+        with self.assertRaises(exc.TimeoutError):
+            engine.connect()
+        connection.close()
+        self.assertEqual(pool_stats.checkouts, 1)
+        self.assertEqual(pool_stats.timeouts, 1)
+        self.assertGreaterEqual(pool_stats.wait_max, 0.01)
+
+
+class ReadReplicaTestCase(LocalAppTestCase):
+    """This class represents the read replica routing test case,
+    the replica is a second SQLite file"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        replica_url = 'sqlite:///' + os.path.join(
+            self.directory.name, 'replica.db')
+        engine = create_engine(replica_url)
+        db.Model.metadata.create_all(engine)
+        engine.execute(Movie.__table__.insert().values(
+            title='replica movie', release_date=date(2020, 1, 1)))
+        # the replica data must not share the primary ETags
+        engine.execute(TableVersion.__table__.update().values(version=1000))
+        engine.dispose()
+        self.app = create_app({'DATABASE_REPLICA_URLS': replica_url})
+        self.client = self.app.test_client
+        self.token = make_token(['get:movies', 'patch:actors'])
+        actor = Actor(name='primary actor', age=30, gender='male')
+        actor.insert()
+        self.actor_id = actor.id
+
+    def tearDown(self):
+        Actor.query.get(self.actor_id).delete()
+        self.directory.cleanup()
+        super().tearDown()
+
+    def replica_movies(self, client, **headers):
+        headers['Authorization'] = 'Bearer {}'.format(self.token)
+        res = client.get('/movies?title=replica+movie', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        return len(json.loads(res.data)['movies'])
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.replica_movies(self.client()), 1)
+
+    def test_header_reads_from_the_primary(self):
+        self.assertEqual(self.replica_movies(
+            self.client(), **{'X-Read-Primary': '1'}), 0)
+
+    def test_reads_after_a_write_go_to_the_primary(self):
+        client = self.client()
+        res = client.patch('/actors/{}'.format(self.actor_id),
+                           json={'age': 31}, headers={
+                               'Authorization': 'Bearer {}'.format(
+                                   self.token)})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('read_primary=1', res.headers['Set-Cookie'])
+        self.assertEqual(Actor.query.get(self.actor_id).age, 31)
+        self.assertEqual(self.replica_movies(client), 0)
+        self.assertEqual(self.replica_movies(self.client()), 1)
+
+    def test_unreachable_replica_falls_back_to_the_primary(self):
+        self.app = create_app({'DATABASE_REPLICA_URLS':
+                               'sqlite:////nonexistent/replica.db'})
+        self.client = self.app.test_client
+        self.assertEqual(self.replica_movies(self.client()), 0)
+        replicas = self.app.extensions['replicas']
+        self.assertEqual(replicas.fallbacks, 1)
+        self.assertEqual(replicas.status(), {'replica0': False})
+
+    def test_health_checks_are_cached(self):
+        now = [0]
+        replicas = ReplicaSet(['replica0'], check_interval=10,
+                              clock=lambda: now[0])
+        pings = []
+        replicas._ping = lambda engine: pings.append(engine) or False
+        self.assertIsNone(replicas.choose(lambda bind: 'engine'))
+        self.assertIsNone(replicas.choose(lambda bind: 'engine'))
+        self.assertEqual(len(pings), 1)
+        now[0] = 10
+        replicas._ping = lambda engine: True
+        self.assertEqual(replicas.choose(lambda bind: 'engine'), 'engine')
+
+
+@unittest.skipUnless(asgi, 'requires the ASGI dependencies')
+class AsgiTestCase(LocalAppTestCase):
+    """This class represents the ASGI application test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.asgi_app = asgi.create_asgi_app()
+        self.database = self.asgi_app.state.database
+        self.async_fetches = 0
+        self.asgi_jwks_store = asgi.jwks_store
+        asgi.jwks_store = asgi.AsyncJWKSStore(fetcher=self.async_fetcher)
+        self.wait(self.database.connect())
+        self.token = make_token(['get:movies', 'get:actors', 'post:movies',
+                                 'patch:movies', 'delete:movies'])
+
+    def tearDown(self):
+        self.wait(self.database.disconnect())
+        self.loop.close()
+        asgi.jwks_store = self.asgi_jwks_store
+        super().tearDown()
+
+    async def async_fetcher(self):
+        self.async_fetches += 1
+        await asyncio.sleep(0)
+        return local_jwks()
+
+    def wait(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    async def send(self, method, path, token=None, **kwargs):
+        headers = kwargs.pop('headers', {})
+        if token is not None:
+            headers['Authorization'] = 'Bearer {}'.format(token)
+        async with httpx.AsyncClient(app=self.asgi_app,
+                                     base_url='http://test') as client:
+            return await client.request(method, path, headers=headers,
+                                        **kwargs)
+
+    def request(self, method, path, token=None, **kwargs):
+        return self.wait(self.send(method, path, token, **kwargs))
+
+    def test_list_bodies_match_the_flask_app(self):
+        for path in ('/movies?limit=3', '/actors?include=movies',
+                     '/movies?sort=-title&limit=2',
+                     '/movies?fields=title&limit=2',
+                     '/actors?fields=name,age&include=movies&limit=2',
+                     '/stats/actors?age_bucket=5', '/stats/movies'):
+            expected = self.get(path, self.token)
+            response_cache.clear()
+            res = self.request('GET', path, self.token)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.content, expected.data)
+            self.assertEqual(res.headers['ETag'], expected.headers['ETag'])
+
+    def test_fields_match_the_flask_app(self):
+        movie = Movie(title='async fields', release_date=date(2006, 6, 6))
+        movie.insert()
+        actor = Actor(name='async fields', age=60, gender='female')
+        actor.insert()
+        movie_id, actor_id = movie.id, actor.id
+        add_links([(movie_id, actor_id)])
+        try:
+            for path in ('/movies/{}/actors?fields=name'.format(movie_id),
+                         '/actors/{}/movies?fields=id,title'.format(actor_id),
+                         '/movies/export?fields=release_date,title',
+                         '/actors/export?fields=age&name=async'):
+                expected = self.get(path, self.token)
+                response_cache.clear()
+                res = self.request('GET', path, self.token)
+                self.assertEqual(res.content, expected.data, path)
+            res = self.request('GET', '/movies?fields=budget', self.token)
+            self.assertEqual(res.status_code, 400)
+        finally:
+            Movie.query.get(movie_id).delete()
+            Actor.query.get(actor_id).delete()
+
+    def test_postgres_url_schemes(self):
+        for url in ('postgres://user@host/agency',
+                    'postgresql://user@host/agency',
+                    'postgresql+asyncpg://user@host/agency'):
+            self.assertTrue(asgi.is_postgres_url(url), url)
+        self.assertFalse(asgi.is_postgres_url('sqlite:///agency.db'))
+
+    def test_conditional_get(self):
+        res = self.request('GET', '/movies', self.token)
+        res = self.request('GET', '/movies', self.token, headers={
+            'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    def test_error_bodies_match_the_flask_app(self):
+        cases = [('GET', '/movies', None), ('GET', '/nowhere', self.token),
+                 ('PUT', '/movies', self.token),
+                 ('GET', '/movies?limit=0', self.token),
+                 ('DELETE', '/movies/999999', self.token),
+                 ('POST', '/actors', self.token)]
+        for method, path, token in cases:
+            headers = {} if token is None else {
+                'Authorization': 'Bearer {}'.format(token)}
+            expected = self.client().open(path, method=method,
+                                          headers=headers)
+            res = self.request(method, path, token)
+            self.assertEqual(res.status_code, expected.status_code, path)
+            self.assertEqual(res.json(), json.loads(expected.data), path)
+
+    def test_create_update_delete(self):
+        res = self.request('POST', '/movies', self.token, json={
+            'title': 'async movie', 'release_date': '2020-02-02'})
+        self.assertEqual(res.status_code, 200)
+        movie_id = res.json()['movie_id']
+        listed = self.request('GET', '/movies?title=async+movie', self.token)
+        self.assertEqual(len(listed.json()['movies']), 1)
+
+        res = self.request('PATCH', '/movies/{}'.format(movie_id),
+                           self.token, json={'release_date': '2021-03-03'})
+        self.assertEqual(res.status_code, 200)
+        listed = self.request('GET', '/movies?title=async+movie', self.token)
+        self.assertEqual(listed.json()['movies'][0]['release_date'],
+                         '2021-03-03')
+
+        res = self.request('DELETE', '/movies/{}'.format(movie_id),
+                           self.token)
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(Movie.query.get(movie_id))
+
+    def test_links_maintain_counts(self):
+        token = make_token(['post:movies_actors'])
+        movie_id = Movie.query.first().id
+        actor_ids = [actor.id for actor in Actor.query.limit(2)]
+        before = link_count_checks()
+        pairs = [{'movie_id': movie_id, 'actor_id': actor_id}
+                 for actor_id in actor_ids]
+        for mode in ('add', 'remove'):
+            res = self.request('POST', '/movies/actors', token, json={
+                'mode': mode, 'links': pairs})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(link_count_checks(), before)
+
+    def test_concurrent_requests_share_one_jwks_fetch(self):
+        async def burst():
+            return await asyncio.gather(*[
+                self.send('GET', '/movies', make_token(['get:movies'],
+                                                       expires_in=3600 + n))
+                for n in range(20)])
+
+        responses = self.wait(burst())
+        self.assertEqual({res.status_code for res in responses}, {200})
+        self.assertEqual(self.async_fetches, 1)
+
+
+    def test_jwks_store_serves_several_event_loops(self):
+        store = asgi.AsyncJWKSStore(fetcher=self.async_fetcher)
+
+        async def contended_refreshes():
+            return await asyncio.gather(store.refresh(), store.refresh())
+
+        for _ in range(2):
+            loop = asyncio.new_event_loop()
+            try:
+                self.assertEqual(
+                    loop.run_until_complete(contended_refreshes()),
+                    [True, True])
+            finally:
+                loop.close()
+
+class SerializerTestCase(LocalAppTestCase):
+    """This class represents the JSON serialization test case"""
+
+    payloads = [
+        {'success': True, 'movies': [], 'next_cursor': None},
+        {'b': 1, 'a': [1, 2.5, -3], 'c': {'z': None, 'y': False}},
+        {'title': 'caf\u00e9 \u2028 \U0001f3ac', 'name': 'tab\tnew\nline'},
+        {'control': '\x00\x1f\x7f "quoted" back\\slash /'},
+        {'big': 2 ** 70, 'empty': '', 'nested': [[{}]]},
+    ]
+
+    def test_dumps_matches_jsonify(self):
+        orjson = serializers.orjson
+        try:
+            for encoder in (orjson, None):
+                serializers.orjson = encoder
+                with self.app.app_context():
+                    for payload in self.payloads:
+                        self.assertEqual(
+                            dumps(payload), jsonify(payload).get_data())
+        finally:
+            serializers.orjson = orjson
+
+    def test_rows_match_format(self):
+        with self.app.app_context():
+            movies = Movie.query.order_by(Movie.id).limit(20).all()
+            rows = movie_serializer.query().order_by(Movie.id).limit(
+                20).all()
+            self.assertEqual(movie_serializer.format(rows),
+                             [movie.format() for movie in movies])
+
+    def test_list_body_matches_jsonify(self):
+        token = make_token(['get:movies', 'get:actors'])
+        for path in ('/movies?limit=20', '/actors?limit=20&include=movies'):
+            res = self.get(path, token)
+            with self.app.app_context():
+                self.assertEqual(
+                    res.data, jsonify(json.loads(res.data)).get_data())
+
+
+class FieldsTestCase(LocalAppTestCase):
+    """This class represents the fields= projection test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.token = make_token(['get:movies', 'get:actors'])
+
+    def test_movies_fields(self):
+        res, statements = self.count_statements(
+            self.get, '/movies?fields=id,title&limit=5', self.token)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        for movie in data['movies']:
+            self.assertEqual(set(movie), {'id', 'title'})
+        select = [statement for statement in statements
+                  if 'FROM "Movie"' in statement][0]
+        self.assertNotIn('release_date', select)
+
+    def test_sort_column_not_rendered(self):
+        actors = [Actor(name='fields actor', age=age, gender='female')
+                  for age in (20, 21)]
+        for actor in actors:
+            actor.insert()
+        try:
+            path = '/actors?fields=name&name=fields+actor&sort=age&limit=1'
+            data = json.loads(self.get(path, self.token).data)
+            self.assertEqual(data['actors'], [{'name': 'fields actor'}])
+            res = self.get(path + '&after=' + data['next_cursor'],
+                           self.token)
+            data = json.loads(res.data)
+            self.assertEqual(data['actors'], [{'name': 'fields actor'}])
+            self.assertIsNone(data['next_cursor'])
+        finally:
+            for actor in actors:
+                actor.delete()
+
+    def test_include_without_id(self):
+        res = self.get('/movies?fields=title&include=cast&limit=3',
+                       self.token)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        for movie in data['movies']:
+            self.assertEqual(set(movie), {'title', 'actors'})
+
+    def test_unknown_field(self):
+        for path in ('/movies?fields=id,budget', '/actors?fields=',
+                     '/actors/1/movies?fields=name'):
+            res = self.get(path, self.token)
+            self.assertEqual(res.status_code, 400, path)
+
+    def test_export_fields(self):
+        res = self.get('/actors/export?fields=name', self.token)
+        self.assertEqual(res.status_code, 200)
+        for line in res.data.decode('utf-8').splitlines():
+            self.assertEqual(set(json.loads(line)), {'name'})
+
+
+class CompressionTestCase(LocalAppTestCase):
+    """This class represents the response compression test case"""
+
+    path = '/movies?title=compressed+movie&limit=100'
+
+    def setUp(self):
+        super().setUp()
+        self.token = make_token(['get:movies'])
+        release_date = datetime.strptime('2002-02-02', '%Y-%m-%d')
+        self.movies = [Movie(title='compressed movie {}'.format(number),
+                             release_date=release_date)
+                       for number in range(40)]
+        for movie in self.movies:
+            movie.insert()
+        self.compressions = 0
+        self.app_module = sys.modules['app']
+        self.compress = self.app_module.compress
+        self.app_module.compress = self.counting_compress
+
+    def tearDown(self):
+        self.app_module.compress = self.compress
+        for movie in self.movies:
+            movie.delete()
+        super().tearDown()
+
+    def counting_compress(self, body, encoding):
+        self.compressions += 1
+        return self.compress(body, encoding)
+
+    def get_encoded(self, path, encoding, **headers):
+        headers['Authorization'] = 'Bearer {}'.format(self.token)
+        headers['Accept-Encoding'] = encoding
+        return self.client().get(path, headers=headers)
+
+    def test_gzip(self):
+        identity = self.get(self.path, self.token)
+        res = self.get_encoded(self.path, 'gzip')
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), identity.data)
+        self.assertEqual(res.get_etag()[0], identity.get_etag()[0] + '-gzip')
+
+    def test_compressed_body_cached(self):
+        first = self.get_encoded(self.path, 'gzip')
+        second = self.get_encoded(self.path, 'gzip')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(self.compressions, 1)
+
+    def test_not_modified_with_variant_etag(self):
+        etag = self.get_encoded(self.path, 'gzip').get_etag()[0]
+        res = self.get_encoded(self.path, 'gzip',
+                               **{'If-None-Match': '"{}"'.format(etag)})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.get_etag()[0], etag)
+
+    def test_small_body_not_compressed(self):
+        res = self.get_encoded('/movies?limit=1', 'gzip')
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(self.compressions, 0)
+
+    def test_quality_order(self):
+        res = self.get_encoded(self.path, 'br;q=0.5, gzip')
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        res = self.get_encoded(self.path, 'identity')
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    @unittest.skipUnless(compression.brotli, 'requires brotli')
+    def test_brotli_preferred(self):
+        identity = self.get(self.path, self.token)
+        res = self.get_encoded(self.path, 'gzip, deflate, br')
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+        self.assertEqual(compression.brotli.decompress(res.data),
+                         identity.data)
+
+
+class MetricsTestCase(LocalAppTestCase):
+    """This class represents the timings and /metrics test case"""
+
+    def server_timing(self, res):
+        entries = {}
+        for entry in res.headers['Server-Timing'].split(', '):
+            name, *params = entry.split(';')
+            entries[name] = dict(param.split('=', 1) for param in params)
+        return entries
+
+    def test_server_timing_phases(self):
+        res, queries = self.count_queries(
+            self.get, '/movies?limit=5', make_token(['get:movies']))
+        self.assertEqual(res.status_code, 200)
+        timing = self.server_timing(res)
+        for phase in ('auth_header', 'jwks', 'jwt_decode', 'serialize',
+                      'db', 'total'):
+            self.assertIn(phase, timing)
+        self.assertEqual(timing['db']['desc'],
+                         '"{} queries"'.format(queries))
+
+    def setUp(self):
+        super().setUp()
+        self.metrics_token = metrics.METRICS_TOKEN
+        metrics.METRICS_TOKEN = 'scrape-token'
+
+    def tearDown(self):
+        metrics.METRICS_TOKEN = self.metrics_token
+        super().tearDown()
+
+    def test_metrics_endpoint(self):
+        before = metrics.REQUESTS.value('GET', '/actors', 200)
+        self.get('/actors', make_token(['get:actors']))
+        self.assertEqual(metrics.REQUESTS.value('GET', '/actors', 200),
+                         before + 1)
+        res = self.client().get('/metrics', headers={
+            'Authorization': 'Bearer scrape-token'})
+        self.assertEqual(res.status_code, 200)
+        text = res.data.decode('utf-8')
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",'
+                      'route="/actors",le="+Inf"}', text)
+        for name in ('request_phase_duration_seconds_count{phase="jwks"}',
+                     'db_query_duration_seconds_count',
+                     'token_cache_misses_total', 'response_cache_hits_total',
+                     'db_pool_checkouts_total'):
+            self.assertIn(name, text)
+
+    def test_metrics_require_the_token(self):
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 401)
+        res = self.get('/metrics', make_token(['get:movies']))
+        self.assertEqual(res.status_code, 401)
+        metrics.METRICS_TOKEN = ''
+        res = self.client().get('/metrics', headers={
+            'Authorization': 'Bearer '})
+        self.assertEqual(res.status_code, 404)
+
+    def test_histogram_buckets(self):
+        histogram = metrics.Histogram('test_seconds', 'test', ('phase',),
+                                      buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, 'a')
+        lines = list(histogram.collect())
+        self.assertIn('test_seconds_bucket{phase="a",le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{phase="a",le="1"} 3', lines)
+        self.assertIn('test_seconds_bucket{phase="a",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{phase="a"} 4', lines)
+
+
+class StatsTestCase(LocalAppTestCase):
+    """This class represents the statistics endpoints test case"""
+
+    def setUp(self):
+        super().setUp()
+        movie = Movie(title='stats movie', release_date=date(1987, 6, 5))
+        actors = [Actor(name='stats actor', age=age, gender='stats')
+                  for age in (21, 29, 30)]
+        movie.insert()
+        for actor in actors:
+            actor.insert()
+        self.movie_id = movie.id
+        self.actor_ids = [actor.id for actor in actors]
+        add_links([(self.movie_id, actor_id)
+                   for actor_id in self.actor_ids[:2]])
+
+    def tearDown(self):
+        for actor_id in self.actor_ids:
+            Actor.query.get(actor_id).delete()
+        Movie.query.get(self.movie_id).delete()
+        super().tearDown()
+
+    def test_actor_stats_match_the_rows(self):
+        actors = Actor.query.all()
+        films = {}
+        for actor_id, in db.session.query(actor_movie.c.Actor):
+            films[actor_id] = films.get(actor_id, 0) + 1
+        res, queries = self.count_queries(
+            self.get, '/stats/actors?age_bucket=10',
+            make_token(['get:actors']))
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data)
+        self.assertEqual(data['total'], len(actors))
+        self.assertIn({'gender': 'stats', 'count': 3}, data['genders'])
+        self.assertEqual(sum(item['count'] for item in data['ages']),
+                         len(actors))
+        self.assertIn({'min': 20, 'max': 29, 'count': len(
+            [actor for actor in actors if 20 <= actor.age <= 29])},
+            data['ages'])
+        self.assertEqual(sum(item['actors'] for item in
+                             data['films']['distribution']), len(actors))
+        self.assertEqual(
+            sum(item['films'] * item['actors']
+                for item in data['films']['distribution']),
+            sum(films.values()))
+        self.assertLessEqual(queries, 8)
+
+    def test_movie_stats_match_the_rows(self):
+        movies = Movie.query.all()
+        sizes = dict.fromkeys([movie.id for movie in movies], 0)
+        for movie_id, in db.session.query(actor_movie.c.Movie):
+            sizes[movie_id] += 1
+        res = self.get('/stats/movies', make_token(['get:movies']))
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data)
+        self.assertEqual(data['total'], len(movies))
+        self.assertIn({'year': 1987, 'count': len(
+            [movie for movie in movies if movie.release_date.year == 1987])},
+            data['years'])
+        self.assertEqual(data['release_date']['min'], min(
+            movie.release_date for movie in movies).strftime('%Y-%m-%d'))
+        distribution = {}
+        for size in sizes.values():
+            distribution[size] = distribution.get(size, 0) + 1
+        self.assertEqual({item['cast_size']: item['movies']
+                          for item in data['cast']['distribution']},
+                         distribution)
+
+    def test_stats_are_cached_until_a_write(self):
+        token = make_token(['get:actors', 'post:movies_actors'])
+        first = self.get('/stats/actors', token)
+        _, queries = self.count_queries(self.get, '/stats/actors', token)
+        self.assertLessEqual(queries, 1)
+        add_links([(self.movie_id, self.actor_ids[2])])
+        res = self.get('/stats/actors', token)
+        self.assertNotEqual(res.headers['ETag'], first.headers['ETag'])
+
+    def test_invalid_age_bucket(self):
+        for bucket in ('0', '-5', 'ten', '101'):
+            res = self.get('/stats/actors?age_bucket=' + bucket,
+                           make_token(['get:actors']))
+            self.assertEqual(res.status_code, 400, bucket)
+
+
+class LinkCountTestCase(LocalAppTestCase):
+    """This class represents the cast_count and film_count test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.token = make_token(['get:movies', 'get:actors',
+                                 'post:movies_actors', 'delete:actors'])
+        movie = Movie(title='count movie', release_date=date(2003, 3, 3))
+        movie.insert()
+        actors = [Actor(name='count actor', age=40, gender='female')
+                  for _ in range(3)]
+        for actor in actors:
+            actor.insert()
+        self.movie_id = movie.id
+        self.actor_ids = [actor.id for actor in actors]
+
+    def tearDown(self):
+        for model, row_id in [(Movie, self.movie_id)] + [
+                (Actor, actor_id) for actor_id in self.actor_ids]:
+            row = model.query.get(row_id)
+            if row is not None:
+                row.delete()
+        super().tearDown()
+
+    def post(self, body):
+        return self.client().post('/movies/actors', json=body, headers={
+            "Authorization": "Bearer {}".format(self.token)})
+
+    def links(self, actor_ids, mode='add'):
+        return {'mode': mode, 'links': [
+            {'movie_id': self.movie_id, 'actor_id': actor_id}
+            for actor_id in actor_ids]}
+
+    def counts(self):
+        cast_count = db.session.query(Movie.cast_count).filter(
+            Movie.id == self.movie_id).scalar()
+        film_counts = [db.session.query(Actor.film_count).filter(
+            Actor.id == actor_id).scalar() for actor_id in self.actor_ids]
+        return cast_count, film_counts
+
+    def test_counts_follow_added_and_removed_links(self):
+        self.post(self.links(self.actor_ids[:2]))
+        # already linked pairs do not count twice
+        self.post(self.links(self.actor_ids))
+        self.assertEqual(self.counts(), (3, [1, 1, 1]))
+        self.post(self.links(self.actor_ids[1:] + [self.actor_ids[1]],
+                             'remove'))
+        self.assertEqual(self.counts(), (1, [1, 0, 0]))
+        self.post(self.links(self.actor_ids[1:], 'remove'))
+        self.assertEqual(self.counts(), (1, [1, 0, 0]))
+
+    def test_deleting_a_row_decrements_the_other_end(self):
+        self.post(self.links(self.actor_ids))
+        res = self.client().delete('/actors/{}'.format(self.actor_ids[0]),
+                                   headers={"Authorization": "Bearer {}"
+                                            .format(self.token)})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.counts()[0], 2)
+        Movie.query.get(self.movie_id).delete()
+        self.assertEqual(self.counts()[1][1:], [0, 0])
+
+    def test_deleting_a_missing_row_changes_nothing(self):
+        self.post(self.links(self.actor_ids))
+        version = get_versions(('Movie',))['Movie']
+        self.assertTrue(delete_row(Actor, self.actor_ids[0]))
+        self.assertFalse(delete_row(Actor, self.actor_ids[0]))
+        self.assertEqual(self.counts()[0], 2)
+        self.assertEqual(get_versions(('Movie',))['Movie'], version + 1)
+
+    def test_sort_and_filter_by_count(self):
+        self.post(self.links(self.actor_ids))
+        res = self.get('/movies?sort=-cast_count&cast_count_min=3',
+                       self.token)
+        movies = json.loads(res.data)['movies']
+        self.assertIn({'id': self.movie_id, 'title': 'count movie',
+                       'release_date': '2003-03-03', 'cast_count': 3},
+                      movies)
+        counts = [movie['cast_count'] for movie in movies]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        self.assertTrue(all(count >= 3 for count in counts))
+        res = self.get('/actors?sort=film_count&film_count_max=0&limit=500',
+                       self.token)
+        self.assertNotIn(self.actor_ids[0], [
+            actor['id'] for actor in json.loads(res.data)['actors']])
+
+    def test_writes_invalidate_the_list_cache(self):
+        path = '/movies?fields=id,cast_count&limit=100&sort=-cast_count'
+        etag = self.get(path, self.token).get_etag()[0]
+        self.post(self.links(self.actor_ids[:1]))
+        self.assertNotEqual(self.get(path, self.token).get_etag()[0], etag)
+
+    def test_consistency_check_and_refresh(self):
+        self.post(self.links(self.actor_ids))
+        self.assertEqual(link_count_checks(), {'Movie': [], 'Actor': []})
+        db.session.execute(Movie.__table__.update().where(
+            Movie.id == self.movie_id).values(cast_count=7))
+        db.session.commit()
+        self.assertEqual(link_count_checks()['Movie'],
+                         [(self.movie_id, 7, 3)])
+        self.assertEqual(refresh_link_counts(), 1)
+        self.assertEqual(self.counts()[0], 3)
+
+
+class ImportTestCase(LocalAppTestCase):
+    """This class represents the bulk import test case"""
+
+    def setUp(self):
+        super().setUp()
+        movie = Movie(title='import movie', release_date=date(2004, 4, 4))
+        movie.insert()
+        actor = Actor(name='import actor', age=50, gender='male')
+        actor.insert()
+        self.movie_id = movie.id
+        self.actor_id = actor.id
+
+    def tearDown(self):
+        Movie.query.filter(Movie.title.like('import %')).delete(
+            synchronize_session=False)
+        Actor.query.filter(Actor.name.like('import %')).delete(
+            synchronize_session=False)
+        db.session.commit()
+        super().tearDown()
+
+    def run_import(self, content, table_name, fmt='csv', **kwargs):
+        return import_file(io.StringIO(content), table_name, fmt,
+                           progress=lambda message: None, **kwargs)
+
+    def test_csv_movies_in_chunks(self):
+        version = get_versions(('Movie',))['Movie']
+        content = 'title,release_date\n' + ''.join(
+            'import csv {},2001-01-0{}\n'.format(number, number)
+            for number in range(1, 6))
+        self.assertEqual(self.run_import(content, 'movies', chunk_size=2),
+                         (5, 0))
+        self.assertEqual(Movie.query.filter(
+            Movie.title.like('import csv %')).count(), 5)
+        # one version bump for the whole file
+        self.assertEqual(get_versions(('Movie',))['Movie'], version + 1)
+
+    def test_ndjson_actors(self):
+        content = '\n'.join(json.dumps(
+            {'name': 'import ndjson', 'age': age, 'gender': 'female'})
+            for age in (20, '21')) + '\n\n'
+        self.assertEqual(self.run_import(content, 'actors', 'ndjson'),
+                         (2, 0))
+        self.assertEqual(sorted(age for age, in db.session.query(Actor.age)
+                                .filter(Actor.name == 'import ndjson')),
+                         [20, 21])
+
+    def test_invalid_rows_abort_the_import(self):
+        content = ('title,release_date\nimport ok,2001-01-01\n'
+                   'import bad,2001-13-01\n,2001-01-01\n')
+        with self.assertRaises(ImportFileError) as error:
+            self.run_import(content, 'movies', chunk_size=1)
+        self.assertEqual([item['line'] for item in error.exception.errors],
+                         [3, 4])
+        self.assertIn('release_date', error.exception.errors[0]['fields'])
+        self.assertIsNone(Movie.query.filter(
+            Movie.title == 'import ok').first())
+        with self.assertRaises(ImportFileError) as error:
+            self.run_import('{"name": "import x"\n', 'actors', 'ndjson')
+        self.assertEqual(error.exception.errors[0]['line'], 1)
+
+    def test_links_update_counts(self):
+        add_links([(self.movie_id, self.actor_id)])
+        actor = Actor(name='import second', age=30, gender='male')
+        actor.insert()
+        actor_id = actor.id
+        content = 'movie_id,actor_id\n' + ''.join(
+            '{},{}\n'.format(self.movie_id, row_id)
+            for row_id in (self.actor_id, actor_id, actor_id))
+        self.assertEqual(self.run_import(content, 'links'), (1, 0))
+        self.assertEqual(db.session.query(Movie.cast_count).filter(
+            Movie.id == self.movie_id).scalar(), 2)
+        self.assertEqual(db.session.query(Actor.film_count).filter(
+            Actor.id == actor_id).scalar(), 1)
+        self.assertEqual(link_count_checks(), {'Movie': [], 'Actor': []})
+
+    def test_skip_invalid(self):
+        unknown = db.session.query(db.func.max(Actor.id)).scalar() + 1
+        content = 'movie_id,actor_id\n{0},{1}\n{0},{2}\n{0},x\n'.format(
+            self.movie_id, self.actor_id, unknown)
+        with self.assertRaises(ImportFileError) as error:
+            self.run_import(content, 'links')
+        self.assertEqual([item['line'] for item in error.exception.errors],
+                         [4, 3])
+        self.assertEqual(self.run_import(content, 'links',
+                                         skip_invalid=True), (1, 2))
+        self.assertEqual(db.session.query(Movie.cast_count).filter(
+            Movie.id == self.movie_id).scalar(), 1)
+
+
+class BenchHarnessTestCase(LocalAppTestCase):
+    """This class represents the load testing harness test case"""
+
+    def test_mixed_workload_in_process(self):
+        with self.app.app_context():
+            ranges = seed(6, 3, 9, progress=lambda message: None)
+        results = bench_workload.run(
+            lambda: bench_workload.InProcessClient(self.app),
+            bench_workload.MIXES['mixed'], [make_token(ALL_PERMISSIONS)],
+            ranges, requests=40, concurrency=2)
+        summary = bench_report.summarize(results)
+        self.assertEqual(summary['total']['count'], 40)
+        self.assertEqual(summary['errors'], 0, summary['statuses'])
+
+    def test_percentiles_and_regressions(self):
+        values = [value / 1000 for value in range(1, 101)]
+        self.assertEqual(bench_report.percentile(values, 50), 0.05)
+        self.assertEqual(bench_report.percentile(values, 99), 0.099)
+        baseline = {'total': {'count': 100, 'throughput': 100.0,
+                              'p95': 10.0},
+                    'operations': {}, 'errors': 0}
+        current = {'total': {'count': 100, 'throughput': 90.0, 'p95': 11.0},
+                   'operations': {}, 'errors': 0}
+        self.assertEqual(bench_report.compare(current, baseline), [])
+        current['total'].update(throughput=70.0, p95=13.0)
+        current['errors'] = 2
+        self.assertEqual(len(bench_report.compare(current, baseline)), 3)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,135 @@
+import os
+from datetime import date
+
+# maximum number of items accepted by the bulk endpoints
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 10000))
+
+'''
+    Request body validation
+    Shared by the Flask and the ASGI applications, every function works
+    on plain decoded JSON values
+'''
+
+
+def parse_dates(values):
+    '''
+        Parse a batch of YYYY-MM-DD strings in one pass, invalid values
+        are returned as None
+    '''
+    dates = []
+    append = dates.append
+    fromisoformat = date.fromisoformat
+    for value in values:
+        try:
+            append(fromisoformat(value))
+        except (TypeError, ValueError):
+            append(None)
+    return dates
+
+
+def is_text(value, max_length):
+    return isinstance(value, str) and 0 < len(value.strip()) and \
+        len(value) <= max_length
+
+
+def validate_movies(items):
+    '''
+        Validate a batch of movies, return the rows to insert and the
+        per item errors
+    '''
+    rows, errors = [], []
+    release_dates = parse_dates(
+        item.get('release_date') if isinstance(item, dict) else None
+        for item in items)
+    for index, (item, release_date) in enumerate(zip(items, release_dates)):
+        if not isinstance(item, dict):
+            errors.append(
+                {'index': index, 'message': 'Movie must be an object'})
+            continue
+        item_errors = {}
+        if not is_text(item.get('title'), 100):
+            item_errors['title'] = 'Required string of at most 100 characters'
+        if release_date is None:
+            item_errors['release_date'] = 'Required date (YYYY-MM-DD)'
+        if item_errors:
+            errors.append({'index': index, 'fields': item_errors})
+            continue
+        rows.append({'title': item['title'], 'release_date': release_date})
+    return rows, errors
+
+
+def parse_int(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    # isdigit() alone accepts digits such as '²' which int() rejects
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        return int(value)
+    return None
+
+
+def parse_ints(values):
+    '''
+        Parse a batch of non negative integers (ints or digit strings)
+        in one pass, invalid values are returned as None
+    '''
+    return [parse_int(value) for value in values]
+
+
+def _field(items, name):
+    return [item.get(name) if isinstance(item, dict) else None
+            for item in items]
+
+
+def validate_actors(items):
+    '''
+        Validate a batch of actors, return the rows to insert and the
+        per item errors
+    '''
+    rows, errors = [], []
+    ages = parse_ints(_field(items, 'age'))
+    for index, (item, age) in enumerate(zip(items, ages)):
+        if not isinstance(item, dict):
+            errors.append(
+                {'index': index, 'message': 'Actor must be an object'})
+            continue
+        item_errors = {}
+        if not is_text(item.get('name'), 120):
+            item_errors['name'] = 'Required string of at most 120 characters'
+        if age is None or age < 0:
+            item_errors['age'] = 'Required non negative integer'
+        if not is_text(item.get('gender'), 120):
+            item_errors['gender'] = 'Required string of at most 120 characters'
+        if item_errors:
+            errors.append({'index': index, 'fields': item_errors})
+            continue
+        rows.append({'name': item['name'], 'age': age,
+                     'gender': item['gender']})
+    return rows, errors
+
+
+def validate_links(items):
+    '''
+        Validate a batch of {'movie_id', 'actor_id'} links, return the
+        (movie_id, actor_id) pairs and the per item errors
+    '''
+    pairs, errors = [], []
+    movie_ids = parse_ints(_field(items, 'movie_id'))
+    actor_ids = parse_ints(_field(items, 'actor_id'))
+    for index, (item, movie_id, actor_id) in enumerate(
+            zip(items, movie_ids, actor_ids)):
+        if not isinstance(item, dict):
+            errors.append(
+                {'index': index, 'message': 'Link must be an object'})
+            continue
+        item_errors = {}
+        if movie_id is None:
+            item_errors['movie_id'] = 'Required integer'
+        if actor_id is None:
+            item_errors['actor_id'] = 'Required integer'
+        if item_errors:
+            errors.append({'index': index, 'fields': item_errors})
+            continue
+        pairs.append((movie_id, actor_id))
+    return pairs, errors